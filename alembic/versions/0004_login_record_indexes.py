@@ -0,0 +1,39 @@
+"""login record lookup indexes
+
+Revision ID: 0004_login_record_indexes
+Revises: 0003_password_expiry
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+from sqlalchemy import inspect
+
+revision: str = '0004_login_record_indexes'
+down_revision: Union[str, None] = '0003_password_expiry'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+_INDEXES = {
+    'ix_login_record_user_id_time': ['user_id', 'time'],
+    'ix_login_record_ip_time': ['ip', 'time'],
+}
+
+
+def _login_record_index_names() -> set[str]:
+    return {index['name'] for index in inspect(op.get_bind()).get_indexes('login_record')}
+
+
+def upgrade() -> None:
+    existing = _login_record_index_names()
+    for name, columns in _INDEXES.items():
+        if name not in existing:
+            op.create_index(name, 'login_record', columns)
+
+
+def downgrade() -> None:
+    existing = _login_record_index_names()
+    for name in _INDEXES:
+        if name in existing:
+            op.drop_index(name, table_name='login_record')
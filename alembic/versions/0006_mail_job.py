@@ -0,0 +1,66 @@
+"""broadcast mail jobs
+
+Revision ID: 0006_mail_job
+Revises: 0005_mail_outbox
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+revision: str = '0006_mail_job'
+down_revision: Union[str, None] = '0005_mail_outbox'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _table_exists(name: str) -> bool:
+    return name in inspect(op.get_bind()).get_table_names()
+
+
+def _outbox_column_names() -> set[str]:
+    return {col['name'] for col in inspect(op.get_bind()).get_columns('mail_outbox')}
+
+
+def upgrade() -> None:
+    if not _table_exists('mail_job'):
+        op.create_table(
+            'mail_job',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('sender_id', sa.Integer(), nullable=True),
+            sa.Column('subject', sa.String(length=256), nullable=False),
+            sa.Column('num_recipients', sa.Integer(), nullable=False),
+            sa.Column('num_chunks', sa.Integer(), nullable=False),
+            sa.Column('sent_chunks', sa.Integer(), nullable=False),
+            sa.Column('failed_chunks', sa.Integer(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('finished_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['sender_id'], ['user.id'], ondelete='SET NULL'),
+            sa.PrimaryKeyConstraint('id'),
+        )
+
+    existing = _outbox_column_names()
+    with op.batch_alter_table('mail_outbox') as batch_op:
+        if 'job_id' not in existing:
+            batch_op.add_column(sa.Column('job_id', sa.Integer(), nullable=True))
+            batch_op.create_foreign_key('fk_mail_outbox_job_id', 'mail_job', ['job_id'], ['id'], ondelete='CASCADE')
+            batch_op.create_index('ix_mail_outbox_job_id', ['job_id'])
+        if 'num_recipients' not in existing:
+            batch_op.add_column(sa.Column('num_recipients', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade() -> None:
+    existing = _outbox_column_names()
+    with op.batch_alter_table('mail_outbox') as batch_op:
+        if 'num_recipients' in existing:
+            batch_op.drop_column('num_recipients')
+        if 'job_id' in existing:
+            batch_op.drop_index('ix_mail_outbox_job_id')
+            batch_op.drop_constraint('fk_mail_outbox_job_id', type_='foreignkey')
+            batch_op.drop_column('job_id')
+
+    if _table_exists('mail_job'):
+        op.drop_table('mail_job')
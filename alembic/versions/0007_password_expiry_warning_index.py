@@ -0,0 +1,33 @@
+"""password expiry warning lookup index
+
+Revision ID: 0007_password_expiry_warning_index
+Revises: 0006_mail_job
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+from sqlalchemy import inspect
+
+revision: str = '0007_password_expiry_warning_index'
+down_revision: Union[str, None] = '0006_mail_job'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+_INDEX_NAME = 'ix_user_password_expiry_warning'
+_INDEX_COLUMNS = ['password_expiry_warning_email_sent_at', 'password_expires_at']
+
+
+def _user_index_names() -> set[str]:
+    return {index['name'] for index in inspect(op.get_bind()).get_indexes('user')}
+
+
+def upgrade() -> None:
+    if _INDEX_NAME not in _user_index_names():
+        op.create_index(_INDEX_NAME, 'user', _INDEX_COLUMNS)
+
+
+def downgrade() -> None:
+    if _INDEX_NAME in _user_index_names():
+        op.drop_index(_INDEX_NAME, table_name='user')
@@ -0,0 +1,41 @@
+"""signed access token revocations
+
+Revision ID: 0008_oauth_token_revocation
+Revises: 0007_password_expiry_warning_index
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+revision: str = '0008_oauth_token_revocation'
+down_revision: Union[str, None] = '0007_password_expiry_warning_index'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _table_exists(name: str) -> bool:
+    return name in inspect(op.get_bind()).get_table_names()
+
+
+def upgrade() -> None:
+    if _table_exists('o_auth_token_revocation'):
+        return
+    op.create_table(
+        'o_auth_token_revocation',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('client_id', sa.Integer(), nullable=True),
+        sa.Column('revoked_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_o_auth_token_revocation_revoked_at', 'o_auth_token_revocation', ['revoked_at'])
+
+
+def downgrade() -> None:
+    if _table_exists('o_auth_token_revocation'):
+        op.drop_index('ix_o_auth_token_revocation_revoked_at', table_name='o_auth_token_revocation')
+        op.drop_table('o_auth_token_revocation')
@@ -0,0 +1,41 @@
+"""OAuth eligibility change log
+
+Revision ID: 0009_oauth_acl_change
+Revises: 0008_oauth_token_revocation
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+revision: str = '0009_oauth_acl_change'
+down_revision: Union[str, None] = '0008_oauth_token_revocation'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _table_exists(name: str) -> bool:
+    return name in inspect(op.get_bind()).get_table_names()
+
+
+def upgrade() -> None:
+    if _table_exists('o_auth_acl_change'):
+        return
+    op.create_table(
+        'o_auth_acl_change',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('client_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_o_auth_acl_change_created_at', 'o_auth_acl_change', ['created_at'])
+
+
+def downgrade() -> None:
+    if _table_exists('o_auth_acl_change'):
+        op.drop_index('ix_o_auth_acl_change_created_at', table_name='o_auth_acl_change')
+        op.drop_table('o_auth_acl_change')
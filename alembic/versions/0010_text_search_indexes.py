@@ -0,0 +1,56 @@
+"""text search indexes for user and group autocomplete
+
+Revision ID: 0010_text_search_indexes
+Revises: 0009_oauth_acl_change
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+revision: str = '0010_text_search_indexes'
+down_revision: Union[str, None] = '0009_oauth_acl_change'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+_COLUMNS = {
+    'user': ['name', 'nickname', 'real_name'],
+    'group': ['name', 'description'],
+}
+
+
+def _index_names(table: str) -> set[str]:
+    return {index['name'] for index in inspect(op.get_bind()).get_indexes(table)}
+
+
+def _indexes(dialect: str):
+    """(table, index name, expression, kwargs) of the indexes utils.text_search relies on for ``dialect``."""
+    for table, columns in _COLUMNS.items():
+        for column in columns:
+            if dialect == 'postgresql':
+                # substring and prefix LIKE on lower(column); GIN keeps no order and needs three characters
+                yield table, 'ix_%s_%s_trgm' % (table, column), 'lower(%s) gin_trgm_ops' % column, \
+                    dict(postgresql_using='gin')
+                # the ordered prefix walk of limited searches, also for one- and two-character terms
+                yield table, 'ix_%s_%s_lower' % (table, column), 'lower(%s) COLLATE "C"' % column, {}
+            elif dialect == 'sqlite':  # prefix LIKE only; substring search stays a scan
+                yield table, 'ix_%s_%s_nocase' % (table, column), '%s COLLATE NOCASE' % column, {}
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, name, expression, kwargs in _indexes(dialect):
+        if name not in _index_names(table):
+            op.create_index(name, table, [sa.text(expression)], **kwargs)
+
+
+def downgrade() -> None:
+    # pg_trgm is left installed; other objects may depend on it
+    for table, name, _, _ in _indexes(op.get_bind().dialect.name):
+        if name in _index_names(table):
+            op.drop_index(name, table_name=table)
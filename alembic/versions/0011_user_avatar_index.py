@@ -0,0 +1,32 @@
+"""user avatar index for counting references to shared avatar files
+
+Revision ID: 0011_user_avatar_index
+Revises: 0010_text_search_indexes
+Create Date: 2026-10-18
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+from sqlalchemy import inspect
+
+revision: str = '0011_user_avatar_index'
+down_revision: Union[str, None] = '0010_text_search_indexes'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+_INDEX_NAME = 'ix_user_avatar'
+
+
+def _user_index_names() -> set[str]:
+    return {index['name'] for index in inspect(op.get_bind()).get_indexes('user')}
+
+
+def upgrade() -> None:
+    if _INDEX_NAME not in _user_index_names():
+        op.create_index(_INDEX_NAME, 'user', ['avatar'])
+
+
+def downgrade() -> None:
+    if _INDEX_NAME in _user_index_names():
+        op.drop_index(_INDEX_NAME, table_name='user')
@@ -9,7 +9,7 @@ from services.group import GroupServiceError, GroupService
 from services.oauth import OAuthService, OAuthServiceError
 from services.user import UserService, UserServiceError
 from utils.external_auth.provider import get_provider, get_providers
-from utils.mail import send_email, is_mail_enabled
+from utils.mail import commit_and_send_email, is_mail_enabled
 from utils.qr_code import build_qr_code, img_to_base64
 from utils.session import (
     get_session_user,
@@ -23,7 +23,8 @@ from utils.session import (
     get_two_factor_user,
 )
 from services.password_expiry import PasswordExpiryError, set_password_expiry_oauth_dismissed
-from utils.upload import handle_upload, handle_post_upload, UploadError
+from utils.upload import handle_upload, handle_post_upload, limit_upload_request, UploadError
+from utils.conditional import make_etag, not_modified, user_version, with_etag
 from utils.captcha import (
     captcha_required_for_login,
     peek_captcha,
@@ -116,8 +117,7 @@ def account_register():
         groups = GroupService.get_by_name_list(add_to_groups) if add_to_groups else []
         if groups:
             user.groups.extend(groups)
-        db.session.commit()
-        send_email(name, email, 'confirm_email', user=user, site=app.config['SITE'])
+        commit_and_send_email(name, email, 'confirm_email', user=user, site=app.config['SITE'])
         return jsonify(user.to_dict(with_advanced_fields=True)), 201
     except (UserServiceError, GroupServiceError, ValueError) as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -210,8 +210,7 @@ def account_request_reset_password():
                 return jsonify(msg='provider not found'), 500
             return jsonify(provider.to_dict())
         else:
-            db.session.commit()
-            send_email(user.name, user.email, 'reset_password', user=user, site=app.config['SITE'])
+            commit_and_send_email(user.name, user.email, 'reset_password', user=user, site=app.config['SITE'])
             return "", 204
     except UserServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -254,9 +253,7 @@ def account_reconfirm_email():
         name_or_email = _json.get('name_or_email')
 
         user = UserService.request_reconfirm_email(name_or_email)
-        db.session.commit()
-
-        send_email(user.name, user.email, 'confirm_email', user=user, site=app.config['SITE'])
+        commit_and_send_email(user.name, user.email, 'confirm_email', user=user, site=app.config['SITE'])
         return "", 204
     except UserServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -268,7 +265,7 @@ def account_who_am_i():
     A more API-friendly version of 'account_me()'
     """
     try:
-        user = get_current_user()
+        user = get_current_user(read_only=True)  # no writes on the most frequent endpoint
     except UserServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 500
     except PasswordExpiryError as e:
@@ -282,7 +279,6 @@ def account_who_am_i():
         return "", 204
     if not user.is_active:  # do not acknowledge inactive user as '@requires_login' do
         return "", 204
-    db.session.commit()
     return jsonify(user_to_dict_with_password_expiry(user, include_intercept=True))
 
 
@@ -292,18 +288,24 @@ def account_me():
     try:
         user = get_current_user()
         if request.method == 'GET':
+            site_config = app.config['SITE']
+            etag = make_etag(user_version(user), site_config['root_url'], site_config['base_url'])
+            response = not_modified(etag)
+            if response is not None:
+                return response
+
             user_dict = user.to_dict()
 
             # add full avatar URL for compatibility with 3rd-party OAuth clients
             user_avatar = user_dict.get('avatar')
             user_avatar_full = None
             if user_avatar:
-                site_config = app.config['SITE']
                 user_avatar_full = site_config['root_url'] + site_config['base_url'] + user_avatar
             user_dict['avatar_full'] = user_avatar_full
 
-            return jsonify(user_dict)
+            return with_etag(jsonify(user_dict), etag)
         else:
+            limit_upload_request('avatar')  # before the form is parsed
             files = request.files
             params = request.form.to_dict() or (request.json if request.is_json else {}) or {}
 
@@ -316,12 +318,11 @@ def account_me():
                 params['avatar'] = url  # save url in params
 
             old_profile = UserService.update_profile(user, **params)
+            db.session.commit()
             if avatar_file:
                 old_avatar = old_profile.get('avatar')
                 if old_avatar:
-                    handle_post_upload(old_avatar, 'avatar')
-
-            db.session.commit()
+                    handle_post_upload(old_avatar, 'avatar')  # once the new reference is committed
             # TODO also add full avatar URL for PUT method? and any other locations?
             return jsonify(user.to_dict())
     except OAuthServiceError as e:
@@ -457,9 +458,7 @@ def account_two_factor_request_disable_by_email():
                 return jsonify(msg='two-factor authentication was not started or is already expired'), 403
 
         UserService.two_factor_request_disable_by_email(user)
-        db.session.commit()
-
-        send_email(user.name, user.email, 'disable_two_factor', user=user, site=app.config['SITE'])
+        commit_and_send_email(user.name, user.email, 'disable_two_factor', user=user, site=app.config['SITE'])
         return "", 204
     except OAuthServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 403
@@ -1,20 +1,44 @@
 from time import time
 
-from flask import Blueprint, current_app as app, request, jsonify, current_app, json
+from flask import Blueprint, Response, current_app as app, request, jsonify, current_app, json, stream_with_context
 
-from models import db
+from models import MailJob, db
 from services.group import GroupService, GroupServiceError
 from services.login_record import LoginRecordService
+from services.mail_outbox import deliver_job_in_background, enqueue_broadcast, get_job_outstanding_chunks
 from services.oauth import OAuthServiceError, OAuthService
+from services.oauth_eligibility import get_eligibility_stats, record_acl_change
+from services.oauth_signed_token import revoke_signed_tokens
+from services.oauth_token_cache import (
+    get_token_cache_stats,
+    invalidate_all_tokens,
+    invalidate_client_tokens,
+    invalidate_user_tokens,
+)
+from services.password_expiry import PasswordExpiryError, get_password_expiry_status
 from services.user import UserService, UserServiceError
+from utils.conditional import make_etag, not_modified, user_version, with_etag
 from utils.external_user_info import get_external_user_info
-from utils.ip import get_ip_info, get_ip_country_info
-from utils.mail import send_email, send_emails, is_mail_enabled, build_confirm_email_url
+from utils.ip import get_geo_stats, get_ip_info, lookup_many
+from utils.mail import (
+    build_confirm_email_url,
+    commit_and_send_email,
+    is_mail_enabled,
+    is_mail_outbox_enabled,
+    send_email,
+)
 from utils.session import requires_admin, set_current_user, get_session_user, clear_current_user, get_current_user
-from utils.upload import handle_upload, handle_post_upload, UploadError
+from utils.thumbnail import get_thumbnail_stats
+from utils.upload import handle_upload, handle_post_upload, limit_upload_request, UploadError
 
 admin = Blueprint('admin', __name__)
 
+_USER_LIST_DEFAULT_LIMIT = 200
+_USER_LIST_MAX_LIMIT = 1000
+_USER_LIST_STREAM_BATCH_SIZE = 500
+_USER_BATCH_MAX_KEYS = 500
+_USER_BATCH_FIELDS = ('id', 'name', 'email', 'nickname', 'real_name', 'avatar', 'is_active')
+
 
 @admin.route('/users', methods=['GET', 'POST'])
 @requires_admin
@@ -33,17 +57,23 @@ def admin_user_list():
                 else:
                     users = UserService.search_by_name(args['name'])  # use default limit
                 return jsonify([user.to_dict(with_advanced_fields=True) for user in users])
-            else:  # get all
-                users = UserService.get_all()
+            else:  # list, one page per request (keyset cursor on id) or streamed as NDJSON
+                filters = _user_list_filters(args)
+                if args.get('format') == 'ndjson':
+                    users = UserService.filter_users(**filters).yield_per(_USER_LIST_STREAM_BATCH_SIZE)
+                    return Response(stream_with_context(_user_list_ndjson(users)), mimetype='application/x-ndjson')
+                limit = _int_arg(args, 'limit', _USER_LIST_DEFAULT_LIMIT)
+                if not 1 <= limit <= _USER_LIST_MAX_LIMIT:
+                    raise UserServiceError('limit must be between 1 and %d' % _USER_LIST_MAX_LIMIT)
+                users = UserService.filter_users(**filters).limit(limit).all()
                 user_dicts = []
                 group_set = set()
                 for u in users:
                     user_dicts.append(u.to_dict(with_groups=False, with_group_ids=True, with_advanced_fields=True))
-                    # assume groups are lazy-loaded, otherwise need to dig into User.to_dict() to avoid redundant
-                    # SQL queries on Group table
                     group_set.update(u.groups)
                 group_dicts = [g.to_dict(with_advanced_fields=True) for g in group_set]
-                return jsonify(users=user_dicts, groups=group_dicts)
+                next_cursor = users[-1].id if len(users) == limit else None
+                return jsonify(users=user_dicts, groups=group_dicts, next_cursor=next_cursor)
         else:  # POST
             _json = request.json
             name = _json.get('name')
@@ -56,10 +86,10 @@ def admin_user_list():
                 name, email, external_auth_provider_id, skip_email_confirmation,
                 real_name=real_name, mobile=mobile,
             )
-            db.session.commit()
-
             if not skip_email_confirmation:
-                send_email(name, email, 'confirm_email', user=user, site=app.config['SITE'])
+                commit_and_send_email(name, email, 'confirm_email', user=user, site=app.config['SITE'])
+            else:
+                db.session.commit()
             payload = user.to_dict(with_advanced_fields=True)
             if (not is_mail_enabled() and not skip_email_confirmation
                     and user.email_confirm_token is not None):
@@ -69,6 +99,69 @@ def admin_user_list():
         return jsonify(msg=e.msg, detail=e.detail), 400
 
 
+def _int_arg(args, name, default=None):
+    value = args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise UserServiceError('%s must be an integer' % name)
+
+
+def _bool_arg(args, name):
+    value = args.get(name)
+    if value is None or value == '':
+        return None
+    if value not in ('true', 'false'):
+        raise UserServiceError('%s must be true or false' % name)
+    return value == 'true'
+
+
+def _user_list_filters(args):
+    return dict(after_id=_int_arg(args, 'cursor'), is_active=_bool_arg(args, 'active'),
+                group_id=_int_arg(args, 'group'), is_two_factor_enabled=_bool_arg(args, 'two_factor'),
+                password_expiry_status=args.get('expiry_status') or None)
+
+
+def _user_list_ndjson(users):
+    for user in users:
+        yield app.json.dumps(user.to_dict(with_advanced_fields=True)) + '\n'
+
+
+@admin.route('/users/batch')
+@requires_admin
+def admin_user_batch():
+    """Resolve ``names=a,b,c`` and/or ``ids=1,2,3`` with one query each, for relying apps rendering rosters."""
+    try:
+        names = [name for name in request.args.get('names', '').split(',') if name]
+        try:
+            ids = [int(_id) for _id in request.args.get('ids', '').split(',') if _id]
+        except ValueError:
+            raise UserServiceError('ids must be integers')
+        if len(names) + len(ids) > _USER_BATCH_MAX_KEYS:
+            raise UserServiceError('at most %d names and ids per request' % _USER_BATCH_MAX_KEYS)
+
+        users = {user.id: user for user in UserService.get_by_name_list(names) + UserService.get_by_id_list(ids)}
+        etag = make_etag(sorted((user.id, user.modified_at) for user in users.values()))
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        by_name = {user.name: user for user in users.values()}
+        found = set()
+        result = []
+        for user in [by_name.get(name) for name in names] + [users.get(_id) for _id in ids]:
+            if user is not None and user.id not in found:
+                found.add(user.id)
+                result.append({field: getattr(user, field) for field in _USER_BATCH_FIELDS})
+        return with_etag(jsonify(users=result,
+                                 missing_names=[name for name in names if name not in by_name],
+                                 missing_ids=[_id for _id in ids if _id not in users]), etag)
+    except UserServiceError as e:
+        return jsonify(msg=e.msg, detail=e.detail), 400
+
+
 @admin.route('/users/<int:uid>', methods=['GET', 'DELETE', 'PUT'])
 @requires_admin
 def admin_user_by_id(uid):
@@ -133,12 +226,29 @@ def _admin_user(user):
 
     if request.method == 'GET':
         require_oauth_info = request.args.get('oauth-info') == 'true'
-        return jsonify(user.to_dict(with_authorizations=require_oauth_info, with_advanced_fields=True))
+        authorizations = None
+        if require_oauth_info:
+            UserService.load_authorizations(user)
+            authorizations = [(a.client_id, a.modified_at, a.client.modified_at) for a in user.authorizations]
+        # the password expiry status also moves with the clock, not only with the row
+        etag = make_etag(user_version(user), get_password_expiry_status(user), authorizations)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        return with_etag(jsonify(user.to_dict(with_authorizations=require_oauth_info, with_advanced_fields=True)),
+                         etag)
     elif request.method == 'DELETE':
+        uid, avatar = user.id, user.avatar
         db.session.delete(user)
+        revoke_signed_tokens(user_id=uid)
+        record_acl_change(user_id=uid)
         db.session.commit()
+        invalidate_user_tokens(uid)
+        if avatar:
+            handle_post_upload(avatar, 'avatar')
         return "", 204
     else:  # PUT
+        limit_upload_request('avatar')  # before the form is parsed
         files = request.files
         params = request.form.to_dict() or (request.json if request.is_json else {}) or {}
 
@@ -151,12 +261,11 @@ def _admin_user(user):
             params['avatar'] = url  # save url in params
 
         old_profile = UserService.update_profile(user, **params)
+        db.session.commit()
         if avatar_file:
             old_avatar = old_profile.get('avatar')
             if old_avatar:
-                handle_post_upload(old_avatar, 'avatar')
-
-        db.session.commit()
+                handle_post_upload(old_avatar, 'avatar')  # once the new reference is committed
         return jsonify(user.to_dict(with_advanced_fields=True))
 
 
@@ -177,7 +286,10 @@ def admin_user_set_active(uid):
                 return jsonify(msg='user already inactive'), 400
             user.is_active = False
 
+        revoke_signed_tokens(user_id=user.id)
+        record_acl_change(user_id=user.id)  # reaches the token caches of the other workers
         db.session.commit()
+        invalidate_user_tokens(user.id)
         return "", 204
     except UserServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -192,9 +304,7 @@ def admin_user_reconfirm_email(uid):
             return jsonify(msg='user not found'), 404
 
         UserService.admin_reset_email_confirmation(user)
-        db.session.commit()
-
-        send_email(user.name, user.email, 'confirm_email', user=user, site=app.config['SITE'])
+        commit_and_send_email(user.name, user.email, 'confirm_email', user=user, site=app.config['SITE'])
         if not is_mail_enabled() and user.email_confirm_token is not None:
             return jsonify(dict(url=build_confirm_email_url(user)))
         return "", 204
@@ -225,18 +335,15 @@ def admin_user_login_records(uid):
             return jsonify(msg='user not found'), 404
 
         require_country = request.args.get('country') == 'true'
-        country_info = {}
+        records = LoginRecordService.get_for_user(user)
+        countries = lookup_many((r.ip for r in records if r.ip), country_only=True) if require_country else {}
 
         results = []
-        for r in LoginRecordService.get_for_user(user):
+        for r in records:
             result = r.to_dict()
-            if require_country:
-                info = country_info.get(r.ip)
-                if not info:
-                    country_info[r.ip] = info = get_ip_country_info(r.ip)
-                country = info.to_dict()
-                if country:
-                    result['country'] = country
+            country = countries.get(r.ip)
+            if country:
+                result['country'] = country
             results.append(result)
         return jsonify(results)
     except UserServiceError as e:
@@ -284,10 +391,19 @@ def admin_group(gid):
 
         if request.method == 'GET':
             require_oauth_info = request.args.get('oauth-info') == 'true'
-            return jsonify(group.to_dict(with_allowed_clients=require_oauth_info, with_advanced_fields=True))
+            clients = sorted((c.id, c.modified_at) for c in group.allowed_clients) if require_oauth_info else None
+            etag = make_etag(group.id, group.modified_at, clients)
+            response = not_modified(etag)
+            if response is not None:
+                return response
+            group_dict = group.to_dict(with_allowed_clients=require_oauth_info, with_advanced_fields=True)
+            return with_etag(jsonify(group_dict), etag)
         elif request.method == 'DELETE':
             db.session.delete(group)
+            revoke_signed_tokens()
+            record_acl_change()
             db.session.commit()
+            invalidate_all_tokens()  # affects memberships of many users and the ACLs of many clients
             return "", 204
         else:  # PUT
             params = request.json or {}
@@ -348,13 +464,19 @@ def _admin_group_user(group, user):
         if group in user.groups:
             return jsonify(msg='user already in the group'), 400
         user.groups.append(group)
+        revoke_signed_tokens(user_id=user.id)
+        record_acl_change(user_id=user.id)
         db.session.commit()
+        invalidate_user_tokens(user.id)
         return "", 204
     else:  # DELETE
         if group not in user.groups:
             return jsonify(msg='user not in the group'), 400
         user.groups.remove(group)
+        revoke_signed_tokens(user_id=user.id)
+        record_acl_change(user_id=user.id)
         db.session.commit()
+        invalidate_user_tokens(user.id)
         return "", 204
 
 
@@ -372,6 +494,8 @@ def oauth_clients():
             description = _json.get('description')
 
             client = OAuthService.add_client(name, redirect_url, home_url, description)
+            db.session.flush()
+            record_acl_change(client_id=client.id)
             db.session.commit()
             return jsonify(client.to_dict(with_advanced_fields=True)), 201
     except OAuthServiceError as e:
@@ -389,10 +513,17 @@ def oauth_client(cid):
         if request.method == 'GET':
             return jsonify(client.to_dict(with_advanced_fields=True))
         elif request.method == 'DELETE':
+            icon = client.icon
             db.session.delete(client)
+            revoke_signed_tokens(client_id=cid)
+            record_acl_change(client_id=cid)
             db.session.commit()
+            invalidate_client_tokens(cid)
+            if icon:
+                handle_post_upload(icon, 'icon')
             return "", 204
         else:  # PUT
+            limit_upload_request('icon')  # before the form is parsed
             files = request.files
             params = request.form.to_dict() or (request.json if request.is_json else {}) or {}
 
@@ -405,12 +536,11 @@ def oauth_client(cid):
                 params['icon'] = url  # save url in params
 
             old_profile = OAuthService.update_client_profile(client, **params)
+            db.session.commit()
             if icon_file is not None:
                 old_icon = old_profile.get('icon')
                 if old_icon:
-                    handle_post_upload(old_icon, 'icon')
-
-            db.session.commit()
+                    handle_post_upload(old_icon, 'icon')  # once the new reference is committed
             return jsonify(client.to_dict(with_advanced_fields=True))
     except (OAuthServiceError, UploadError) as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -433,7 +563,10 @@ def oauth_client_set_public(cid):
                 return jsonify(msg='client already non-public'), 400
             client.is_public = False
 
+        revoke_signed_tokens(client_id=client.id)
+        record_acl_change(client_id=client.id)
         db.session.commit()
+        invalidate_client_tokens(client.id)
         return "", 204
     except OAuthServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -493,6 +626,7 @@ def oauth_client_generate_config_file(cid):
                 "profile_api": "/api/account/me",
                 "admin_users_api": "/api/admin/users",
                 "admin_user_by_name_api": "/api/admin/user-by-name",
+                "admin_users_batch_api": "/api/admin/users/batch",
                 "admin_groups_api": "/api/admin/groups",
                 "profile_page": "/settings/profile",
                 "logout_page": "/account/logout",
@@ -535,7 +669,7 @@ def oauth_client_authorizations(cid):
         if client is None:
             return jsonify(msg='client not found'), 404
 
-        return jsonify([auth.to_dict() for auth in client.authorizations])
+        return jsonify([auth.to_dict() for auth in OAuthService.get_client_authorizations(client)])
     except OAuthServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
@@ -555,13 +689,19 @@ def oauth_client_allowed_groups(cid, gid):
             if group in client.allowed_groups:
                 return jsonify(msg='client already in the allowed group'), 400
             client.allowed_groups.append(group)
+            revoke_signed_tokens(client_id=client.id)
+            record_acl_change(client_id=client.id)
             db.session.commit()
+            invalidate_client_tokens(client.id)
             return "", 204
         else:  # DELETE
             if group not in client.allowed_groups:
                 return jsonify(msg='client not in the allowed group'), 400
             client.allowed_groups.remove(group)
+            revoke_signed_tokens(client_id=client.id)
+            record_acl_change(client_id=client.id)
             db.session.commit()
+            invalidate_client_tokens(client.id)
             return "", 204
     except (OAuthServiceError, GroupServiceError) as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
@@ -577,6 +717,22 @@ def lookup_ip_info(ip_addr):
         return jsonify(msg=str(e)), 400
 
 
+@admin.route('/cache-stats')
+@requires_admin
+def cache_stats():
+    return jsonify(oauth_token=get_token_cache_stats(), oauth_eligibility=get_eligibility_stats(),
+                   thumbnails=get_thumbnail_stats(), geoip=get_geo_stats())
+
+
+@admin.route('/mail-jobs/<int:job_id>')
+@requires_admin
+def mail_job_status(job_id):
+    job = db.session.get(MailJob, job_id)
+    if job is None:
+        return jsonify(msg='mail job not found'), 404
+    return jsonify(job=job.to_dict(), outstanding_chunks=[c.to_dict() for c in get_job_outstanding_chunks(job)])
+
+
 @admin.route('/send-email', methods=['POST'])
 @requires_admin
 def send_email_api():
@@ -630,10 +786,13 @@ def send_email_api():
             send_email(_user.name, _user.email,
                        template=None, subject=subject, body=body, sender=user,
                        site=app.config['SITE'])
-        else:  # use bcc list if there are multiple recipients
-            send_emails([], [], [(u.name, u.email) for u in to_users.values()],
-                        template=None, subject=subject, body=body, sender=user,
-                        site=app.config['SITE'])
+        else:  # broadcast in bcc chunks, delivered in the background; progress at /mail-jobs/<id>
+            job = enqueue_broadcast(user, [(u.name, u.email) for u in to_users.values()], subject, body)
+            db.session.commit()
+            if not is_mail_outbox_enabled():  # no mail worker to pick it up
+                deliver_job_in_background(job.id)
+            return jsonify(num_recipients=len(to_users), job=job.to_dict()), 202
+        db.session.commit()
         return jsonify(num_recipients=len(to_users))
     except (UserServiceError, GroupServiceError, OAuthServiceError) as e:
         return jsonify(msg=e.msg, detail=e.detail), 500
@@ -4,6 +4,7 @@ from models import db
 from services.oauth import OAuthService, OAuthServiceError
 from services.password_expiry import PasswordExpiryError
 from services.user import UserServiceError
+from utils.conditional import make_etag, not_modified, with_etag
 from utils.session import get_session_user, _password_expiry_error_response, _password_expiry_login_url
 from utils.url import url_append_param
 
@@ -17,7 +18,11 @@ def oauth_client(cid):
         if client is None:
             return jsonify(msg='client not found'), 404
 
-        return jsonify(client.to_dict())
+        etag = make_etag(client.id, client.modified_at)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        return with_etag(jsonify(client.to_dict()), etag)
     except OAuthServiceError as e:
         return jsonify(msg=e.msg, detail=e.detail), 400
 
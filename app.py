@@ -21,11 +21,14 @@ from services.oauth_bootstrap import (
     import_oauth_clients_from_file,
     parse_oauth_clients_file,
 )
+from services.oauth_eligibility import record_acl_change
 from services.user import UserService, UserServiceError
-from utils import upload
+from utils import mail_templates, upload
 from utils.external_auth import provider
-from utils.ip import get_geo_country
+from utils.ip import get_geo_country, init_geo_databases
+from utils.password_hashing import PasswordHashingBusyError
 from utils.request_client import get_client_ip
+from utils.thumbnail import init_thumbnail_cache
 
 
 class MyFlask(Flask):
@@ -144,11 +147,16 @@ def _load_config_with_env_overrides(config_path: str) -> dict[str, Any]:
         (('MAIL', 'display_name'), ('MAIL_DISPLAY_NAME',), str),
         (('MAIL', 'reply_to'), ('MAIL_REPLY_TO',), str),
         (('MAIL', 'reply_to_name'), ('MAIL_REPLY_TO_NAME',), str),
+        (('MAIL', 'outbox', 'enabled'), ('MAIL_OUTBOX_ENABLED',), _parse_bool),
         (('UPLOAD', 'root_folder'), ('UPLOAD_ROOT_FOLDER',), str),
         (('DEBUG',), ('FLASK_DEBUG',), _parse_bool),
         (('CAPTCHA', 'enabled'), ('CAPTCHA_ENABLED',), _parse_bool),
         (('CAPTCHA', 'service_url'), ('CAPTCHA_SERVICE_URL',), str),
         (('CAPTCHA', 'secret'), ('CAPTCHA_SECRET',), str),
+        (('LOGIN_THROTTLE', 'backend'), ('LOGIN_THROTTLE_BACKEND',), str),
+        (('LOGIN_THROTTLE', 'redis_url'), ('LOGIN_THROTTLE_REDIS_URL',), str),
+        (('OAUTH_AUTH_CODES', 'backend'), ('OAUTH_AUTH_CODES_BACKEND',), str),
+        (('OAUTH_AUTH_CODES', 'redis_url'), ('OAUTH_AUTH_CODES_REDIS_URL',), str),
     ]
     for config_path_keys, env_names, parser in override_specs:
         env_value = _get_env_override(env_names)
@@ -156,10 +164,23 @@ def _load_config_with_env_overrides(config_path: str) -> dict[str, Any]:
             continue
         _set_nested_config(config, config_path_keys, parser(env_value))
 
-    if _get_env_override(('MAIL_SMTP_HOST',)):
+    smtp_host = _get_env_override(('MAIL_SMTP_HOST',))
+    if smtp_host:
         mail_cfg = config.get('MAIL')
         if isinstance(mail_cfg, dict):
             mail_cfg.pop('mail_catcher', None)
+            # same settings and defaults as the msmtp config written by scripts/configure-msmtp.sh
+            tls = _parse_bool(_get_env_override(('MAIL_SMTP_TLS',)) or 'on')
+            starttls = tls and _parse_bool(_get_env_override(('MAIL_SMTP_STARTTLS',)) or 'on')
+            auth = _parse_bool(_get_env_override(('MAIL_SMTP_AUTH',)) or 'on')
+            mail_cfg['smtp'] = dict(
+                host=smtp_host,
+                port=int(_get_env_override(('MAIL_SMTP_PORT',)) or 587),
+                ssl=tls and not starttls,
+                starttls=starttls,
+                username=_get_env_override(('MAIL_SMTP_USER',)) if auth else None,
+                password=_get_env_override(('MAIL_SMTP_PASSWORD',)) if auth else None,
+            )
 
     return config
 
@@ -169,7 +190,10 @@ app.config.from_mapping(_load_config_with_env_overrides('config.json'))
 
 db.init_app(app)
 upload.init_app(app)
+mail_templates.init_app(app)
 provider.init_app(app)
+init_geo_databases(app)
+init_thumbnail_cache(app)
 
 app.register_blueprint(account, url_prefix='/api/account')
 app.register_blueprint(admin, url_prefix='/api/admin')
@@ -203,6 +227,18 @@ def page_not_found(error):
     return app.send_region_static_file(_STATIC_INDEX_HTML_PATH, region), 404
 
 
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify(msg='request too large', detail='The request body exceeds the size limit'), 413
+
+
+@app.errorhandler(PasswordHashingBusyError)
+def password_hashing_busy(error: PasswordHashingBusyError):
+    response = jsonify(msg=error.msg, detail=error.detail)
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+
 @app.cli.command()
 def create_db():
     """Apply Alembic migrations (alias for alembic upgrade head)."""
@@ -229,6 +265,8 @@ def init_db():
 
     if admin_group not in admin_user.groups:
         admin_user.groups.append(admin_group)
+        db.session.flush()
+        record_acl_change(user_id=admin_user.id)
 
     db.session.commit()
 
@@ -304,6 +342,252 @@ def migrate_password_expiry(dry_run: bool, force: bool) -> None:
     click.echo(f'Updated {updated} user(s), skipped {skipped}')
 
 
+@app.cli.command('benchmark-password-hashing')
+@click.option('--scheme', 'schemes', multiple=True,
+              help='Scheme to benchmark (repeatable). Defaults to every scheme in PASSWORD_HASHING.context.')
+@click.option('--rounds', type=int, default=None, help='Override the configured cost (rounds) of each scheme.')
+@click.option('--duration', type=float, default=2.0, show_default=True, help='Seconds to spend on each scheme.')
+def benchmark_password_hashing(schemes: tuple[str, ...], rounds: int | None, duration: float) -> None:
+    """Report single-core hashes/sec for the configured password hashing schemes."""
+    from utils.password_hashing import benchmark_password_scheme, get_password_schemes
+
+    available = get_password_schemes()
+    for scheme in schemes or available:
+        if scheme not in available:
+            raise click.ClickException(f'scheme {scheme!r} is not in PASSWORD_HASHING.context '
+                                       f'(available: {", ".join(available)})')
+        result = benchmark_password_scheme(scheme, duration, rounds)
+        click.echo(f'{scheme:<16} rounds={result["rounds"]!s:<8} {result["hashes_per_second"]:10.1f} hashes/sec '
+                   f'{result["ms_per_hash"]:9.2f} ms/hash')
+
+
+@app.cli.command('benchmark-mail-templates')
+@click.option('--template', 'templates', multiple=True,
+              help='Template to benchmark (repeatable). Defaults to confirm_email and password_expiry_warning.')
+@click.option('--count', type=int, default=10000, show_default=True, help='Renders per template.')
+def benchmark_mail_templates(templates: tuple[str, ...], count: int) -> None:
+    """Report renders/sec and complete messages/sec for mail templates."""
+    import time
+    from datetime import datetime, timedelta
+    from models import User
+    from utils.mail import build_email
+    from utils.mail_templates import get_mail_template
+    from utils.profile_validation import display_name
+
+    user = User(id=12345, name='benchmark', email='benchmark@example.com', email_confirm_token='t' * 32,
+                password_reset_token='t' * 32, two_factor_disable_token='t' * 32,
+                password_expires_at=datetime.utcnow() + timedelta(days=7))
+    values = dict(user=user, site=app.config['SITE'], user_display_name=display_name(user))
+    for name in templates or ('confirm_email', 'password_expiry_warning'):
+        template = get_mail_template(name)
+        started = time.perf_counter()
+        for _ in range(count):
+            template.subject.render(values)
+            template.text.render(values)
+            if template.html is not None:
+                template.html.render(values)
+        render_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in range(count):
+            build_email([(user.name, user.email)], [], [], name, user=user, site=app.config['SITE'])
+        build_seconds = time.perf_counter() - started
+        click.echo(f'{name:<24} html={"yes" if template.html is not None else "no ":<4} '
+                   f'{count / render_seconds:10.0f} renders/sec {count / build_seconds:8.0f} messages/sec')
+
+
+@app.cli.command('benchmark-whoami')
+@click.option('--user-id', type=int, required=True, help='Existing user to resolve from the session cookie.')
+@click.option('--requests', 'count', type=int, default=2000, show_default=True, help='Requests per mode.')
+def benchmark_whoami(user_id: int, count: int) -> None:
+    """Report /api/account/whoami req/s for the ORM load + commit session path and the read-only one."""
+    import time
+    from flask import session
+    from utils.session import get_session_user, user_to_dict_with_password_expiry
+
+    def orm_and_commit() -> None:  # what /whoami did before: full User load, then an unconditional commit
+        user = get_session_user()
+        db.session.commit()
+        jsonify(user_to_dict_with_password_expiry(user, include_intercept=True))
+
+    def read_only() -> None:
+        user = get_session_user(read_only=True)
+        jsonify(user_to_dict_with_password_expiry(user, include_intercept=True))
+
+    for name, handler in (('orm+commit', orm_and_commit), ('read-only', read_only)):
+        started = time.perf_counter()
+        for _ in range(count):
+            with app.test_request_context('/api/account/whoami'):
+                session['user_id'] = user_id
+                handler()
+        click.echo(f'{name:<12} {count / (time.perf_counter() - started):10.0f} req/s')
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    started = time.perf_counter()
+    for _ in range(count):
+        if client.get('/api/account/whoami').status_code != 200:
+            raise click.ClickException(f'/whoami did not return user {user_id}')
+    click.echo(f'{"endpoint":<12} {count / (time.perf_counter() - started):10.0f} req/s (full request through the app)')
+
+
+@app.cli.command('benchmark-oauth-handshake')
+@click.option('--user-id', type=int, required=True, help='Existing user who may authorize the client.')
+@click.option('--client-id', type=int, required=True, help='Existing OAuth client.')
+@click.option('--count', type=int, default=500, show_default=True, help='Handshakes to run.')
+def benchmark_oauth_handshake(user_id: int, client_id: int, count: int) -> None:
+    """Run /api/oauth/connect + /api/oauth/token handshakes; report handshakes/sec and SQL statements per step."""
+    import time
+    from sqlalchemy import event
+    from models import OAuthClient
+
+    client_row = db.session.get(OAuthClient, client_id)
+    if client_row is None:
+        raise click.ClickException(f'client {client_id} not found')
+    redirect_url, secret = client_row.redirect_url, client_row.secret
+    db.session.remove()
+
+    statements = {'connect': 0, 'token': 0}
+    step = ['connect']
+
+    def count_statement(*_args) -> None:
+        statements[step[0]] += 1
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    try:
+        started = time.perf_counter()
+        for _ in range(count):
+            step[0] = 'connect'
+            resp = client.get('/api/oauth/connect', query_string={'client_id': client_id, 'redirect_url': redirect_url})
+            if resp.status_code != 200:
+                raise click.ClickException(f'/api/oauth/connect returned {resp.status_code}: {resp.get_data(True)}')
+            step[0] = 'token'
+            resp = client.post('/api/oauth/token', data={'client_id': client_id, 'client_secret': secret,
+                                                         'redirect_url': redirect_url, 'code': resp.json['token']})
+            if resp.status_code != 200:
+                raise click.ClickException(f'/api/oauth/token returned {resp.status_code}: {resp.get_data(True)}')
+        elapsed = time.perf_counter() - started
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    click.echo(f'{count / elapsed:10.1f} handshakes/sec  SQL statements per handshake: '
+               f'connect {statements["connect"] / count:.1f}, token {statements["token"] / count:.1f}')
+
+
+@app.cli.command('benchmark-user-search')
+@click.option('--users', type=int, default=100000, show_default=True,
+              help='Synthetic users to search (added to the configured database as *@search-bench.invalid).')
+@click.option('--queries', type=int, default=200, show_default=True, help='Searches per term kind and query.')
+@click.option('--keep', is_flag=True, help='Keep the synthetic users for the next run.')
+def benchmark_user_search(users: int, queries: int, keep: bool) -> None:
+    """Report admin autocomplete latency of UserService.search_by_name against the old unindexed LIKE query."""
+    import random
+    import time
+    from sqlalchemy import func, or_
+    from models import User
+
+    email_suffix = '@search-bench.invalid'
+    words = ['ann', 'bob', 'carl', 'dora', 'eve', 'finn', 'gus', 'hana', 'ivan', 'jo', 'kim', 'lena', 'max', 'nina']
+    rng = random.Random(42)
+    existing = User.query.filter(User.email.like('%' + email_suffix)).count()
+    rows = [dict(name='sb%07d' % i, email='sb%07d%s' % (i, email_suffix), password='x',
+                 nickname='%s%s%d' % (rng.choice(words), rng.choice(words), i),
+                 real_name='%s %s' % (rng.choice(words).title(), rng.choice(words).title()))
+            for i in range(existing, users)]
+    for start in range(0, len(rows), 5000):
+        db.session.execute(db.insert(User.__table__), rows[start:start + 5000])
+    db.session.commit()
+    click.echo(f'{max(users, existing)} synthetic users ({len(rows)} added), dialect {db.engine.dialect.name}')
+
+    def legacy(term: str) -> list:  # the search before 0010_text_search_indexes
+        term = term.lower()
+        return User.query.filter(or_(func.lower(User.name).contains(term), func.lower(User.nickname).contains(term),
+                                     func.lower(User.real_name).contains(term))).limit(5).all()
+
+    kinds = {
+        '1-char': lambda: rng.choice(words)[:1],
+        '2-char': lambda: rng.choice(words)[:2],
+        'substring': lambda: rng.choice(words) + rng.choice(words)[:2],
+        'exact name': lambda: 'sb%07d' % rng.randrange(users),
+    }
+    try:
+        for kind, make_term in kinds.items():
+            terms = [make_term() for _ in range(queries)]
+            timings = []
+            for search in (legacy, lambda term: UserService.search_by_name(term, 5)):
+                started = time.perf_counter()
+                for term in terms:
+                    search(term)
+                    db.session.expunge_all()
+                timings.append((time.perf_counter() - started) * 1000 / queries)
+            click.echo(f'{kind:<12} legacy {timings[0]:8.2f} ms/query  indexed {timings[1]:8.2f} ms/query')
+    finally:
+        if not keep:
+            db.session.query(User).filter(User.email.like('%' + email_suffix)).delete(synchronize_session=False)
+            db.session.commit()
+
+
+@app.cli.command('send-password-expiry-warnings')
+@click.option('--page-size', type=int, default=200, show_default=True, help='Users loaded and sent per batch.')
+@click.option('--dry-run', is_flag=True, help='Only count the users who are due a warning.')
+@click.option('--interval', type=float, default=None,
+              help='Keep running and repeat every INTERVAL seconds (for a long-running container).')
+def send_password_expiry_warnings_cmd(page_size: int, dry_run: bool, interval: float | None) -> None:
+    """Email the one-week password expiry warning to users who are due one (run periodically, e.g. hourly)."""
+    import time
+    from services.password_expiry import send_password_expiry_warnings
+
+    while True:
+        count = send_password_expiry_warnings(page_size, dry_run)
+        click.echo(f'{"Due" if dry_run else "Sent"}: {count} password expiry warning(s)')
+        if interval is None:
+            return
+        db.session.remove()
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            return
+
+
+@app.cli.command('sweep-uploads')
+@click.option('--interval', type=float, default=None,
+              help='Keep running and repeat every INTERVAL seconds (for a long-running container).')
+def sweep_uploads_cmd(interval: float | None) -> None:
+    """Delete uploaded avatars and icons that nothing refers to any more (run periodically, e.g. hourly)."""
+    import time
+    from utils.upload import sweep_uploads
+
+    while True:
+        click.echo(f'Deleted: {sweep_uploads()} unreferenced upload(s)')
+        if interval is None:
+            return
+        db.session.remove()
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            return
+
+
+@app.cli.command('mail-worker')
+@click.option('--once', is_flag=True, help='Deliver everything that is due, then exit.')
+@click.option('--batch-size', type=int, default=None, help='Messages per batch (default: MAIL.outbox.batch_size).')
+@click.option('--poll-interval', type=float, default=None,
+              help='Seconds to wait when the outbox is empty (default: MAIL.outbox.poll_interval_seconds).')
+def mail_worker(once: bool, batch_size: int | None, poll_interval: float | None) -> None:
+    """Deliver queued outbound email from the mail outbox."""
+    import logging
+    from services.mail_outbox import run_mail_worker
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        run_mail_worker(batch_size, poll_interval, once)
+    except KeyboardInterrupt:
+        pass
+
+
 @app.cli.command('import-oauth-clients')
 @click.argument('path', type=click.Path(exists=True, dir_okay=False))
 def import_oauth_clients_cmd(path: str) -> None:
@@ -55,13 +55,21 @@ function mergeAdminUserList(envelope: z.infer<typeof AdminUserListEnvelopeSchema
 }
 
 export async function fetchAdminUserList(): Promise<AdminUser[]> {
-  const res = await apiClient.get<unknown>('/api/admin/users')
-  const parsed = AdminUserListEnvelopeSchema.safeParse(res.data)
-  if (!parsed.success) {
-    console.error('admin user list parse error', parsed.error.flatten())
-    throw new Error('Invalid admin user list payload from server')
-  }
-  return mergeAdminUserList(parsed.data)
+  const users: AdminUser[] = []
+  let cursor: number | null | undefined = undefined
+  do {
+    const res = await apiClient.get<unknown>('/api/admin/users', {
+      params: cursor !== undefined ? { cursor } : {},
+    })
+    const parsed = AdminUserListEnvelopeSchema.safeParse(res.data)
+    if (!parsed.success) {
+      console.error('admin user list parse error', parsed.error.flatten())
+      throw new Error('Invalid admin user list payload from server')
+    }
+    users.push(...mergeAdminUserList(parsed.data))
+    cursor = parsed.data.next_cursor
+  } while (cursor !== null && cursor !== undefined)
+  return users
 }
 
 export async function searchAdminUsersByName(name: string, limit?: number): Promise<AdminUser[]> {
@@ -85,6 +85,7 @@ export const AdminUserListEnvelopeSchema = z.object({
       modified_at: z.string(),
     }),
   ),
+  next_cursor: z.number().nullable().optional(),
 })
 
 export type AdminUserListEnvelope = z.infer<typeof AdminUserListEnvelopeSchema>
@@ -1,6 +1,7 @@
 from datetime import datetime
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 
 db = SQLAlchemy()
 
@@ -14,7 +15,27 @@ client_allowed_groups = db.Table('o_auth_client_allowed_groups',
                                  db.Column('group_id', db.Integer, db.ForeignKey('group.id'), primary_key=True))
 
 
+def _text_search_indexes(table: str, *columns: str) -> tuple:
+    """Indexes behind utils.text_search: pg_trgm GIN and a C-collated btree on lower(column) on Postgres, NOCASE on
+    SQLite."""
+    indexes = []
+    for column in columns:
+        indexes.append(db.Index('ix_%s_%s_trgm' % (table, column), db.text('lower(%s) gin_trgm_ops' % column),
+                                postgresql_using='gin').ddl_if(dialect='postgresql'))
+        indexes.append(db.Index('ix_%s_%s_lower' % (table, column), db.text('lower(%s) COLLATE "C"' % column))
+                       .ddl_if(dialect='postgresql'))
+        indexes.append(db.Index('ix_%s_%s_nocase' % (table, column), db.text('%s COLLATE NOCASE' % column))
+                       .ddl_if(dialect='sqlite'))
+    return tuple(indexes)
+
+
 class User(db.Model):
+    __table_args__ = (
+        db.Index('ix_user_password_expiry_warning', 'password_expiry_warning_email_sent_at', 'password_expires_at'),
+        db.Index('ix_user_avatar', 'avatar'),  # references to shared avatar files, see utils.upload
+        *_text_search_indexes('user', 'name', 'nickname', 'real_name'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(16), unique=True, nullable=False)
     password = db.Column(db.String(128), nullable=False)
@@ -50,7 +71,7 @@ class User(db.Model):
     password_expiry_warning_email_sent_at = db.Column(db.DateTime)
 
     login_records = db.relationship('LoginRecord', backref=db.backref('user'), cascade="all, delete-orphan")
-    authorizations = db.relationship('OAuthAuthorization', backref=db.backref('user', lazy=False),
+    authorizations = db.relationship('OAuthAuthorization', backref=db.backref('user'),
                                      cascade="all, delete-orphan")
     password_history = db.relationship(
         'UserPasswordHistory',
@@ -90,6 +111,11 @@ class User(db.Model):
         return '<User %r>' % self.name
 
 
+# the trigram indexes need pg_trgm; migration 0010 creates it the same way
+event.listen(User.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
 class UserPasswordHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
@@ -101,6 +127,8 @@ class UserPasswordHistory(db.Model):
 
 
 class Group(db.Model):
+    __table_args__ = _text_search_indexes('group', 'name', 'description')
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(24), unique=True, nullable=False)
     description = db.Column(db.String(256))
@@ -108,7 +136,7 @@ class Group(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    users = db.relationship('User', secondary=user_groups, backref=db.backref('groups', lazy=False))
+    users = db.relationship('User', secondary=user_groups, backref=db.backref('groups'))
 
     def to_dict(self, with_users=False, with_user_ids=False, with_allowed_clients=False, with_advanced_fields=False):
         _dict = dict(id=self.id, name=self.name, description=self.description)
@@ -131,6 +159,11 @@ class Group(db.Model):
 
 
 class LoginRecord(db.Model):
+    __table_args__ = (
+        db.Index('ix_login_record_user_id_time', 'user_id', 'time'),
+        db.Index('ix_login_record_ip_time', 'ip', 'time'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -165,8 +198,7 @@ class OAuthClient(db.Model):
     modified_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     authorizations = db.relationship('OAuthAuthorization', backref=db.backref('client'), cascade="all, delete-orphan")
-    allowed_groups = db.relationship('Group', secondary=client_allowed_groups, lazy=False,
-                                     backref=db.backref('allowed_clients'))
+    allowed_groups = db.relationship('Group', secondary=client_allowed_groups, backref=db.backref('allowed_clients'))
 
     def to_dict(self, with_advanced_fields=False):
         _dict = dict(id=self.id, name=self.name, is_public=self.is_public, home_url=self.home_url,
@@ -210,3 +242,81 @@ class OAuthAuthorization(db.Model):
 
     def __repr__(self):
         return '<OAuthAuthorization %r,%r>' % (self.client_id, self.user_id)
+
+
+class OAuthTokenRevocation(db.Model):
+    """Signed access tokens of ``user_id``, of ``client_id``, or (with neither) all of them issued before
+    ``revoked_at`` are revoked. Rows older than the signed token lifetime are pruned."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer)
+    client_id = db.Column(db.Integer)
+    revoked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<OAuthTokenRevocation %r>' % self.id
+
+
+class OAuthAclChange(db.Model):
+    """The groups of ``user_id``, the allowed groups or visibility of ``client_id``, or (with neither) any OAuth
+    eligibility input changed. The latest id is the version every worker's eligibility index syncs to."""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer)
+    client_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<OAuthAclChange %r>' % self.id
+
+
+class MailJob(db.Model):
+    """A broadcast email split into several outbox messages (chunks) of up to MAIL.broadcast.batch_size recipients."""
+    id = db.Column(db.Integer, primary_key=True)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    subject = db.Column(db.String(256), nullable=False)
+    num_recipients = db.Column(db.Integer, nullable=False)
+    num_chunks = db.Column(db.Integer, nullable=False)
+    sent_chunks = db.Column(db.Integer, nullable=False, default=0)
+    failed_chunks = db.Column(db.Integer, nullable=False, default=0)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    @property
+    def status(self) -> str:
+        if self.sent_chunks + self.failed_chunks < self.num_chunks:
+            return 'running'
+        return 'failed' if self.failed_chunks else 'done'
+
+    def to_dict(self):
+        return dict(id=self.id, sender_id=self.sender_id, subject=self.subject, status=self.status,
+                    num_recipients=self.num_recipients, num_chunks=self.num_chunks, sent_chunks=self.sent_chunks,
+                    failed_chunks=self.failed_chunks, created_at=self.created_at, finished_at=self.finished_at)
+
+    def __repr__(self):
+        return '<MailJob %r>' % self.id
+
+
+class MailOutbox(db.Model):
+    __table_args__ = (
+        db.Index('ix_mail_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+        db.Index('ix_mail_outbox_job_id', 'job_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('mail_job.id', ondelete='CASCADE'))
+    num_recipients = db.Column(db.Integer, nullable=False, default=1)
+    message = db.Column(db.LargeBinary, nullable=False)  # RFC 5322 bytes, including any Bcc header
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending | failed (sent rows are deleted)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.String(512))
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return dict(id=self.id, job_id=self.job_id, num_recipients=self.num_recipients, status=self.status,
+                    attempts=self.attempts, next_attempt_at=self.next_attempt_at, last_error=self.last_error,
+                    created_at=self.created_at)
+
+    def __repr__(self):
+        return '<MailOutbox %r>' % self.id
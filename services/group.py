@@ -1,9 +1,10 @@
 import re
 
-from sqlalchemy import or_, func
+from sqlalchemy import func
 
 from error import BasicError
 from models import db, Group
+from utils.text_search import ranked_search
 
 
 class GroupServiceError(BasicError):
@@ -49,14 +50,9 @@ class GroupService:
         if len(name) == 0:
             raise GroupServiceError('name must not be empty')
 
-        name_lower = name.lower()
-        _filter = or_(func.lower(Group.name).contains(name_lower), func.lower(Group.description).contains(name_lower))
-        if limit is None:
-            return Group.query.filter(_filter).all()
-        else:
-            if type(limit) is not int:
-                raise GroupServiceError('limit must be an integer')
-            return Group.query.filter(_filter).limit(limit)
+        if limit is not None and type(limit) is not int:
+            raise GroupServiceError('limit must be an integer')
+        return ranked_search(Group.query, [Group.name, Group.description], name, limit, Group.name)
 
     @staticmethod
     def add(name, description):
@@ -1,6 +1,6 @@
 from datetime import timedelta, datetime
 
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 
 from error import BasicError
 from models import db, LoginRecord, User
@@ -37,32 +37,31 @@ class LoginRecordService:
         db.session.add(record)
         return record
 
+    @staticmethod
+    def _count_consecutive_failures(match, time_span: timedelta) -> int:
+        """Count failed logins matching ``match`` after the latest success within ``time_span``.
+
+        Runs as a single aggregate query served by the (user_id, time) / (ip, time) indexes.
+        """
+        since = datetime.utcnow() - time_span
+        last_success_id = db.session.query(func.max(LoginRecord.id)) \
+            .filter(match, LoginRecord.time >= since, LoginRecord.success.is_(True)) \
+            .scalar_subquery()
+        return db.session.query(func.count(LoginRecord.id)) \
+            .filter(match, LoginRecord.time >= since, LoginRecord.success.is_(False),
+                    LoginRecord.id > func.coalesce(last_success_id, 0)) \
+            .scalar()
+
     @staticmethod
     def count_recent_failures_for_user(user: User, time_span: timedelta) -> int:
         if user is None:
             raise LoginRecordServiceError('user is required')
 
-        failures = 0
-        for record in db.session.query(LoginRecord) \
-                .filter(LoginRecord.user_id == user.id,
-                        LoginRecord.time >= datetime.utcnow() - time_span) \
-                .order_by(desc(LoginRecord.id)):
-            if record.success:  # only count the latest consecutive failures
-                break
-            failures += 1
-        return failures
+        return LoginRecordService._count_consecutive_failures(LoginRecord.user_id == user.id, time_span)
 
     @staticmethod
     def count_recent_failures_for_ip(ip: str, time_span: timedelta) -> int:
         if ip is None:
             raise LoginRecordServiceError('ip is required')
 
-        failures = 0
-        for record in db.session.query(LoginRecord) \
-                .filter(LoginRecord.ip == ip,
-                        LoginRecord.time >= datetime.utcnow() - time_span) \
-                .order_by(desc(LoginRecord.id)):
-            if record.success:  # only count the latest consecutive failures
-                break
-            failures += 1
-        return failures
+        return LoginRecordService._count_consecutive_failures(LoginRecord.ip == ip, time_span)
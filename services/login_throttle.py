@@ -0,0 +1,218 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import timedelta
+from secrets import token_hex
+from typing import Any
+
+from flask import current_app as app
+
+from models import User
+from services.login_record import LoginRecordService
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_KEY_PREFIX = 'auth:login-throttle:'
+_DEFAULT_MEMORY_MAX_KEYS = 100000
+
+_throttle: 'LoginThrottle | None' = None
+
+
+class LoginThrottle:
+    """Counts consecutive failed logins per user and per client IP within a sliding window.
+
+    A successful login resets both counters, matching the "failures since last success" rule of the login_record
+    audit trail.
+    """
+
+    def __init__(self, window: timedelta):
+        self.window = window
+
+    def record_attempt(self, user: User, ip: str | None, success: bool) -> None:
+        raise NotImplementedError()
+
+    def count_user_failures(self, user: User) -> int:
+        raise NotImplementedError()
+
+    def count_ip_failures(self, ip: str) -> int:
+        raise NotImplementedError()
+
+
+class DatabaseLoginThrottle(LoginThrottle):
+    """Derive counts from the login_record table (no shared store required)."""
+
+    def record_attempt(self, user: User, ip: str | None, success: bool) -> None:
+        pass  # the login_record row written by UserService is the source of truth
+
+    def count_user_failures(self, user: User) -> int:
+        return LoginRecordService.count_recent_failures_for_user(user, self.window)
+
+    def count_ip_failures(self, ip: str) -> int:
+        return LoginRecordService.count_recent_failures_for_ip(ip, self.window)
+
+
+class _KeyedLoginThrottle(LoginThrottle):
+    def record_attempt(self, user: User, ip: str | None, success: bool) -> None:
+        keys = [self._user_key(user)]
+        if ip:
+            keys.append(self._ip_key(ip))
+        for key in keys:
+            if success:
+                self._reset(key)
+            else:
+                self._add_failure(key)
+
+    def count_user_failures(self, user: User) -> int:
+        return self._count(self._user_key(user))
+
+    def count_ip_failures(self, ip: str) -> int:
+        return self._count(self._ip_key(ip))
+
+    @staticmethod
+    def _user_key(user: User) -> str:
+        return 'user:%d' % user.id
+
+    @staticmethod
+    def _ip_key(ip: str) -> str:
+        return 'ip:%s' % ip
+
+    def _add_failure(self, key: str) -> None:
+        raise NotImplementedError()
+
+    def _reset(self, key: str) -> None:
+        raise NotImplementedError()
+
+    def _count(self, key: str) -> int:
+        raise NotImplementedError()
+
+
+class MemoryLoginThrottle(_KeyedLoginThrottle):
+    """Process-local sliding window. Only suitable for a single worker or tests."""
+
+    def __init__(self, window: timedelta, max_keys: int = _DEFAULT_MEMORY_MAX_KEYS):
+        super().__init__(window)
+        self.max_keys = max_keys
+        self._failures: OrderedDict[str, deque[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _prune(self, key: str, now: float) -> deque[float] | None:
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        horizon = now - self.window.total_seconds()
+        while failures and failures[0] < horizon:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+    def _add_failure(self, key: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            failures = self._prune(key, now)
+            if failures is None:
+                failures = self._failures[key] = deque()
+            failures.append(now)
+            self._failures.move_to_end(key)
+            while len(self._failures) > self.max_keys:
+                self._failures.popitem(last=False)
+
+    def _reset(self, key: str) -> None:
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def _count(self, key: str) -> int:
+        with self._lock:
+            failures = self._prune(key, time.monotonic())
+            return len(failures) if failures is not None else 0
+
+
+class RedisLoginThrottle(_KeyedLoginThrottle):
+    """Sliding window on Redis sorted sets, shared by every worker.
+
+    If Redis is unreachable, counts fall back to the login_record table so lockouts keep working.
+    """
+
+    def __init__(self, window: timedelta, redis_url: str, key_prefix: str = _DEFAULT_KEY_PREFIX):
+        super().__init__(window)
+        import redis  # optional dependency, only needed for this backend
+        self._redis_error = redis.RedisError
+        self._redis = redis.Redis.from_url(redis_url)
+        self.key_prefix = key_prefix
+        self._fallback = DatabaseLoginThrottle(window)
+
+    def _redis_key(self, key: str) -> str:
+        return self.key_prefix + key
+
+    def _add_failure(self, key: str) -> None:
+        now = time.time()
+        window_seconds = self.window.total_seconds()
+        redis_key = self._redis_key(key)
+        try:
+            pipe = self._redis.pipeline()
+            pipe.zadd(redis_key, {'%f:%s' % (now, token_hex(4)): now})
+            pipe.zremrangebyscore(redis_key, '-inf', now - window_seconds)
+            pipe.expire(redis_key, math.ceil(window_seconds))
+            pipe.execute()
+        except self._redis_error as e:
+            logger.warning('Login throttle: failed to record failure in Redis: %s', e)
+
+    def _reset(self, key: str) -> None:
+        try:
+            self._redis.delete(self._redis_key(key))
+        except self._redis_error as e:
+            logger.warning('Login throttle: failed to reset counter in Redis: %s', e)
+
+    def _count(self, key: str) -> int:
+        return self._redis.zcount(self._redis_key(key), time.time() - self.window.total_seconds(), '+inf')
+
+    def count_user_failures(self, user: User) -> int:
+        try:
+            return super().count_user_failures(user)
+        except self._redis_error as e:
+            logger.warning('Login throttle: Redis unavailable, counting from login records: %s', e)
+            return self._fallback.count_user_failures(user)
+
+    def count_ip_failures(self, ip: str) -> int:
+        try:
+            return super().count_ip_failures(ip)
+        except self._redis_error as e:
+            logger.warning('Login throttle: Redis unavailable, counting from login records: %s', e)
+            return self._fallback.count_ip_failures(ip)
+
+
+def _throttle_config() -> dict[str, Any]:
+    cfg = app.config.get('LOGIN_THROTTLE')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def _create_login_throttle(window: timedelta) -> LoginThrottle:
+    cfg = _throttle_config()
+    backend = cfg.get('backend') or 'database'
+    if backend == 'database':
+        return DatabaseLoginThrottle(window)
+    if backend == 'memory':
+        return MemoryLoginThrottle(window, int(cfg.get('max_keys', _DEFAULT_MEMORY_MAX_KEYS)))
+    if backend == 'redis':
+        redis_url = cfg.get('redis_url')
+        if not redis_url:
+            raise ValueError('LOGIN_THROTTLE.redis_url is required for the redis backend')
+        return RedisLoginThrottle(window, redis_url, cfg.get('key_prefix') or _DEFAULT_KEY_PREFIX)
+    raise ValueError('Unsupported login throttle backend: %s' % backend)
+
+
+def get_login_throttle() -> LoginThrottle:
+    global _throttle
+    if _throttle is None:
+        from services.user import UserService
+        _throttle = _create_login_throttle(UserService.login_recent_failures_time_span)
+    return _throttle
+
+
+def reset_login_throttle() -> None:
+    """Drop the throttle instance so the next use re-reads LOGIN_THROTTLE (mainly for tests)."""
+    global _throttle
+    _throttle = None
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from email import message_from_bytes, policy
+from email.message import EmailMessage
+from typing import Any
+
+from flask import current_app as app
+
+from models import MailJob, MailOutbox, User, db
+from utils.mail import MailTransport, build_email
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_BATCH_SIZE = 50
+_DEFAULT_POLL_INTERVAL_SECONDS = 5
+_DEFAULT_MAX_ATTEMPTS = 8
+_DEFAULT_RETRY_BASE_SECONDS = 30
+_DEFAULT_RETRY_MAX_SECONDS = 3600
+_DEFAULT_BROADCAST_BATCH_SIZE = 100
+
+
+def _outbox_config() -> dict[str, Any]:
+    cfg = (app.config.get('MAIL') or {}).get('outbox')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def enqueue_email(msg: EmailMessage, job_id: int | None = None, num_recipients: int = 1) -> MailOutbox:
+    """Add a message to the outbox in the current transaction; it is delivered once the caller commits."""
+    entry = MailOutbox(message=msg.as_bytes(), job_id=job_id, num_recipients=num_recipients, status='pending',
+                       attempts=0, next_attempt_at=datetime.utcnow())
+    db.session.add(entry)
+    return entry
+
+
+def enqueue_broadcast(sender: User, recipients: list[tuple[str, str]], subject: str, body: str) -> MailJob:
+    """Queue a personal email to many recipients as a job of Bcc chunks of MAIL.broadcast.batch_size each.
+
+    Each chunk is a separate outbox message, so a relay's per-message recipient limit is respected and a failed
+    chunk is retried on its own. Progress is tracked on the returned MailJob.
+    """
+    cfg = (app.config.get('MAIL') or {}).get('broadcast') or {}
+    batch_size = max(1, int(cfg.get('batch_size', _DEFAULT_BROADCAST_BATCH_SIZE)))
+    chunks = [recipients[i:i + batch_size] for i in range(0, len(recipients), batch_size)]
+    job = MailJob(sender_id=sender.id, subject=subject[:256], num_recipients=len(recipients), num_chunks=len(chunks),
+                  sent_chunks=0, failed_chunks=0)
+    db.session.add(job)
+    db.session.flush()
+    for chunk in chunks:
+        msg = build_email([], [], chunk, None, subject=subject, body=body, sender=sender, site=app.config['SITE'])
+        enqueue_email(msg, job.id, len(chunk))
+    return job
+
+
+def get_job_outstanding_chunks(job: MailJob) -> list[MailOutbox]:
+    """Chunks of a job that are not delivered yet: pending (possibly after failed attempts) or given up."""
+    return MailOutbox.query.filter_by(job_id=job.id).order_by(MailOutbox.id).all()
+
+
+def _record_job_chunk(job_id: int, delivered: bool) -> None:
+    counter = MailJob.sent_chunks if delivered else MailJob.failed_chunks
+    MailJob.query.filter_by(id=job_id).update({counter: counter + 1}, synchronize_session=False)
+    MailJob.query.filter(MailJob.id == job_id, MailJob.finished_at.is_(None),
+                         MailJob.sent_chunks + MailJob.failed_chunks >= MailJob.num_chunks) \
+        .update({MailJob.finished_at: datetime.utcnow()}, synchronize_session=False)
+
+
+def get_retry_delay(attempts: int) -> timedelta:
+    """Exponential backoff after the given number of failed attempts."""
+    cfg = _outbox_config()
+    base = float(cfg.get('retry_base_seconds', _DEFAULT_RETRY_BASE_SECONDS))
+    cap = float(cfg.get('retry_max_seconds', _DEFAULT_RETRY_MAX_SECONDS))
+    return timedelta(seconds=min(cap, base * 2 ** max(0, attempts - 1)))
+
+
+def deliver_outbox_batch(transport: MailTransport, batch_size: int | None = None,
+                         job_id: int | None = None) -> tuple[int, int]:
+    """Deliver up to ``batch_size`` due messages (of one job, if ``job_id`` is given) over ``transport``.
+
+    Returns (sent, failed).
+
+    Claimed rows are locked with SKIP LOCKED (on databases that support it), so several workers can run side by
+    side. Sent messages are deleted; failures are retried with backoff until MAIL.outbox.max_attempts, after which
+    they stay in the table with status 'failed'.
+    """
+    cfg = _outbox_config()
+    if batch_size is None:
+        batch_size = int(cfg.get('batch_size', _DEFAULT_BATCH_SIZE))
+    max_attempts = int(cfg.get('max_attempts', _DEFAULT_MAX_ATTEMPTS))
+
+    query = MailOutbox.query.filter(MailOutbox.status == 'pending', MailOutbox.next_attempt_at <= datetime.utcnow())
+    if job_id is not None:
+        query = query.filter(MailOutbox.job_id == job_id)
+    entries = query \
+        .order_by(MailOutbox.next_attempt_at, MailOutbox.id) \
+        .limit(batch_size) \
+        .with_for_update(skip_locked=True) \
+        .all()
+
+    sent = failed = 0
+    for entry in entries:
+        try:
+            transport.send(message_from_bytes(entry.message, policy=policy.default))
+        except Exception as e:
+            failed += 1
+            entry.attempts += 1
+            entry.last_error = ('%s: %s' % (type(e).__name__, e))[:512]
+            if entry.attempts >= max_attempts:
+                entry.status = 'failed'
+                if entry.job_id is not None:
+                    _record_job_chunk(entry.job_id, False)
+                logger.error('Mail outbox: giving up on message %d after %d attempts: %s',
+                             entry.id, entry.attempts, entry.last_error)
+            else:
+                entry.next_attempt_at = datetime.utcnow() + get_retry_delay(entry.attempts)
+                logger.warning('Mail outbox: attempt %d for message %d failed: %s',
+                               entry.attempts, entry.id, entry.last_error)
+            transport.close()  # do not reuse a session that may be in a bad state
+        else:
+            sent += 1
+            if entry.job_id is not None:
+                _record_job_chunk(entry.job_id, True)
+            db.session.delete(entry)
+    db.session.commit()
+    return sent, failed
+
+
+def run_mail_worker(batch_size: int | None = None, poll_interval: float | None = None, once: bool = False,
+                    job_id: int | None = None) -> None:
+    """Deliver the outbox until interrupted (or until it is drained, with ``once``).
+
+    With ``job_id``, only that job's chunks are delivered, and the worker stops once none of them is pending.
+    One transport, and so one SMTP session, is kept open while there is work.
+    """
+    if poll_interval is None:
+        poll_interval = float(_outbox_config().get('poll_interval_seconds', _DEFAULT_POLL_INTERVAL_SECONDS))
+    transport = MailTransport(app.config['MAIL'])
+    try:
+        while True:
+            sent, failed = deliver_outbox_batch(transport, batch_size, job_id)
+            if sent or failed:
+                logger.info('Mail outbox: sent %d, failed %d', sent, failed)
+                continue
+            if once:
+                return
+            if job_id is not None and not MailOutbox.query.filter_by(job_id=job_id, status='pending').count():
+                return
+            transport.close()  # do not hold an idle SMTP session open between polls
+            time.sleep(poll_interval)
+    finally:
+        transport.close()
+
+
+def deliver_job_in_background(job_id: int) -> threading.Thread:
+    """Deliver a committed job from a daemon thread of this process.
+
+    Only for setups without ``flask mail-worker`` (MAIL.outbox disabled): chunks still pending when the process
+    exits stay in the outbox until a worker runs.
+    """
+    flask_app = app._get_current_object()
+
+    def run() -> None:
+        with flask_app.app_context():
+            try:
+                run_mail_worker(job_id=job_id)
+            except Exception:
+                logger.exception('Mail outbox: delivery of job %d stopped', job_id)
+
+    thread = threading.Thread(target=run, name='mail-job-%d' % job_id, daemon=True)
+    thread.start()
+    return thread
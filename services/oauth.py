@@ -1,14 +1,36 @@
 import re
-from datetime import datetime, timedelta
 from secrets import token_urlsafe
 from typing import Optional
 
-from sqlalchemy import func
-from sqlalchemy.orm import joinedload
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 
 from error import BasicError
-from models import OAuthClient, db, OAuthAuthorization, User, client_allowed_groups, user_groups
-from services.password_expiry import PasswordExpiryError, check_password_expiry_for_oauth
+from models import OAuthClient, db, OAuthAuthorization, User
+from services.oauth_auth_code import AuthCodeError, get_auth_code_store
+from services.oauth_eligibility import get_eligibility_index, record_acl_change
+from services.oauth_signed_token import (
+    SignedTokenError,
+    is_signed_token_enabled,
+    issue_signed_token,
+    looks_like_signed_token,
+    revoke_signed_tokens,
+    verify_signed_token,
+)
+from services.oauth_token_cache import (
+    VerifiedAccessToken,
+    get_verified_token,
+    invalidate_token,
+    invalidate_user_tokens,
+    put_verified_token,
+)
+from services.password_expiry import (
+    PasswordExpiryError,
+    PasswordExpiryStatus,
+    check_password_expiry_for_oauth,
+    get_password_expiry_status,
+    get_password_expiry_status_valid_until,
+)
 
 
 class OAuthServiceError(BasicError):
@@ -43,24 +65,26 @@ class OAuthService:
 
     @staticmethod
     def get_all_clients():
-        return OAuthClient.query.all()
+        return OAuthClient.query.options(selectinload(OAuthClient.allowed_groups)).all()
+
+    @staticmethod
+    def get_client_authorizations(client):
+        """Authorizations of ``client`` with their users and the users' groups, in three queries in total."""
+        if client is None:
+            raise OAuthServiceError('client is required')
+        return OAuthAuthorization.query.filter_by(client_id=client.id) \
+            .options(joinedload(OAuthAuthorization.user).selectinload(User.groups)) \
+            .all()
 
     @staticmethod
     def get_clients_for_user(user: User):
         if user is None:
             raise OAuthServiceError('user is required')
 
-        group_allowed_clients = db.session.query(OAuthClient.id.label('client_id')) \
-            .filter(client_allowed_groups.c.client_id == OAuthClient.id,
-                    client_allowed_groups.c.group_id == user_groups.c.group_id,
-                    user_groups.c.user_id == user.id)
-        public_clients = db.session.query(OAuthClient.id.label('client_id')) \
-            .filter(OAuthClient.is_public == True)
-        all_client_ids = group_allowed_clients.union(public_clients).subquery()
-        return db.session.query(OAuthClient) \
-            .filter(OAuthClient.id == all_client_ids.c.client_id) \
-            .order_by(OAuthClient.id) \
-            .all()
+        client_ids = get_eligibility_index().client_ids_for_user(user)
+        if not client_ids:
+            return []
+        return OAuthClient.query.filter(OAuthClient.id.in_(client_ids)).order_by(OAuthClient.id).all()
 
     @staticmethod
     def _validate_new_client_fields(
@@ -180,26 +204,10 @@ class OAuthService:
         except PasswordExpiryError as e:
             raise OAuthServiceError(e.msg, detail=e.detail, code=e.code)
 
-        authorize_token = None
-        for _ in range(OAuthService.token_generation_retry):  # repeat in case token collision
-            token = token_urlsafe()
-            if db.session.query(func.count()).filter(OAuthAuthorization.authorize_token == token).scalar() == 0:
-                authorize_token = token
-                break
-        if authorize_token is None:
-            raise OAuthServiceError('token space almost exhausted')
-
-        expire = datetime.utcnow() + timedelta(minutes=1)
-
-        auth = OAuthAuthorization.query.filter_by(client_id=client.id, user_id=user.id).first()
-        if auth is None:
-            auth = OAuthAuthorization(client_id=client.id, user_id=user.id,
-                                      authorize_token=authorize_token, authorize_token_expire_at=expire)
-            db.session.add(auth)
-        else:
-            auth.authorize_token = authorize_token
-            auth.authorize_token_expire_at = expire
-        return authorize_token
+        try:
+            return get_auth_code_store().issue(client.id, user.id)
+        except AuthCodeError as e:
+            raise OAuthServiceError(e.msg)
 
     @staticmethod
     def get_access_token(client, client_secret, redirect_url, authorize_token):
@@ -217,32 +225,56 @@ class OAuthService:
         if client.secret != client_secret:
             raise OAuthServiceError('wrong client secret')
 
-        auth = OAuthAuthorization.query.filter_by(client_id=client.id, authorize_token=authorize_token).first()
-        if auth is None:
-            raise OAuthServiceError('invalid authorization token')
-        if auth.authorize_token_expire_at < datetime.utcnow():
-            raise OAuthServiceError('authorization token expired')
+        try:
+            code = get_auth_code_store().redeem(authorize_token, client.id)
+        except AuthCodeError as e:
+            raise OAuthServiceError(e.msg)
+        user = db.session.get(User, code.user_id)
 
-        OAuthService._check_user_eligibility(client, auth.user)
+        OAuthService._check_user_eligibility(client, user)
+        status = get_password_expiry_status(user)
         try:
-            check_password_expiry_for_oauth(auth.user)
+            check_password_expiry_for_oauth(user, status)
         except PasswordExpiryError as e:
             raise OAuthServiceError(e.msg, detail=e.detail, code=e.code)
 
-        access_token = None
-        for _ in range(OAuthService.token_generation_retry):  # repeat in case token collision
-            token = token_urlsafe()
-            if db.session.query(func.count()).filter(OAuthAuthorization.access_token == token).scalar() == 0:
-                access_token = token
-                break
-        if access_token is None:
-            raise OAuthServiceError('token space almost exhausted')
+        def apply(access_token):
+            # codes kept outside the database do not create the row, so this is the handshake's only write
+            auth = db.session.get(OAuthAuthorization, (client.id, user.id))
+            if auth is None:
+                auth = OAuthAuthorization(client_id=client.id, user_id=user.id)
+                db.session.add(auth)
+            auth.access_token = access_token
+            auth.authorize_token = None  # consumes a code of the database store, also after a retry
+            auth.authorize_token_expire_at = None
 
-        auth.access_token = access_token
-        auth.authorize_token = None
-        auth.authorize_token_expire_at = None
+        access_token = OAuthService._issue_unique_token(apply)
+        if is_signed_token_enabled():  # the stored token then only serves as the signed token's id (jti)
+            try:
+                return issue_signed_token(access_token, user, client, status,
+                                          get_password_expiry_status_valid_until(user))
+            except SignedTokenError as e:
+                raise OAuthServiceError(e.msg)
         return access_token
 
+    @staticmethod
+    def _issue_unique_token(apply) -> str:
+        """Call ``apply(token)`` with a fresh token and flush, relying on the unique constraints of the token columns.
+
+        On an IntegrityError (a token collision, or a concurrent request creating the same authorization) the
+        transaction is rolled back and ``apply`` runs again with a new token, so it must (re)load what it changes,
+        and the caller must not have other pending changes.
+        """
+        for _ in range(OAuthService.token_generation_retry):  # repeat in case of collision
+            token = token_urlsafe()
+            apply(token)
+            try:
+                db.session.flush()
+                return token
+            except IntegrityError:
+                db.session.rollback()
+        raise OAuthServiceError('token space almost exhausted')
+
     @staticmethod
     def verify_access_token(access_token):
         if access_token is None:
@@ -250,18 +282,60 @@ class OAuthService:
         if len(access_token) == 0:
             raise OAuthServiceError('access_token can not be empty')
 
-        auth = OAuthAuthorization.query.filter_by(access_token=access_token).options(joinedload(OAuthAuthorization.client)).first()
+        if is_signed_token_enabled() and looks_like_signed_token(access_token):
+            try:
+                token = verify_signed_token(access_token)
+            except SignedTokenError as e:
+                raise OAuthServiceError(e.msg)
+            if token.password_expiry_status not in ('none', 'warning_1month'):  # needs the user row
+                OAuthService._check_password_expiry_for_access(token.user, token.password_expiry_status)
+            return token
+
+        # changes that other workers announced in the ACL change log (deactivation, revoked tokens, group and client
+        # ACL edits) advance the index version; entries verified at an older version are verified again
+        index = get_eligibility_index()
+        index.sync()
+        acl_version = index.version
+        cached = get_verified_token(access_token)
+        if cached is not None and cached.acl_version == acl_version:
+            if cached.eligibility_error is not None:
+                raise OAuthServiceError(cached.eligibility_error)
+            if cached.password_expiry_status not in ('none', 'warning_1month'):  # needs the user row
+                OAuthService._check_password_expiry_for_access(cached.user, cached.password_expiry_status)
+            return cached
+
+        auth = OAuthAuthorization.query.filter_by(access_token=access_token) \
+            .options(joinedload(OAuthAuthorization.client), joinedload(OAuthAuthorization.user)).first()
         if auth is None:
+            invalidate_token(access_token)
             raise OAuthServiceError('invalid access_token')
 
-        OAuthService._check_user_eligibility(auth.client, auth.user)
+        user = auth.user
         try:
-            check_password_expiry_for_oauth(auth.user)
+            OAuthService._check_user_eligibility(auth.client, user)
+        except OAuthServiceError as e:
+            put_verified_token(access_token, VerifiedAccessToken(user_id=auth.user_id, client_id=auth.client_id,
+                                                                 eligibility_error=e.msg,
+                                                                 password_expiry_status='none',
+                                                                 acl_version=acl_version))
+            raise
+
+        status = get_password_expiry_status(user)
+        put_verified_token(access_token,
+                           VerifiedAccessToken(user_id=auth.user_id, client_id=auth.client_id,
+                                               eligibility_error=None, password_expiry_status=status,
+                                               acl_version=acl_version),
+                           valid_until=get_password_expiry_status_valid_until(user))
+        OAuthService._check_password_expiry_for_access(user, status)
+        return auth
+
+    @staticmethod
+    def _check_password_expiry_for_access(user: User, status: PasswordExpiryStatus):
+        try:
+            check_password_expiry_for_oauth(user, status)
         except PasswordExpiryError as e:
             raise OAuthServiceError(e.msg, detail=e.detail, code=e.code)
 
-        return auth
-
     @staticmethod
     def _check_user_eligibility(client: OAuthClient, user: User):
         if user is None:
@@ -270,17 +344,8 @@ class OAuthService:
         if not user.is_active:
             raise OAuthServiceError('inactive user')
 
-        if not client.is_public:  # check if user is in a group among the client's allowed_groups
-            access_group_found = False
-            for group_allowed in client.allowed_groups:
-                for group in user.groups:
-                    if group.id == group_allowed.id:
-                        access_group_found = True
-                        break
-                if access_group_found:
-                    break
-            if not access_group_found:
-                raise OAuthServiceError('permission denied')
+        if not get_eligibility_index().is_eligible(client.id, user):
+            raise OAuthServiceError('permission denied')
 
     @staticmethod
     def clear_user_tokens(user):
@@ -290,3 +355,7 @@ class OAuthService:
             auth.authorize_token = None
             auth.authorize_token_expire_at = None
             auth.access_token = None
+        get_auth_code_store().discard_user_codes(user.id)
+        revoke_signed_tokens(user_id=user.id)
+        record_acl_change(user_id=user.id)  # so the other workers' token caches verify this user's tokens again
+        invalidate_user_tokens(user.id)
@@ -0,0 +1,211 @@
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from secrets import token_urlsafe
+from typing import Any
+
+from flask import current_app as app
+
+from error import BasicError
+from models import OAuthAuthorization, db
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_TTL_SECONDS = 60
+_DEFAULT_KEY_PREFIX = 'auth:oauth-code:'
+_DEFAULT_MEMORY_MAX_CODES = 100000
+
+_store: 'AuthCodeStore | None' = None
+
+
+class AuthCodeError(BasicError):
+    pass
+
+
+@dataclass(frozen=True)
+class AuthorizationCode:
+    client_id: int
+    user_id: int
+
+
+class AuthCodeStore:
+    """Single-use OAuth authorization codes that expire ``ttl`` after they are issued."""
+
+    def __init__(self, ttl: timedelta):
+        self.ttl = ttl
+
+    def issue(self, client_id: int, user_id: int) -> str:
+        raise NotImplementedError()
+
+    def redeem(self, code: str, client_id: int) -> AuthorizationCode:
+        """Consume ``code``; raises AuthCodeError if it is unknown, expired or was issued for another client."""
+        raise NotImplementedError()
+
+    def discard_user_codes(self, user_id: int) -> None:
+        raise NotImplementedError()
+
+
+class DatabaseAuthCodeStore(AuthCodeStore):
+    """Codes in the authorize_token columns of the OAuthAuthorization row (no shared store required).
+
+    Changes join the current transaction; the caller commits.
+    """
+
+    def issue(self, client_id: int, user_id: int) -> str:
+        from services.oauth import OAuthService
+        expire = datetime.utcnow() + self.ttl
+
+        def apply(authorize_token):
+            auth = OAuthAuthorization.query.filter_by(client_id=client_id, user_id=user_id).first()
+            if auth is None:
+                auth = OAuthAuthorization(client_id=client_id, user_id=user_id,
+                                          authorize_token=authorize_token, authorize_token_expire_at=expire)
+                db.session.add(auth)
+            else:
+                auth.authorize_token = authorize_token
+                auth.authorize_token_expire_at = expire
+
+        return OAuthService._issue_unique_token(apply)
+
+    def redeem(self, code: str, client_id: int) -> AuthorizationCode:
+        auth = OAuthAuthorization.query.filter_by(client_id=client_id, authorize_token=code).first()
+        if auth is None:
+            raise AuthCodeError('invalid authorization token')
+        if auth.authorize_token_expire_at < datetime.utcnow():
+            raise AuthCodeError('authorization token expired')
+        auth.authorize_token = None
+        auth.authorize_token_expire_at = None
+        return AuthorizationCode(auth.client_id, auth.user_id)
+
+    def discard_user_codes(self, user_id: int) -> None:
+        pass  # OAuthService.clear_user_tokens clears the columns along with the access tokens
+
+
+class MemoryAuthCodeStore(AuthCodeStore):
+    """Process-local codes. Only suitable for a single worker or tests."""
+
+    def __init__(self, ttl: timedelta, max_codes: int = _DEFAULT_MEMORY_MAX_CODES):
+        super().__init__(ttl)
+        self.max_codes = max_codes
+        self._codes: OrderedDict[str, tuple[AuthorizationCode, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, client_id: int, user_id: int) -> str:
+        code = token_urlsafe()
+        now = time.monotonic()
+        with self._lock:
+            self._codes[code] = (AuthorizationCode(client_id, user_id), now + self.ttl.total_seconds())
+            while self._codes:  # drop expired codes (oldest first), then enforce the size bound
+                oldest_code, (_, expires_at) = next(iter(self._codes.items()))
+                if expires_at > now and len(self._codes) <= self.max_codes:
+                    break
+                del self._codes[oldest_code]
+        return code
+
+    def redeem(self, code: str, client_id: int) -> AuthorizationCode:
+        with self._lock:
+            entry = self._codes.pop(code, None)
+        if entry is None or entry[1] <= time.monotonic() or entry[0].client_id != client_id:
+            raise AuthCodeError('invalid authorization token')
+        return entry[0]
+
+    def discard_user_codes(self, user_id: int) -> None:
+        with self._lock:
+            for code in [code for code, (grant, _) in self._codes.items() if grant.user_id == user_id]:
+                del self._codes[code]
+
+
+class RedisAuthCodeStore(AuthCodeStore):
+    """Codes as Redis keys with a native TTL, consumed with GETDEL (Redis 6.2+), shared by every worker.
+
+    While Redis is unreachable, codes are issued to and redeemed from the database instead.
+    """
+
+    def __init__(self, ttl: timedelta, redis_url: str, key_prefix: str = _DEFAULT_KEY_PREFIX):
+        super().__init__(ttl)
+        import redis  # optional dependency, only needed for this backend
+        self._redis_error = redis.RedisError
+        self._redis = redis.Redis.from_url(redis_url)
+        self.key_prefix = key_prefix
+        self._fallback = DatabaseAuthCodeStore(ttl)
+
+    def _code_key(self, code: str) -> str:
+        return self.key_prefix + 'code:' + code
+
+    def _user_key(self, user_id: int) -> str:
+        return self.key_prefix + 'user:%d' % user_id
+
+    def issue(self, client_id: int, user_id: int) -> str:
+        code = token_urlsafe()
+        ttl_seconds = math.ceil(self.ttl.total_seconds())
+        try:
+            pipe = self._redis.pipeline()
+            pipe.set(self._code_key(code), '%d:%d' % (client_id, user_id), ex=ttl_seconds, nx=True)
+            pipe.sadd(self._user_key(user_id), code)
+            pipe.expire(self._user_key(user_id), ttl_seconds)
+            created = pipe.execute()[0]
+        except self._redis_error as e:
+            logger.warning('OAuth codes: Redis unavailable, issuing from the database: %s', e)
+            return self._fallback.issue(client_id, user_id)
+        if not created:  # a 256-bit collision; keep the other code intact
+            raise AuthCodeError('token space almost exhausted')
+        return code
+
+    def redeem(self, code: str, client_id: int) -> AuthorizationCode:
+        try:
+            value = self._redis.getdel(self._code_key(code))
+        except self._redis_error as e:
+            logger.warning('OAuth codes: Redis unavailable, redeeming from the database: %s', e)
+            value = None
+        if value is None:  # unknown, expired, or issued by the database fallback
+            return self._fallback.redeem(code, client_id)
+        code_client_id, user_id = (int(part) for part in value.split(b':'))
+        if code_client_id != client_id:
+            raise AuthCodeError('invalid authorization token')
+        return AuthorizationCode(code_client_id, user_id)
+
+    def discard_user_codes(self, user_id: int) -> None:
+        try:
+            codes = self._redis.smembers(self._user_key(user_id))
+            keys = [self._code_key(code.decode()) for code in codes] + [self._user_key(user_id)]
+            self._redis.delete(*keys)
+        except self._redis_error as e:
+            logger.warning('OAuth codes: failed to discard codes of user %d in Redis: %s', user_id, e)
+
+
+def _auth_code_config() -> dict[str, Any]:
+    cfg = app.config.get('OAUTH_AUTH_CODES')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def _create_auth_code_store() -> AuthCodeStore:
+    cfg = _auth_code_config()
+    ttl = timedelta(seconds=float(cfg.get('ttl_seconds', _DEFAULT_TTL_SECONDS)))
+    backend = cfg.get('backend') or 'database'
+    if backend == 'database':
+        return DatabaseAuthCodeStore(ttl)
+    if backend == 'memory':
+        return MemoryAuthCodeStore(ttl, int(cfg.get('max_codes', _DEFAULT_MEMORY_MAX_CODES)))
+    if backend == 'redis':
+        redis_url = cfg.get('redis_url')
+        if not redis_url:
+            raise ValueError('OAUTH_AUTH_CODES.redis_url is required for the redis backend')
+        return RedisAuthCodeStore(ttl, redis_url, cfg.get('key_prefix') or _DEFAULT_KEY_PREFIX)
+    raise ValueError('Unsupported OAuth authorization code backend: %s' % backend)
+
+
+def get_auth_code_store() -> AuthCodeStore:
+    global _store
+    if _store is None:
+        _store = _create_auth_code_store()
+    return _store
+
+
+def reset_auth_code_store() -> None:
+    """Drop the store instance so the next use re-reads OAUTH_AUTH_CODES (mainly for tests)."""
+    global _store
+    _store = None
@@ -0,0 +1,160 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+from sqlalchemy import func
+
+from models import OAuthAclChange, OAuthClient, User, client_allowed_groups, db
+from utils.ttl_cache import TTLCache
+
+_DEFAULT_CHECK_INTERVAL_SECONDS = 2
+_DEFAULT_MAX_USERS = 100000
+_CHANGE_LOG_RETENTION = timedelta(days=1)
+_LATE_COMMIT_WINDOW = 100
+
+_index: 'EligibilityIndex | None' = None
+_index_lock = threading.Lock()
+
+
+class EligibilityIndex:
+    """Which users may use which OAuth clients, as frozensets of group ids.
+
+    Every client's ``(is_public, allowed group ids)`` is loaded with two queries; a user's group ids are added on
+    first use. Changes are announced through the o_auth_acl_change log, whose latest id is the version shared by
+    all workers: each worker reads the entries past its version at most every ``check_interval`` seconds and drops
+    only what they name.
+    """
+
+    def __init__(self, check_interval: float, max_users: int):
+        self.check_interval = check_interval
+        self.version: int | None = None
+        self.full_reloads = 0
+        self._checked_at = 0.0
+        self._clients: dict[int, tuple[bool, frozenset[int]]] | None = None
+        self._users: TTLCache[int, frozenset[int]] = TTLCache(max_users)
+        self._applied: set[int] = set()
+        self._lock = threading.Lock()
+
+    def sync(self) -> None:
+        """Apply the change log entries added since the last check, checking at most every ``check_interval``
+        seconds; ``version`` then covers every change seen so far."""
+        now = time.monotonic()
+        if self.version is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self.version is None:
+                self.version = db.session.query(func.max(OAuthAclChange.id)).scalar() or 0
+                self._applied = {change_id for change_id, in db.session.query(OAuthAclChange.id)
+                                 .filter(OAuthAclChange.id > self.version - _LATE_COMMIT_WINDOW)}
+                self._reset()
+            else:
+                # ids are assigned at insert but become visible at commit, so look a little behind the version
+                # for entries whose transaction committed late
+                changes = db.session.query(OAuthAclChange.id, OAuthAclChange.user_id, OAuthAclChange.client_id) \
+                    .filter(OAuthAclChange.id > self.version - _LATE_COMMIT_WINDOW).order_by(OAuthAclChange.id).all()
+                for change_id, user_id, client_id in changes:
+                    if change_id not in self._applied:
+                        self._apply(user_id, client_id)
+                        self._applied.add(change_id)
+                    self.version = max(self.version, change_id)
+                self._applied = {change_id for change_id in self._applied
+                                 if change_id > self.version - _LATE_COMMIT_WINDOW}
+            self._checked_at = now
+
+    def _reset(self) -> None:
+        self._clients = None
+        self._users.clear()
+        self.full_reloads += 1
+
+    def _apply(self, user_id: int | None, client_id: int | None) -> None:
+        if user_id is None and client_id is None:
+            self._reset()
+            return
+        if user_id is not None:
+            self._users.pop(user_id)
+        if client_id is not None:
+            self._clients = None  # clients are few; reload them together
+
+    def forget(self, user_id: int | None, client_id: int | None) -> None:
+        with self._lock:
+            self._apply(user_id, client_id)
+
+    def _load_clients(self) -> dict[int, tuple[bool, frozenset[int]]]:
+        allowed: dict[int, set[int]] = {}
+        for client_id, group_id in db.session.query(client_allowed_groups.c.client_id,
+                                                    client_allowed_groups.c.group_id):
+            allowed.setdefault(client_id, set()).add(group_id)
+        return {client_id: (is_public, frozenset(allowed.get(client_id, ())))
+                for client_id, is_public in db.session.query(OAuthClient.id, OAuthClient.is_public)}
+
+    def _client_acls(self, client_id: int | None = None) -> dict[int, tuple[bool, frozenset[int]]]:
+        clients = self._clients
+        if clients is None or (client_id is not None and client_id not in clients):  # new since the last load
+            clients = self._load_clients()
+            self._clients = clients
+        return clients
+
+    def user_group_ids(self, user: User) -> frozenset[int]:
+        group_ids = self._users.get(user.id)
+        if group_ids is None:
+            group_ids = frozenset(group.id for group in user.groups)
+            self._users.put(user.id, group_ids)
+        return group_ids
+
+    def is_eligible(self, client_id: int, user: User) -> bool:
+        self.sync()
+        is_public, allowed = self._client_acls(client_id).get(client_id, (False, frozenset()))
+        return is_public or not allowed.isdisjoint(self.user_group_ids(user))
+
+    def client_ids_for_user(self, user: User) -> list[int]:
+        self.sync()
+        group_ids = self.user_group_ids(user)
+        return sorted(client_id for client_id, (is_public, allowed) in self._client_acls().items()
+                      if is_public or not allowed.isdisjoint(group_ids))
+
+    def stats(self) -> dict:
+        stats = self._users.stats()
+        stats.update(version=self.version, full_reloads=self.full_reloads,
+                     clients=len(self._clients) if self._clients is not None else None)
+        return stats
+
+
+def _eligibility_config() -> dict:
+    cfg = app.config.get('OAUTH_ELIGIBILITY')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def get_eligibility_index() -> EligibilityIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                cfg = _eligibility_config()
+                _index = EligibilityIndex(float(cfg.get('check_interval_seconds', _DEFAULT_CHECK_INTERVAL_SECONDS)),
+                                          int(cfg.get('max_users', _DEFAULT_MAX_USERS)))
+    return _index
+
+
+def record_acl_change(user_id: int | None = None, client_id: int | None = None) -> None:
+    """Announce that the groups of ``user_id``, the ACL of ``client_id``, or (with neither) anything changed.
+
+    Adds a change log entry to the current transaction (the caller commits). This worker drops the affected
+    entries right away; the others do on their next check.
+    """
+    db.session.query(OAuthAclChange) \
+        .filter(OAuthAclChange.created_at < datetime.utcnow() - _CHANGE_LOG_RETENTION) \
+        .delete(synchronize_session=False)
+    db.session.add(OAuthAclChange(user_id=user_id, client_id=client_id))
+    if _index is not None:
+        _index.forget(user_id, client_id)
+
+
+def get_eligibility_stats() -> dict:
+    return get_eligibility_index().stats()
+
+
+def reset_eligibility_index() -> None:
+    """Drop the index so the next use re-reads OAUTH_ELIGIBILITY and reloads everything (mainly for tests)."""
+    global _index
+    _index = None
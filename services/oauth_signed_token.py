@@ -0,0 +1,220 @@
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+
+from error import BasicError
+from models import OAuthClient, OAuthTokenRevocation, User, db
+from services.password_expiry import PasswordExpiryStatus
+
+_DEFAULT_TTL_SECONDS = 900
+_DEFAULT_REVOCATION_REFRESH_SECONDS = 30
+
+_HEADER_TYP = 'JWT'
+_HEADER_ALG = 'HS256'
+
+
+class SignedTokenError(BasicError):
+    pass
+
+
+@dataclass(frozen=True)
+class SignedAccessToken:
+    """Claims of a verified signed access token; stands in for the OAuthAuthorization it was issued for.
+
+    Verification needs no database access. ``user`` and ``client`` are loaded only when a caller reads them.
+    """
+    token_id: str
+    user_id: int
+    client_id: int
+    group_ids: tuple[int, ...]
+    issued_at: float
+    expires_at: float
+    password_expiry_status: PasswordExpiryStatus
+
+    @property
+    def user(self) -> User | None:
+        return db.session.get(User, self.user_id)
+
+    @property
+    def client(self) -> OAuthClient | None:
+        return db.session.get(OAuthClient, self.client_id)
+
+
+@dataclass(frozen=True)
+class _RevocationList:
+    """Latest revocation time per user, per client and for all tokens, covering the last ``ttl_seconds``."""
+    users: dict[int, float]
+    clients: dict[int, float]
+    everything: float
+    loaded_at: float
+
+    def is_revoked(self, token: SignedAccessToken) -> bool:
+        return token.issued_at < max(self.everything, self.users.get(token.user_id, 0.0),
+                                     self.clients.get(token.client_id, 0.0))
+
+
+_revocations: _RevocationList | None = None
+_revocations_lock = threading.Lock()
+
+
+def _signed_token_config() -> dict:
+    cfg = app.config.get('OAUTH_SIGNED_TOKENS')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def is_signed_token_enabled() -> bool:
+    return bool(_signed_token_config().get('enabled', False))
+
+
+def _ttl_seconds() -> float:
+    return float(_signed_token_config().get('ttl_seconds', _DEFAULT_TTL_SECONDS))
+
+
+def _keys() -> dict[str, str]:
+    keys = _signed_token_config().get('keys')
+    if not isinstance(keys, dict) or not keys:
+        raise SignedTokenError('OAUTH_SIGNED_TOKENS.keys is not configured')
+    return keys
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(key: str, signing_input: str) -> bytes:
+    return hmac.new(key.encode('utf-8'), signing_input.encode('ascii'), hashlib.sha256).digest()
+
+
+def _timestamp(value: datetime) -> float:
+    return (value - datetime(1970, 1, 1)).total_seconds()
+
+
+def looks_like_signed_token(access_token: str) -> bool:
+    # opaque tokens are token_urlsafe() strings, which never contain a dot
+    return access_token.count('.') == 2
+
+
+def issue_signed_token(token_id: str, user: User, client: OAuthClient, password_expiry_status: PasswordExpiryStatus,
+                       valid_until: datetime | None = None) -> str:
+    """Return an HS256 JWT for ``user`` and ``client`` signed with OAUTH_SIGNED_TOKENS.current_key.
+
+    ``token_id`` becomes the ``jti`` claim. The token expires after ``ttl_seconds``, or at ``valid_until`` if that is
+    sooner, so its embedded password expiry status never outlives the moment it would change.
+    """
+    keys = _keys()
+    kid = _signed_token_config().get('current_key') or next(iter(keys))
+    if kid not in keys:
+        raise SignedTokenError('OAUTH_SIGNED_TOKENS.current_key is not in OAUTH_SIGNED_TOKENS.keys')
+    now = time.time()
+    expires_at = now + _ttl_seconds()
+    if valid_until is not None:
+        expires_at = min(expires_at, _timestamp(valid_until))
+    header = dict(alg=_HEADER_ALG, typ=_HEADER_TYP, kid=kid)
+    payload = dict(iss=app.config['SITE']['root_url'], sub=str(user.id), aud=str(client.id),
+                   grp=sorted(group.id for group in user.groups), iat=int(now * 1000) / 1000, exp=int(expires_at),
+                   jti=token_id, pes=password_expiry_status)
+    signing_input = '.'.join(_b64encode(json.dumps(part, separators=(',', ':')).encode('utf-8'))
+                             for part in (header, payload))
+    return signing_input + '.' + _b64encode(_sign(keys[kid], signing_input))
+
+
+def verify_signed_token(access_token: str) -> SignedAccessToken:
+    """Check signature, expiry and the revocation list. Only the periodic revocation list refresh queries the
+    database."""
+    try:
+        header_b64, payload_b64, signature_b64 = access_token.split('.')
+        header = json.loads(_b64decode(header_b64))
+        key = _keys().get(header.get('kid'))
+        if header.get('alg') != _HEADER_ALG or key is None:
+            raise SignedTokenError('invalid access_token')
+        if not hmac.compare_digest(_sign(key, header_b64 + '.' + payload_b64), _b64decode(signature_b64)):
+            raise SignedTokenError('invalid access_token')
+        payload = json.loads(_b64decode(payload_b64))
+        token = SignedAccessToken(token_id=payload['jti'], user_id=int(payload['sub']),
+                                  client_id=int(payload['aud']), group_ids=tuple(payload['grp']),
+                                  issued_at=float(payload['iat']), expires_at=float(payload['exp']),
+                                  password_expiry_status=payload['pes'])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise SignedTokenError('invalid access_token')
+    if token.expires_at <= time.time():
+        raise SignedTokenError('access_token expired')
+    if _get_revocations().is_revoked(token):
+        raise SignedTokenError('invalid access_token')
+    return token
+
+
+def _load_revocations() -> _RevocationList:
+    now = time.time()
+    users: dict[int, float] = {}
+    clients: dict[int, float] = {}
+    everything = 0.0
+    since = datetime.utcnow() - timedelta(seconds=_ttl_seconds())
+    rows = db.session.query(OAuthTokenRevocation.user_id, OAuthTokenRevocation.client_id,
+                            OAuthTokenRevocation.revoked_at) \
+        .filter(OAuthTokenRevocation.revoked_at > since).all()
+    for user_id, client_id, revoked_at in rows:
+        ts = _timestamp(revoked_at)
+        if user_id is not None:
+            users[user_id] = max(users.get(user_id, 0.0), ts)
+        elif client_id is not None:
+            clients[client_id] = max(clients.get(client_id, 0.0), ts)
+        else:
+            everything = max(everything, ts)
+    return _RevocationList(users, clients, everything, now)
+
+
+def _get_revocations() -> _RevocationList:
+    global _revocations
+    refresh = float(_signed_token_config().get('revocation_refresh_seconds', _DEFAULT_REVOCATION_REFRESH_SECONDS))
+    current = _revocations
+    if current is None or time.time() - current.loaded_at >= refresh:
+        current = _load_revocations()
+        with _revocations_lock:
+            _revocations = current
+    return current
+
+
+def revoke_signed_tokens(user_id: int | None = None, client_id: int | None = None) -> None:
+    """Revoke every signed token issued so far to ``user_id``, for ``client_id``, or (with neither) all of them.
+
+    Adds a row to the current transaction (the caller commits) and applies it to this process's list right away;
+    other processes see it on their next refresh. No-op while signed tokens are disabled.
+    """
+    global _revocations
+    if not is_signed_token_enabled():
+        return
+    now = datetime.utcnow()
+    db.session.query(OAuthTokenRevocation) \
+        .filter(OAuthTokenRevocation.revoked_at <= now - timedelta(seconds=_ttl_seconds())) \
+        .delete(synchronize_session=False)
+    db.session.add(OAuthTokenRevocation(user_id=user_id, client_id=client_id, revoked_at=now))
+    with _revocations_lock:
+        current = _revocations
+        if current is not None:
+            ts = _timestamp(now)
+            users, clients, everything = dict(current.users), dict(current.clients), current.everything
+            if user_id is not None:
+                users[user_id] = ts
+            elif client_id is not None:
+                clients[client_id] = ts
+            else:
+                everything = ts
+            _revocations = _RevocationList(users, clients, everything, current.loaded_at)
+
+
+def reset_revocation_list() -> None:
+    """Drop the in-memory revocation list so the next check reloads it (mainly for tests)."""
+    global _revocations
+    with _revocations_lock:
+        _revocations = None
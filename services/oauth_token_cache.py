@@ -0,0 +1,111 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+from flask import current_app as app
+
+from models import OAuthClient, User, db
+from services.password_expiry import PasswordExpiryStatus
+from utils.ttl_cache import TTLCache
+
+_DEFAULT_MAX_SIZE = 10000
+_DEFAULT_TTL_SECONDS = 60
+
+_cache: TTLCache[str, 'VerifiedAccessToken'] | None = None
+
+
+@dataclass(frozen=True)
+class VerifiedAccessToken:
+    """Outcome of a full OAuthService.verify_access_token() run for one access token; a cache hit returns it in
+    place of the OAuthAuthorization.
+
+    ``acl_version`` is the eligibility index version the outcome was reached at: once the index has seen a later
+    change (from any worker), the entry is verified again. ``user`` and ``client`` are loaded only when a caller
+    reads them.
+    """
+    user_id: int
+    client_id: int
+    eligibility_error: str | None
+    password_expiry_status: PasswordExpiryStatus
+    acl_version: int | None
+
+    @property
+    def user(self) -> User | None:
+        return db.session.get(User, self.user_id)
+
+    @property
+    def client(self) -> OAuthClient | None:
+        return db.session.get(OAuthClient, self.client_id)
+
+
+def _cache_config() -> dict:
+    cfg = app.config.get('OAUTH_TOKEN_CACHE')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def is_token_cache_enabled() -> bool:
+    return bool(_cache_config().get('enabled', True))
+
+
+def _get_cache() -> TTLCache[str, VerifiedAccessToken]:
+    global _cache
+    if _cache is None:
+        cfg = _cache_config()
+        _cache = TTLCache(int(cfg.get('max_size', _DEFAULT_MAX_SIZE)),
+                          float(cfg.get('ttl_seconds', _DEFAULT_TTL_SECONDS)))
+    return _cache
+
+
+def get_verified_token(access_token: str) -> VerifiedAccessToken | None:
+    if not is_token_cache_enabled():
+        return None
+    return _get_cache().get(access_token)
+
+
+def put_verified_token(access_token: str, entry: VerifiedAccessToken, valid_until: datetime | None = None) -> None:
+    """Cache a verification result.
+
+    ``valid_until`` caps the entry lifetime below the configured TTL, so a cached password expiry status never
+    outlives the moment it would change.
+    """
+    if not is_token_cache_enabled():
+        return
+    cache = _get_cache()
+    ttl = cache.ttl
+    if valid_until is not None:
+        remaining = (valid_until - datetime.utcnow()).total_seconds()
+        if remaining <= 0:
+            return
+        ttl = remaining if ttl is None else min(ttl, remaining)
+    cache.put(access_token, entry, ttl)
+
+
+def invalidate_token(access_token: str) -> None:
+    if _cache is not None:
+        _cache.pop(access_token)
+
+
+def invalidate_user_tokens(user_id: int) -> None:
+    if _cache is not None:
+        _cache.discard_where(lambda _, entry: entry.user_id == user_id)
+
+
+def invalidate_client_tokens(client_id: int) -> None:
+    if _cache is not None:
+        _cache.discard_where(lambda _, entry: entry.client_id == client_id)
+
+
+def invalidate_all_tokens() -> None:
+    if _cache is not None:
+        _cache.clear()
+
+
+def get_token_cache_stats() -> dict:
+    stats = _get_cache().stats()
+    stats['enabled'] = is_token_cache_enabled()
+    return stats
+
+
+def reset_token_cache() -> None:
+    """Drop the cache instance so the next use re-reads OAUTH_TOKEN_CACHE (mainly for tests)."""
+    global _cache
+    _cache = None
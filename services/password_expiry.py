@@ -2,10 +2,11 @@ from datetime import datetime, timedelta
 from typing import Literal
 
 from flask import current_app as app, session, has_request_context
+from sqlalchemy import and_, not_, or_
 
 from error import BasicError
 from models import User, db
-from utils.mail import is_mail_enabled, send_email
+from utils.mail import build_email, is_mail_enabled, is_mail_outbox_enabled, send_messages
 
 PasswordExpiryStatus = Literal['none', 'warning_1month', 'warning_1week', 'expired']
 
@@ -45,6 +46,40 @@ def get_password_expiry_status(user: User) -> PasswordExpiryStatus:
     return 'none'
 
 
+def password_expiry_status_filter(status: PasswordExpiryStatus, now: datetime | None = None):
+    """SQL condition matching the users for whom get_password_expiry_status(user) == ``status`` at ``now``."""
+    if now is None:
+        now = datetime.utcnow()
+    applicable = and_(User.is_two_factor_enabled.is_(False), User.external_auth_enforced.is_(False),
+                      User.password_expires_at.isnot(None))
+    if status == 'expired':
+        return and_(applicable, User.password_expires_at <= now)
+    if status == 'warning_1week':
+        return and_(applicable, User.password_expires_at > now,
+                    User.password_expires_at <= now + PASSWORD_WARNING_1WEEK)
+    if status == 'warning_1month':
+        return and_(applicable, User.password_expires_at > now + PASSWORD_WARNING_1WEEK,
+                    User.password_expires_at <= now + PASSWORD_WARNING_1MONTH)
+    if status == 'none':
+        return or_(not_(applicable), User.password_expires_at > now + PASSWORD_WARNING_1MONTH)
+    raise ValueError('unknown password expiry status: %s' % status)
+
+
+def get_password_expiry_status_valid_until(user: User) -> datetime | None:
+    """Return when the result of get_password_expiry_status(user) next changes by time alone (None if never)."""
+    if not is_password_expiry_applicable(user):
+        return None
+    if user.password_expires_at is None:
+        return None
+    now = datetime.utcnow()
+    for boundary in (user.password_expires_at - PASSWORD_WARNING_1MONTH,
+                     user.password_expires_at - PASSWORD_WARNING_1WEEK,
+                     user.password_expires_at):
+        if boundary > now:
+            return boundary
+    return None
+
+
 def is_password_expiry_intercept_active(user: User) -> bool:
     if get_password_expiry_status(user) != 'warning_1week':
         return False
@@ -74,7 +109,15 @@ def clear_password_expiry_oauth_dismissed() -> None:
     session.pop(_SESSION_KEY_OAUTH_DISMISSED_FOR, None)
 
 
+def _invalidate_cached_access_tokens(user: User) -> None:
+    if user.id is None:
+        return
+    from services.oauth_token_cache import invalidate_user_tokens
+    invalidate_user_tokens(user.id)
+
+
 def refresh_password_expiry(user: User) -> None:
+    _invalidate_cached_access_tokens(user)
     user.password_changed_at = datetime.utcnow()
     clear_password_expiry_oauth_dismissed()
     user.password_expiry_warning_email_sent_at = None
@@ -85,12 +128,14 @@ def refresh_password_expiry(user: User) -> None:
 
 
 def clear_password_expiry(user: User) -> None:
+    _invalidate_cached_access_tokens(user)
     user.password_expires_at = None
     clear_password_expiry_oauth_dismissed()
     user.password_expiry_warning_email_sent_at = None
 
 
 def restore_password_expiry_on_2fa_disable(user: User) -> None:
+    _invalidate_cached_access_tokens(user)
     if is_password_expiry_applicable(user):
         user.password_expires_at = datetime.utcnow() + PASSWORD_EXPIRY_NO_2FA
         user.password_expiry_warning_email_sent_at = None
@@ -121,8 +166,9 @@ def build_password_expiry_admin_fields(user: User) -> dict:
     }
 
 
-def check_password_expiry_for_oauth(user: User) -> None:
-    status = get_password_expiry_status(user)
+def check_password_expiry_for_oauth(user: User, status: PasswordExpiryStatus | None = None) -> None:
+    if status is None:
+        status = get_password_expiry_status(user)
     if status == 'expired':
         raise PasswordExpiryError('password expired', code='password_expired',
                                   detail='Your password has expired. Please reset your password to continue.')
@@ -138,15 +184,49 @@ def revoke_expired_session(user: User) -> None:
     db.session.commit()
 
 
-def maybe_send_password_expiry_warning_email(user: User) -> None:
+def _password_expiry_warning_candidates(now: datetime, after_id: int, limit: int) -> list[User]:
+    # get_password_expiry_status(user) == 'warning_1week' in SQL, answered from ix_user_password_expiry_warning
+    return User.query.filter(
+        User.password_expiry_warning_email_sent_at.is_(None),
+        User.password_expires_at > now,
+        User.password_expires_at <= now + PASSWORD_WARNING_1WEEK,
+        User.is_two_factor_enabled.is_(False),
+        User.external_auth_enforced.is_(False),
+        User.is_active.is_(True),
+        User.id > after_id,
+    ).order_by(User.id).limit(limit).all()
+
+
+def send_password_expiry_warnings(page_size: int = 200, dry_run: bool = False) -> int:
+    """Send the one-week password expiry warning to every user who is due one and has not had it yet.
+
+    Users are processed in pages of ``page_size``; each page is sent as one batch (outbox inserts, or one SMTP
+    session). Queued messages are committed together with the page's ``password_expiry_warning_email_sent_at``
+    marks; with direct delivery each user's mark is committed as soon as their message is sent, so a failure
+    halfway through a page does not mail the users before it again on the next run.
+    Returns the number of users warned (or, with ``dry_run``, due a warning).
+    """
     if not is_mail_enabled():
-        return
-    if get_password_expiry_status(user) != 'warning_1week':
-        return
-    if user.password_expiry_warning_email_sent_at is not None:
-        return
-    if user.email is None:
-        return
-
-    send_email(user.name, user.email, 'password_expiry_warning', user=user, site=app.config['SITE'])
-    user.password_expiry_warning_email_sent_at = datetime.utcnow()
+        return 0
+    now = datetime.utcnow()
+    count = 0
+    last_id = 0
+    while True:
+        users = _password_expiry_warning_candidates(now, last_id, page_size)
+        if not users:
+            return count
+        last_id = users[-1].id
+        count += len(users)
+        if dry_run:
+            continue
+        messages = [build_email([(user.name, user.email)], [], [], 'password_expiry_warning', user=user,
+                                site=app.config['SITE']) for user in users]
+        queued = is_mail_outbox_enabled()
+
+        def mark_warned(index: int) -> None:
+            users[index].password_expiry_warning_email_sent_at = now
+            if not queued:
+                db.session.commit()  # already delivered
+
+        send_messages(messages, on_sent=mark_warned)
+        db.session.commit()
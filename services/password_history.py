@@ -1,25 +1,35 @@
 from datetime import datetime
 
-from passlib.hash import pbkdf2_sha256
+from flask import current_app as app
 from sqlalchemy import desc
 
 from models import User, UserPasswordHistory, db
+from utils.password_hashing import find_matching_password_hash
 
-_PASSWORD_HISTORY_LIMIT = 3
+_DEFAULT_PASSWORD_HISTORY_LIMIT = 3
+
+
+def get_password_history_limit() -> int:
+    """Number of previous passwords (besides the current one) that may not be reused."""
+    cfg = app.config.get('PASSWORD_HISTORY')
+    if not isinstance(cfg, dict):
+        return _DEFAULT_PASSWORD_HISTORY_LIMIT
+    return max(0, int(cfg.get('limit', _DEFAULT_PASSWORD_HISTORY_LIMIT)))
 
 
 def check_password_not_reused(user: User, new_password: str) -> None:
     from services.user import UserServiceError
-    if pbkdf2_sha256.verify(new_password, user.password):
-        raise UserServiceError('password recently used',
-                               'Choose a password that differs from your current password.')
     history_rows = UserPasswordHistory.query.filter_by(user_id=user.id).order_by(
         desc(UserPasswordHistory.created_at),
-    ).limit(_PASSWORD_HISTORY_LIMIT).all()
-    for row in history_rows:
-        if pbkdf2_sha256.verify(new_password, row.password_hash):
-            raise UserServiceError('password recently used',
-                                   'Choose a password that differs from one of your recent passwords.')
+    ).limit(get_password_history_limit()).all()
+    # the current hash and the history hashes are verified concurrently, stopping at the first match
+    index = find_matching_password_hash(new_password, [user.password] + [row.password_hash for row in history_rows])
+    if index == 0:
+        raise UserServiceError('password recently used',
+                               'Choose a password that differs from your current password.')
+    if index is not None:
+        raise UserServiceError('password recently used',
+                               'Choose a password that differs from one of your recent passwords.')
 
 
 def record_password_change(user: User) -> None:
@@ -31,5 +41,5 @@ def record_password_change(user: User) -> None:
     history_rows = UserPasswordHistory.query.filter_by(user_id=user.id).order_by(
         desc(UserPasswordHistory.created_at),
     ).all()
-    for row in history_rows[_PASSWORD_HISTORY_LIMIT:]:
+    for row in history_rows[get_password_history_limit():]:
         db.session.delete(row)
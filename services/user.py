@@ -1,16 +1,20 @@
 import re
+from dataclasses import dataclass
 from datetime import timedelta, datetime
 from secrets import token_urlsafe
 
-from passlib.hash import pbkdf2_sha256
-from sqlalchemy import or_, func
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, raiseload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
 import utils.two_factor as two_factor
 from error import BasicError
-from models import db, User
+from models import db, Group, OAuthAuthorization, User, user_groups
+from services.login_throttle import get_login_throttle
 from services.password_expiry import (
     clear_password_expiry,
     get_password_expiry_status,
+    password_expiry_status_filter,
     refresh_password_expiry,
     restore_password_expiry_on_2fa_disable,
 )
@@ -18,18 +22,68 @@ from services.password_history import check_password_not_reused, record_password
 from utils.email_validation import EMAIL_MAX_LENGTH, EMAIL_PATTERN, is_valid_email
 from utils.external_auth.provider import get_provider, ExternalAuthError
 from utils.password import validate_password_strength, PasswordValidationError
+from utils.password_hashing import hash_password, verify_password, verify_password_and_update
 from utils.profile_validation import (
     ProfileValidationError,
     validate_mobile,
     validate_nickname,
     validate_real_name,
 )
+from utils.text_search import ranked_search
 
 
 class UserServiceError(BasicError):
     pass
 
 
+@dataclass(frozen=True)
+class GroupView:
+    id: int
+    name: str
+    description: str | None
+
+    def to_dict(self) -> dict:
+        return dict(id=self.id, name=self.name, description=self.description)
+
+
+_USER_VIEW_COLUMNS = (User.id, User.name, User.email, User.nickname, User.real_name, User.mobile, User.avatar,
+                      User.is_active, User.is_two_factor_enabled, User.external_auth_provider_id,
+                      User.external_auth_enforced, User.password_expires_at)
+
+
+@dataclass(frozen=True)
+class UserView:
+    """Read-only column projection of a User: what session checks and ``/whoami`` need, detached from the ORM.
+
+    Duck-types the User attributes used by the password expiry helpers; ``to_dict`` matches ``User.to_dict()``.
+    """
+    id: int
+    name: str
+    email: str
+    nickname: str | None
+    real_name: str | None
+    mobile: str | None
+    avatar: str | None
+    is_active: bool
+    is_two_factor_enabled: bool
+    external_auth_provider_id: str | None
+    external_auth_enforced: bool
+    password_expires_at: datetime | None
+    groups: tuple[GroupView, ...]
+
+    def to_dict(self, with_groups=True, password_expiry_fields: dict | None = None) -> dict:
+        _dict = dict(id=self.id, name=self.name, email=self.email, nickname=self.nickname,
+                     real_name=self.real_name, mobile=self.mobile, avatar=self.avatar,
+                     is_active=self.is_active, is_two_factor_enabled=self.is_two_factor_enabled,
+                     external_auth_provider_id=self.external_auth_provider_id,
+                     external_auth_enforced=self.external_auth_enforced)
+        if password_expiry_fields is not None:
+            _dict.update(password_expiry_fields)
+        if with_groups:
+            _dict['groups'] = [group.to_dict() for group in self.groups]
+        return _dict
+
+
 class UserService:
     name_pattern = re.compile('^[\w]{3,16}$')
     password_pattern = re.compile('^.{8,64}$')
@@ -61,6 +115,36 @@ class UserService:
 
         return User.query.get(_id)
 
+    @staticmethod
+    def load_authorizations(user):
+        """Fill ``user.authorizations`` with their clients in one query instead of one query per client."""
+        if user is None:
+            raise UserServiceError('user is required')
+        authorizations = OAuthAuthorization.query.filter_by(user_id=user.id) \
+            .options(joinedload(OAuthAuthorization.client)).all()
+        set_committed_value(user, 'authorizations', authorizations)
+        return user
+
+    @staticmethod
+    def get_view(_id):
+        """Load a UserView with one query and without touching the session's identity map (None if not found)."""
+        if _id is None:
+            raise UserServiceError('id is required')
+        if type(_id) is not int:
+            raise UserServiceError('id must be an integer')
+
+        rows = db.session.execute(
+            db.select(*_USER_VIEW_COLUMNS, Group.id, Group.name, Group.description)
+            .outerjoin(user_groups, user_groups.c.user_id == User.id)
+            .outerjoin(Group, Group.id == user_groups.c.group_id)
+            .where(User.id == _id)
+        ).all()
+        if not rows:
+            return None
+        n = len(_USER_VIEW_COLUMNS)
+        groups = tuple(GroupView(*row[n:]) for row in rows if row[n] is not None)
+        return UserView(*rows[0][:n], groups=groups)
+
     @staticmethod
     def get_by_id_list(id_list):
         if id_list is None:
@@ -81,6 +165,20 @@ class UserService:
             raise UserServiceError('name is required')
         return User.query.filter_by(name=name).first()
 
+    @staticmethod
+    def get_by_name_list(name_list):
+        if name_list is None:
+            raise UserServiceError('name list is required')
+        if not isinstance(name_list, (list, set, tuple)):
+            raise UserServiceError('name list must be a list, set or tuple')
+        if not name_list:  # accept empty list
+            return []
+        for name in name_list:
+            if type(name) is not str:
+                raise UserServiceError('name must be a string')
+
+        return User.query.filter(User.name.in_(name_list)).all()
+
     @staticmethod
     def get_by_email(email):
         if email is None:
@@ -98,6 +196,30 @@ class UserService:
     def get_all():
         return User.query.all()
 
+    @staticmethod
+    def filter_users(after_id=None, is_active=None, group_id=None, is_two_factor_enabled=None,
+                     password_expiry_status=None):
+        """Users matching every given filter, ordered by id, starting after ``after_id`` (keyset cursor).
+
+        Groups are loaded per batch with selectinload, so the query can be paged with ``limit`` or streamed with
+        ``yield_per``; any other relationship access raises instead of querying once per user.
+        """
+        query = User.query.options(selectinload(User.groups), raiseload('*')).order_by(User.id)
+        if after_id is not None:
+            query = query.filter(User.id > after_id)
+        if is_active is not None:
+            query = query.filter(User.is_active.is_(is_active))
+        if group_id is not None:
+            query = query.filter(User.groups.any(Group.id == group_id))
+        if is_two_factor_enabled is not None:
+            query = query.filter(User.is_two_factor_enabled.is_(is_two_factor_enabled))
+        if password_expiry_status is not None:
+            try:
+                query = query.filter(password_expiry_status_filter(password_expiry_status))
+            except ValueError as e:
+                raise UserServiceError(str(e))
+        return query
+
     @staticmethod
     def search_by_name(name, limit=5):
         if name is None:
@@ -105,18 +227,10 @@ class UserService:
         if len(name) == 0:
             raise UserServiceError('name must not be empty')
 
-        name_lower = name.lower()
-        _filter = or_(
-            func.lower(User.name).contains(name_lower),
-            func.lower(User.nickname).contains(name_lower),
-            func.lower(User.real_name).contains(name_lower),
-        )
-        if limit is None:
-            return User.query.filter(_filter).all()
-        else:
-            if type(limit) is not int:
-                raise UserServiceError('limit must be an integer')
-            return User.query.filter(_filter).limit(limit)
+        if limit is not None and type(limit) is not int:
+            raise UserServiceError('limit must be an integer')
+        return ranked_search(User.query.options(selectinload(User.groups)), [User.name, User.nickname, User.real_name],
+                             name, limit, User.name)
 
     @staticmethod
     def login(name_or_email, password, ip, user_agent):
@@ -152,7 +266,7 @@ class UserService:
                 else:
                     try:
                         if not user.external_auth_enforced:
-                            if not pbkdf2_sha256.verify(password, user.password):  # try local password first
+                            if not UserService._verify_login_password(user, password):  # try local password first
                                 if not auth_provider.check(user.name, password):  # then try external auth
                                     error = 'wrong password'
                                     error_detail = 'Both the local password and the external password (%s) of this ' \
@@ -169,15 +283,14 @@ class UserService:
                         error_detail = e.msg
                         if e.detail:
                             error_detail += ': ' + e.detail
-            elif not pbkdf2_sha256.verify(password, user.password):
+            elif not UserService._verify_login_password(user, password):
                 error = 'wrong password'
                 error_detail = 'Please use the password that you set during the E-mail ' \
                                'confirmation. If you forgot your password, please click the "Reset ' \
                                'Password" link below.'
 
         if error is not None:
-            from .login_record import LoginRecordService
-            LoginRecordService.add(user, ip, user_agent.string, False, error)
+            UserService._record_login_attempt(user, ip, user_agent, False, error)
             db.session.commit()
             raise UserServiceError(error, detail=error_detail)
 
@@ -185,13 +298,24 @@ class UserService:
 
         # two-factor authentication
         if user.is_two_factor_enabled:  # skip adding 'success' login record
+            db.session.commit()  # keep a rehashed password even if the second factor is never completed
             return user
 
-        from .login_record import LoginRecordService
-        LoginRecordService.add(user, ip, user_agent.string, True, None)
+        UserService._record_login_attempt(user, ip, user_agent, True, None)
         db.session.commit()
         return user
 
+    @staticmethod
+    def _verify_login_password(user: User, password: str) -> bool:
+        """Verify the local password, upgrading the stored hash in place if PASSWORD_HASHING.context deprecates it.
+
+        The upgraded hash encodes the same password, so password history and expiry are left alone.
+        """
+        matched, new_hash = verify_password_and_update(password, user.password)
+        if matched and new_hash is not None:
+            user.password = new_hash
+        return matched
+
     @staticmethod
     def two_factor_login(user: User, token, ip, user_agent):
         if user is None:
@@ -217,8 +341,7 @@ class UserService:
                 error = 'two-factor: %s' % e.msg
                 error_source = e
 
-        from .login_record import LoginRecordService
-        LoginRecordService.add(user, ip, user_agent.string, error is None, error)
+        UserService._record_login_attempt(user, ip, user_agent, error is None, error)
         db.session.commit()  # force commit, a little bit ugly
 
         if error is not None:
@@ -230,17 +353,21 @@ class UserService:
         UserService._check_password_not_expired_for_login(user)
 
     @staticmethod
-    def check_login_recent_failures(user: User, ip: str):
+    def _record_login_attempt(user: User, ip, user_agent, success: bool, reason):
         from .login_record import LoginRecordService
+        LoginRecordService.add(user, ip, user_agent.string, success, reason)  # audit trail
+        get_login_throttle().record_attempt(user, ip, success)
+
+    @staticmethod
+    def check_login_recent_failures(user: User, ip: str):
+        throttle = get_login_throttle()
         recent_failures_time_span = UserService.login_recent_failures_time_span
-        if LoginRecordService.count_recent_failures_for_user(user, recent_failures_time_span) >= \
-                UserService.login_user_recent_failures_lock_threshold:
+        if throttle.count_user_failures(user) >= UserService.login_user_recent_failures_lock_threshold:
             recent_failures_minutes = round(recent_failures_time_span.total_seconds() / 60)
             raise UserServiceError('too many recent failures',
                                    'User login banned temporarily. Please wait for at most %d minutes '
                                    'and then try again' % recent_failures_minutes)
-        if LoginRecordService.count_recent_failures_for_ip(ip, recent_failures_time_span) >= \
-                UserService.login_ip_recent_failures_lock_threshold:
+        if ip and throttle.count_ip_failures(ip) >= UserService.login_ip_recent_failures_lock_threshold:
             recent_failures_minutes = round(recent_failures_time_span.total_seconds() / 60)
             raise UserServiceError('too many recent failures',
                                    'IP login banned temporarily. Please wait for at most %d minutes '
@@ -259,7 +386,7 @@ class UserService:
         if check_reuse:
             check_password_not_reused(user, new_password)
         record_password_change(user)
-        user.password = pbkdf2_sha256.hash(new_password)
+        user.password = hash_password(new_password)
         refresh_password_expiry(user)
 
     @staticmethod
@@ -344,7 +471,7 @@ class UserService:
         if db.session.query(func.count()).filter(User.email == email).scalar():
             raise UserServiceError('duplicate email')
 
-        password = pbkdf2_sha256.hash(token_urlsafe(12))  # dummy initial password
+        password = hash_password(token_urlsafe(12))  # dummy initial password
         user_args = dict(name=name, password=password, email=email,
                          external_auth_provider_id=external_auth_provider_id,
                          external_auth_enforced=external_auth_enforced)
@@ -383,7 +510,7 @@ class UserService:
         if db.session.query(func.count()).filter(User.email == email).scalar():
             raise UserServiceError('duplicate email')
 
-        password_hash = pbkdf2_sha256.hash(password)
+        password_hash = hash_password(password)
         user = User(name=name, password=password_hash, email=email,
                     is_email_confirmed=True, email_confirmed_at=datetime.utcnow())
         db.session.add(user)
@@ -525,7 +652,7 @@ class UserService:
         UserService._validate_new_password(new_password)
         if not old_password:
             raise UserServiceError('require old password')
-        if not pbkdf2_sha256.verify(old_password, user.password):
+        if not verify_password(old_password, user.password):
             raise UserServiceError('wrong old password')
         UserService._apply_new_password(user, new_password)
 
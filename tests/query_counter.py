@@ -0,0 +1,25 @@
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy import event
+
+from models import db
+
+
+@contextmanager
+def count_queries() -> Iterator[list[str]]:
+    """Collect the SQL statements run on ``db.engine`` inside the block.
+
+    Pin an endpoint's query count with ``assertEqual(len(statements), n, statements)`` so the failure message
+    shows the statements when a change adds a query (typically a lazy load in a loop).
+    """
+    statements: list[str] = []
+
+    def record(conn, cursor, statement, *args) -> None:
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
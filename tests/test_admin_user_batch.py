@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from app import app as flask_app
+from models import Group, User, db
+from query_counter import count_queries
+
+
+class AdminUserBatchTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        admin = User(name='admin', email='admin@example.com', password='x', is_email_confirmed=True)
+        admin.groups.append(Group(name='admin'))
+        self.users = [User(name='user%d' % i, email='user%d@example.com' % i, password='x', nickname='U%d' % i)
+                      for i in range(5)]
+        db.session.add_all([admin] + self.users)
+        db.session.commit()
+        self.client = flask_app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = admin.id
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_resolves_names_and_ids_in_request_order(self) -> None:
+        ids = ','.join(str(user.id) for user in (self.users[4], self.users[0])) + ',9999'
+        response = self.client.get('/api/admin/users/batch', query_string={'names': 'user2,nobody,user0',
+                                                                           'ids': ids})
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual([user['name'] for user in body['users']], ['user2', 'user0', 'user4'])
+        self.assertEqual(set(body['users'][0]), {'id', 'name', 'email', 'nickname', 'real_name', 'avatar',
+                                                 'is_active'})
+        self.assertEqual(body['missing_names'], ['nobody'])
+        self.assertEqual(body['missing_ids'], [9999])
+
+    def test_unchanged_roster_is_not_modified(self) -> None:
+        params = {'names': ','.join(user.name for user in self.users)}
+        etag = self.client.get('/api/admin/users/batch', query_string=params).headers['ETag']
+
+        with flask_app.app_context(), count_queries() as statements:
+            response = self.client.get('/api/admin/users/batch', query_string=params,
+                                       headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(len([s for s in statements if 'IN (' in s]), 1)  # one lookup for the whole roster
+
+        self.users[3].nickname = 'renamed'
+        db.session.commit()
+        response = self.client.get('/api/admin/users/batch', query_string=params, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_rejects_bad_keys(self) -> None:
+        self.assertEqual(self.client.get('/api/admin/users/batch?ids=1,x').status_code, 400)
+        too_many = ','.join('u%d' % i for i in range(501))
+        self.assertEqual(self.client.get('/api/admin/users/batch', query_string={'names': too_many}).status_code,
+                         400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from app import app as flask_app
+from models import Group, User, db
+
+
+class AdminUserListTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.admin_group = Group(name='admin')
+        self.staff = Group(name='staff')
+        admin = User(name='admin', email='admin@example.com', password='x', is_email_confirmed=True,
+                     is_two_factor_enabled=True)
+        admin.groups.append(self.admin_group)
+        db.session.add_all([self.admin_group, self.staff, admin])
+        now = datetime.utcnow()
+        for i in range(6):
+            user = User(name='user%d' % i, email='user%d@example.com' % i, password='x', is_email_confirmed=True,
+                        is_active=i != 5, password_expires_at=now + timedelta(days=3 if i % 2 else 60))
+            if i < 3:
+                user.groups.append(self.staff)
+            db.session.add(user)
+        db.session.commit()
+        self.client = flask_app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = admin.id
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _names(self, **params) -> list[str]:
+        response = self.client.get('/api/admin/users', query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return [user['name'] for user in response.get_json()['users']]
+
+    def test_keyset_pages_cover_every_user_once(self) -> None:
+        names, cursor = [], None
+        while True:
+            params = {'limit': 3} if cursor is None else {'limit': 3, 'cursor': cursor}
+            page = self.client.get('/api/admin/users', query_string=params).get_json()
+            names += [user['name'] for user in page['users']]
+            self.assertEqual({g['id'] for g in page['groups']},
+                             {gid for user in page['users'] for gid in user['group_ids']})
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(names, ['admin'] + ['user%d' % i for i in range(6)])
+
+    def test_filters(self) -> None:
+        self.assertEqual(self._names(active='false'), ['user5'])
+        self.assertEqual(self._names(group=self.staff.id), ['user0', 'user1', 'user2'])
+        self.assertEqual(self._names(two_factor='true'), ['admin'])
+        self.assertEqual(self._names(expiry_status='warning_1week', active='true'), ['user1', 'user3'])
+        self.assertEqual(self._names(expiry_status='none'), ['admin', 'user0', 'user2', 'user4'])
+        for params in ({'limit': 0}, {'active': 'yes'}, {'expiry_status': 'soon'}, {'cursor': 'x'}):
+            self.assertEqual(self.client.get('/api/admin/users', query_string=params).status_code, 400)
+
+    def test_ndjson_stream(self) -> None:
+        response = self.client.get('/api/admin/users', query_string={'format': 'ndjson', 'group': self.staff.id})
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        users = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([user['name'] for user in users], ['user0', 'user1', 'user2'])
+        self.assertEqual(users[0]['groups'][0]['name'], 'staff')
+        self.assertEqual(users[1]['password_expiry_status'], 'warning_1week')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,27 +26,17 @@ class CaptchaUtilsTests(unittest.TestCase):
         flask_app.config['CAPTCHA'] = {'enabled': False}
         self.assertFalse(is_captcha_enabled())
 
-    @patch('utils.captcha.LoginRecordService.count_recent_failures_for_user')
-    @patch('utils.captcha.LoginRecordService.count_recent_failures_for_ip')
-    def test_required_after_user_failure(
-        self,
-        mock_ip: MagicMock,
-        mock_user: MagicMock,
-    ) -> None:
+    @patch('utils.captcha.get_login_throttle')
+    def test_required_after_user_failure(self, mock_throttle: MagicMock) -> None:
         user = MagicMock(spec=User)
-        mock_user.return_value = 1
-        mock_ip.return_value = 0
+        mock_throttle.return_value.count_user_failures.return_value = 1
+        mock_throttle.return_value.count_ip_failures.return_value = 0
         self.assertTrue(captcha_required_for_login(user, '10.0.0.1'))
 
-    @patch('utils.captcha.LoginRecordService.count_recent_failures_for_user')
-    @patch('utils.captcha.LoginRecordService.count_recent_failures_for_ip')
-    def test_not_required_without_failures(
-        self,
-        mock_ip: MagicMock,
-        mock_user: MagicMock,
-    ) -> None:
-        mock_user.return_value = 0
-        mock_ip.return_value = 0
+    @patch('utils.captcha.get_login_throttle')
+    def test_not_required_without_failures(self, mock_throttle: MagicMock) -> None:
+        mock_throttle.return_value.count_user_failures.return_value = 0
+        mock_throttle.return_value.count_ip_failures.return_value = 0
         self.assertFalse(captcha_required_for_login(None, '10.0.0.1'))
 
     @patch('utils.captcha._call_captcha_service')
@@ -82,16 +72,10 @@ class CaptchaUtilsTests(unittest.TestCase):
         mock_call.return_value = False
         self.assertFalse(verify_captcha('00000000-0000-4000-8000-000000000099', '1234', '1.2.3.4'))
 
-
-    @patch('utils.captcha.LoginRecordService.count_recent_failures_for_user')
-    @patch('utils.captcha.LoginRecordService.count_recent_failures_for_ip')
-    def test_required_after_ip_failure(
-        self,
-        mock_ip: MagicMock,
-        mock_user: MagicMock,
-    ) -> None:
-        mock_user.return_value = 0
-        mock_ip.return_value = 2
+    @patch('utils.captcha.get_login_throttle')
+    def test_required_after_ip_failure(self, mock_throttle: MagicMock) -> None:
+        mock_throttle.return_value.count_user_failures.return_value = 0
+        mock_throttle.return_value.count_ip_failures.return_value = 2
         self.assertTrue(captcha_required_for_login(None, '10.0.0.2'))
 
 
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+from app import app as flask_app
+from models import Group, OAuthClient, User, db
+from services.oauth_eligibility import reset_eligibility_index
+
+
+class ConditionalRequestTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        reset_eligibility_index()
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.admin_group, self.staff = Group(name='admin'), Group(name='staff')
+        self.admin = User(name='admin', email='admin@example.com', password='x', is_email_confirmed=True)
+        self.admin.groups.append(self.admin_group)
+        self.client = OAuthClient(name='app', secret='s', redirect_url='http://app/cb', home_url='http://app')
+        db.session.add_all([self.admin_group, self.staff, self.admin, self.client])
+        db.session.commit()
+        self.http = flask_app.test_client()
+        with self.http.session_transaction() as sess:
+            sess['user_id'] = self.admin.id
+
+    def tearDown(self) -> None:
+        reset_eligibility_index()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _assert_revalidates(self, url: str, change) -> None:
+        first = self.http.get(url)
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers['ETag']
+        with flask_app.app_context():  # fresh session, as in production
+            unchanged = self.http.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged.headers['ETag'], etag)
+        for response in (first, unchanged):
+            self.assertEqual(response.headers['Cache-Control'], 'no-cache, private')
+
+        change()
+        db.session.commit()
+        with flask_app.app_context():
+            changed = self.http.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200, url)
+        self.assertEqual(changed.get_json(), self.http.get(url).get_json())
+
+    def test_me_follows_profile_and_membership(self) -> None:
+        self._assert_revalidates('/api/account/me', lambda: setattr(self.admin, 'nickname', 'Boss'))
+        self._assert_revalidates('/api/account/me', lambda: self.admin.groups.append(self.staff))
+        self._assert_revalidates('/api/account/me', lambda: setattr(self.staff, 'description', 'Staff'))
+
+    def test_admin_resources(self) -> None:
+        self._assert_revalidates('/api/admin/users/%d' % self.admin.id, lambda: self.admin.groups.append(self.staff))
+        self._assert_revalidates('/api/admin/groups/%d?oauth-info=true' % self.staff.id,
+                                 lambda: self.client.allowed_groups.append(self.staff))
+        self._assert_revalidates('/api/oauth/clients/%d' % self.client.id,
+                                 lambda: setattr(self.client, 'description', 'An app'))
+
+    def test_user_etag_varies_with_oauth_info(self) -> None:
+        url = '/api/admin/users/%d' % self.admin.id
+        etag = self.http.get(url).headers['ETag']
+        response = self.http.get(url + '?oauth-info=true', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
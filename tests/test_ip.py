@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from geoip2.errors import AddressNotFoundError
+from geoip2.models import Country
+
+import utils.ip as ip
+from app import app as flask_app
+
+
+class _FakeReader:
+    def __init__(self) -> None:
+        self.calls = []
+
+    def country(self, addr: str) -> Country:
+        self.calls.append(addr)
+        if addr.startswith('10.'):
+            raise AddressNotFoundError('not found', addr)
+        return Country(['en'], country={'iso_code': 'AU', 'names': {'en': 'Australia'}})
+
+
+class GeoCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.reader = _FakeReader()
+        patcher = mock.patch.object(ip._geo_country_db, 'get_reader', return_value=self.reader)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        ip.reset_geo_cache()
+        self.addCleanup(ip.reset_geo_cache)
+
+    def test_results_and_misses_are_cached(self) -> None:
+        for _ in range(3):
+            self.assertEqual(ip.get_geo_country('1.2.3.4').country.iso_code, 'AU')
+            self.assertIsNone(ip.get_geo_country('10.0.0.1'))
+        self.assertEqual(self.reader.calls, ['1.2.3.4', '10.0.0.1'])
+
+        stats = ip.get_geo_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['reader_lookups']), (4, 2, 2))
+        self.assertIsNotNone(stats['reader_mean_ms'])
+
+    def test_cache_is_bounded(self) -> None:
+        with flask_app.app_context():
+            saved = flask_app.config.get('GEOIP')
+            flask_app.config['GEOIP'] = {'cache_size': 2}
+            try:
+                for addr in ('1.1.1.1', '2.2.2.2', '3.3.3.3', '1.1.1.1'):
+                    ip.get_geo_country(addr)
+            finally:
+                flask_app.config['GEOIP'] = saved
+        self.assertEqual(self.reader.calls, ['1.1.1.1', '2.2.2.2', '3.3.3.3', '1.1.1.1'])
+        self.assertEqual(ip.get_geo_stats()['size'], 2)
+
+    def test_lookup_many(self) -> None:
+        result = ip.lookup_many(['1.2.3.4', '10.0.0.1', '1.2.3.4'], country_only=True)
+        self.assertEqual(result, {'1.2.3.4': {'name': 'Australia', 'iso_code': 'AU'}, '10.0.0.1': {}})
+        self.assertEqual(result['1.2.3.4'], ip.get_ip_country_info('1.2.3.4').to_dict())
+        self.assertEqual(sorted(self.reader.calls), ['1.2.3.4', '10.0.0.1'])
+
+
+class GeoDatabaseReloadTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, 'GeoLite2-Country.mmdb')
+        self.db = ip._GeoDatabase(self.path, 'Country')
+        reader_patcher = mock.patch.object(ip.geoip2.database, 'Reader', side_effect=lambda path, mode: object())
+        self.opened = reader_patcher.start()
+        self.addCleanup(reader_patcher.stop)
+        interval_patcher = mock.patch.object(ip, '_reload_check_seconds', return_value=0)  # check on every lookup
+        interval_patcher.start()
+        self.addCleanup(interval_patcher.stop)
+        ip.reset_geo_cache()
+        self.addCleanup(ip.reset_geo_cache)
+
+    def _write(self, content: bytes) -> None:
+        tmp = self.path + '.part'
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, self.path)  # as scripts/download-mmdb.sh does
+
+    def test_reopens_memory_mapped_reader_when_the_file_is_replaced(self) -> None:
+        self.assertIsNone(self.db.get_reader())  # not downloaded yet
+
+        self._write(b'first')
+        first = self.db.get_reader()
+        self.assertIsNotNone(first)
+        self.assertIn(self.opened.call_args.kwargs['mode'], (ip.maxminddb.MODE_MMAP, ip.maxminddb.MODE_MMAP_EXT))
+        self.assertIs(self.db.get_reader(), first)
+        self.assertEqual(self.opened.call_count, 1)
+
+        ip._get_geo_cache().put(('Country', '1.2.3.4'), 'stale')
+        ip._get_geo_cache().put(('City', '1.2.3.4'), 'kept')
+        self._write(b'second')
+        second = self.db.get_reader()
+        self.assertIsNot(second, first)
+        self.assertIsNone(ip._get_geo_cache().get(('Country', '1.2.3.4')))
+        self.assertEqual(ip._get_geo_cache().get(('City', '1.2.3.4')), 'kept')
+
+        os.unlink(self.path)
+        self.assertIs(self.db.get_reader(), second)  # keeps serving what it mapped
+
+
+if __name__ == '__main__':
+    unittest.main()
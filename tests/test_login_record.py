@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from passlib.hash import pbkdf2_sha256
+
+from app import app as flask_app
+from models import LoginRecord, User, db
+from services.login_record import LoginRecordService
+
+_SPAN = timedelta(minutes=15)
+
+
+class LoginRecordFailureCountTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.user = User(name='loginuser', email='login@example.com', password=pbkdf2_sha256.hash('OldPass123'))
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _add(self, success: bool, ip: str = '10.0.0.1', age: timedelta = timedelta()) -> None:
+        db.session.add(LoginRecord(user_id=self.user.id, ip=ip, success=success,
+                                   time=datetime.utcnow() - age))
+        db.session.commit()
+
+    def test_counts_failures_after_latest_success(self) -> None:
+        self._add(False)
+        self._add(True)
+        self._add(False)
+        self._add(False)
+        self.assertEqual(LoginRecordService.count_recent_failures_for_user(self.user, _SPAN), 2)
+        self.assertEqual(LoginRecordService.count_recent_failures_for_ip('10.0.0.1', _SPAN), 2)
+
+    def test_success_resets_count(self) -> None:
+        self._add(False)
+        self._add(True)
+        self.assertEqual(LoginRecordService.count_recent_failures_for_user(self.user, _SPAN), 0)
+
+    def test_ignores_records_outside_window(self) -> None:
+        self._add(False, age=timedelta(minutes=30))
+        self._add(False)
+        self.assertEqual(LoginRecordService.count_recent_failures_for_user(self.user, _SPAN), 1)
+
+    def test_ip_count_is_independent_of_other_ips(self) -> None:
+        self._add(False, ip='10.0.0.2')
+        self._add(True, ip='10.0.0.1')
+        self._add(False, ip='10.0.0.2')
+        self.assertEqual(LoginRecordService.count_recent_failures_for_ip('10.0.0.2', _SPAN), 2)
+        self.assertEqual(LoginRecordService.count_recent_failures_for_ip('10.0.0.1', _SPAN), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
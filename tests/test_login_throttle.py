@@ -0,0 +1,104 @@
+import unittest
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+import redis
+
+from app import app as flask_app
+from models import User
+from services.login_throttle import (
+    DatabaseLoginThrottle,
+    MemoryLoginThrottle,
+    RedisLoginThrottle,
+    get_login_throttle,
+    reset_login_throttle,
+)
+
+
+def _user(uid: int) -> User:
+    return User(id=uid)
+
+
+class MemoryLoginThrottleTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.throttle = MemoryLoginThrottle(timedelta(minutes=15))
+
+    def test_counts_failures_per_user_and_ip(self) -> None:
+        self.throttle.record_attempt(_user(1), '10.0.0.1', False)
+        self.throttle.record_attempt(_user(2), '10.0.0.1', False)
+        self.assertEqual(self.throttle.count_user_failures(_user(1)), 1)
+        self.assertEqual(self.throttle.count_ip_failures('10.0.0.1'), 2)
+        self.assertEqual(self.throttle.count_ip_failures('10.0.0.2'), 0)
+
+    def test_success_resets_counters(self) -> None:
+        self.throttle.record_attempt(_user(1), '10.0.0.1', False)
+        self.throttle.record_attempt(_user(1), '10.0.0.1', True)
+        self.assertEqual(self.throttle.count_user_failures(_user(1)), 0)
+        self.assertEqual(self.throttle.count_ip_failures('10.0.0.1'), 0)
+
+    def test_failures_leave_the_window(self) -> None:
+        throttle = MemoryLoginThrottle(timedelta(seconds=10))
+        with patch('services.login_throttle.time.monotonic', return_value=100.0):
+            throttle.record_attempt(_user(1), None, False)
+        with patch('services.login_throttle.time.monotonic', return_value=111.0):
+            self.assertEqual(throttle.count_user_failures(_user(1)), 0)
+
+    def test_key_count_is_bounded(self) -> None:
+        throttle = MemoryLoginThrottle(timedelta(minutes=15), max_keys=2)
+        for i in range(3):
+            throttle.record_attempt(_user(1), '10.0.0.%d' % i, False)
+        self.assertEqual(throttle.count_ip_failures('10.0.0.0'), 0)
+        self.assertEqual(throttle.count_ip_failures('10.0.0.2'), 1)
+
+
+class RedisLoginThrottleTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = MagicMock()
+        with patch('redis.Redis.from_url', return_value=self.client):
+            self.throttle = RedisLoginThrottle(timedelta(minutes=15), 'redis://localhost/1', key_prefix='t:')
+
+    def test_failure_updates_sorted_set(self) -> None:
+        self.throttle.record_attempt(_user(7), '10.0.0.1', False)
+        pipe = self.client.pipeline.return_value
+        self.assertEqual([c.args[0] for c in pipe.zadd.call_args_list], ['t:user:7', 't:ip:10.0.0.1'])
+        pipe.expire.assert_called_with('t:ip:10.0.0.1', 900)
+
+    def test_success_deletes_keys(self) -> None:
+        self.throttle.record_attempt(_user(7), '10.0.0.1', True)
+        self.assertEqual([c.args[0] for c in self.client.delete.call_args_list], ['t:user:7', 't:ip:10.0.0.1'])
+
+    def test_count_falls_back_to_login_records(self) -> None:
+        self.client.zcount.side_effect = redis.ConnectionError('down')
+        with patch.object(DatabaseLoginThrottle, 'count_ip_failures', return_value=4) as fallback:
+            self.assertEqual(self.throttle.count_ip_failures('10.0.0.1'), 4)
+        fallback.assert_called_once_with('10.0.0.1')
+
+
+class LoginThrottleConfigTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        self.original = flask_app.config.get('LOGIN_THROTTLE')
+        reset_login_throttle()
+
+    def tearDown(self) -> None:
+        flask_app.config['LOGIN_THROTTLE'] = self.original
+        reset_login_throttle()
+        self.ctx.pop()
+
+    def test_defaults_to_database(self) -> None:
+        flask_app.config['LOGIN_THROTTLE'] = None
+        self.assertIsInstance(get_login_throttle(), DatabaseLoginThrottle)
+
+    def test_memory_backend(self) -> None:
+        flask_app.config['LOGIN_THROTTLE'] = {'backend': 'memory'}
+        self.assertIsInstance(get_login_throttle(), MemoryLoginThrottle)
+
+    def test_redis_backend_requires_url(self) -> None:
+        flask_app.config['LOGIN_THROTTLE'] = {'backend': 'redis'}
+        with self.assertRaises(ValueError):
+            get_login_throttle()
+
+
+if __name__ == '__main__':
+    unittest.main()
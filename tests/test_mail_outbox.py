@@ -0,0 +1,182 @@
+import os
+import smtplib
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+from app import app as flask_app
+from models import Group, MailJob, MailOutbox, User, db
+from services.mail_outbox import deliver_outbox_batch, get_retry_delay, run_mail_worker
+from utils.mail import MailTransport, commit_and_send_email, send_email, send_emails
+
+
+class _MailOutboxTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original_mail = flask_app.config.get('MAIL')
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        flask_app.config['MAIL'] = {
+            'enabled': True, 'from': 'noreply@example.com', 'display_name': 'Identity',
+            'mail_catcher': {'host': 'localhost', 'port': 1025},
+            'outbox': {'enabled': True, 'batch_size': 10, 'max_attempts': 2, 'retry_base_seconds': 60},
+        }
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self) -> None:
+        flask_app.config['MAIL'] = self.original_mail
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _enqueue(self, count: int) -> None:
+        for i in range(count):
+            send_email('User %d' % i, 'user%d@example.com' % i, None, subject='Hi', body='Hello')
+        db.session.commit()
+
+
+class MailOutboxTests(_MailOutboxTestCase):
+    def test_send_only_enqueues(self) -> None:
+        with patch('utils.mail.smtplib.SMTP') as smtp, patch('utils.mail.Popen') as popen:
+            send_emails([], [], [('A', 'a@example.com'), ('B', 'b@example.com')], None, subject='S', body='B')
+            db.session.commit()
+        smtp.assert_not_called()
+        popen.assert_not_called()
+        entry = MailOutbox.query.one()
+        self.assertEqual(entry.status, 'pending')
+        self.assertIn(b'Bcc: A <a@example.com>, B <b@example.com>', entry.message)
+
+    def test_commit_and_send_queues_with_the_change(self) -> None:
+        db.session.add(User(name='queued', email='queued@example.com', password='x'))
+        with patch('utils.mail.smtplib.SMTP') as smtp:
+            commit_and_send_email('Queued', 'queued@example.com', None, subject='S', body='B')
+        smtp.assert_not_called()
+        self.assertEqual(MailOutbox.query.count(), 1)
+        self.assertEqual(User.query.count(), 1)
+
+    def test_commit_and_send_delivers_after_commit_without_outbox(self) -> None:
+        flask_app.config['MAIL'] = {**flask_app.config['MAIL'], 'outbox': {'enabled': False}}
+        db.session.add(User(name='direct', email='direct@example.com', password='x'))
+        pending_at_send = []
+        with patch('utils.mail.smtplib.SMTP') as smtp:
+            smtp.return_value.send_message.side_effect = lambda msg: pending_at_send.append(bool(db.session.new))
+            commit_and_send_email('Direct', 'direct@example.com', None, subject='S', body='B')
+        self.assertEqual(pending_at_send, [False])
+        self.assertEqual(MailOutbox.query.count(), 0)
+
+    def test_batch_reuses_one_smtp_session(self) -> None:
+        self._enqueue(3)
+        with patch('utils.mail.smtplib.SMTP') as smtp:
+            with MailTransport(flask_app.config['MAIL']) as transport:
+                self.assertEqual(deliver_outbox_batch(transport), (3, 0))
+        smtp.assert_called_once()
+        self.assertEqual(smtp.return_value.send_message.call_count, 3)
+        self.assertEqual(MailOutbox.query.count(), 0)
+
+    def test_failure_is_retried_with_backoff_then_marked_failed(self) -> None:
+        self._enqueue(1)
+        with patch('utils.mail.smtplib.SMTP') as smtp:
+            smtp.return_value.send_message.side_effect = smtplib.SMTPDataError(451, b'try later')
+            with MailTransport(flask_app.config['MAIL']) as transport:
+                self.assertEqual(deliver_outbox_batch(transport), (0, 1))
+                entry = MailOutbox.query.one()
+                self.assertEqual(entry.attempts, 1)
+                self.assertGreater(entry.next_attempt_at, datetime.utcnow() + timedelta(seconds=50))
+                self.assertEqual(deliver_outbox_batch(transport), (0, 0))  # not due yet
+
+                entry.next_attempt_at = datetime.utcnow()
+                db.session.commit()
+                self.assertEqual(deliver_outbox_batch(transport), (0, 1))
+        entry = MailOutbox.query.one()
+        self.assertEqual(entry.status, 'failed')
+        self.assertIn('try later', entry.last_error)
+
+    def test_retry_delay_is_capped(self) -> None:
+        flask_app.config['MAIL']['outbox'].update(retry_base_seconds=30, retry_max_seconds=100)
+        self.assertEqual(get_retry_delay(1), timedelta(seconds=30))
+        self.assertEqual(get_retry_delay(2), timedelta(seconds=60))
+        self.assertEqual(get_retry_delay(5), timedelta(seconds=100))
+
+    def test_worker_once_drains_in_batches(self) -> None:
+        self._enqueue(25)
+        with patch('utils.mail.smtplib.SMTP') as smtp:
+            run_mail_worker(batch_size=10, once=True)
+        smtp.assert_called_once()
+        self.assertEqual(smtp.return_value.send_message.call_count, 25)
+        self.assertEqual(MailOutbox.query.count(), 0)
+
+    def test_reconnects_after_server_disconnect(self) -> None:
+        sessions = [MagicMock(), MagicMock()]
+        sessions[0].send_message.side_effect = smtplib.SMTPServerDisconnected()
+        self._enqueue(1)
+        with patch('utils.mail.smtplib.SMTP', side_effect=sessions):
+            with MailTransport(flask_app.config['MAIL']) as transport:
+                self.assertEqual(deliver_outbox_batch(transport), (1, 0))
+        sessions[1].send_message.assert_called_once()
+
+
+class BroadcastJobTests(_MailOutboxTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        flask_app.config['MAIL']['broadcast'] = {'batch_size': 2}
+        flask_app.config['MAIL']['outbox']['max_attempts'] = 1
+        admin_group = Group(name='admin')
+        members = Group(name='members')
+        self.admin = User(name='admin', email='admin@example.com', password='x', is_email_confirmed=True)
+        self.admin.groups.append(admin_group)
+        for i in range(5):
+            member = User(name='member%d' % i, email='member%d@example.com' % i, password='x',
+                          is_email_confirmed=True)
+            member.groups.append(members)
+            db.session.add(member)
+        db.session.add_all([self.admin, admin_group, members])
+        db.session.commit()
+        self.client = flask_app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = self.admin.id
+
+    def test_broadcast_is_chunked_and_reports_progress(self) -> None:
+        response = self.client.post('/api/admin/send-email', json={
+            'subject': 'News', 'body': 'Hello all', 'receiver_groups': 'members'})
+        self.assertEqual(response.status_code, 202)
+        job = response.get_json()['job']
+        self.assertEqual((job['num_recipients'], job['num_chunks'], job['status']), (5, 3, 'running'))
+        self.assertEqual([c.num_recipients for c in MailOutbox.query.order_by(MailOutbox.id)], [2, 2, 1])
+
+        session = MagicMock()
+        session.send_message.side_effect = [None, smtplib.SMTPRecipientsRefused({}), None]
+        with patch('utils.mail.smtplib.SMTP', return_value=session) as smtp:
+            run_mail_worker(once=True)
+        self.assertEqual(smtp.call_count, 2)  # reconnects only after the failed chunk
+
+        status = self.client.get('/api/admin/mail-jobs/%d' % job['id']).get_json()
+        self.assertEqual(status['job']['sent_chunks'], 2)
+        self.assertEqual(status['job']['failed_chunks'], 1)
+        self.assertEqual(status['job']['status'], 'failed')
+        self.assertIsNotNone(status['job']['finished_at'])
+        self.assertEqual(len(status['outstanding_chunks']), 1)
+        self.assertEqual(status['outstanding_chunks'][0]['status'], 'failed')
+        self.assertIn('SMTPRecipientsRefused', status['outstanding_chunks'][0]['last_error'])
+
+    def test_without_outbox_job_is_delivered_in_background(self) -> None:
+        flask_app.config['MAIL']['outbox']['enabled'] = False
+        with patch('utils.mail.smtplib.SMTP') as smtp, \
+                patch('api_admin.deliver_job_in_background', side_effect=lambda job_id: run_mail_worker(
+                    job_id=job_id)) as background:
+            response = self.client.post('/api/admin/send-email', json={
+                'subject': 'News', 'body': 'Hello all', 'receiver_groups': 'members'})
+        self.assertEqual(response.status_code, 202)
+        background.assert_called_once()
+        self.assertEqual(smtp.return_value.send_message.call_count, 3)
+        self.assertEqual(db.session.get(MailJob, response.get_json()['job']['id']).status, 'done')
+
+    def test_unknown_job(self) -> None:
+        self.assertEqual(self.client.get('/api/admin/mail-jobs/999').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
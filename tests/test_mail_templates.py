@@ -0,0 +1,85 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from app import app as flask_app
+from models import User
+from utils.mail_templates import (
+    compile_format,
+    compile_html,
+    get_mail_template,
+    invalidate_mail_templates,
+    load_mail_template,
+)
+
+
+class MailTemplateTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original_mail = flask_app.config.get('MAIL')
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        self.user = User(id=7, name='alice', email='alice@example.com', email_confirm_token='ect',
+                         password_reset_token='prt', two_factor_disable_token='tdt',
+                         password_expires_at=datetime(2030, 1, 2, 3, 4))
+        self.values = dict(user=self.user, user_display_name='Alice', site=dict(
+            root_url='https://id.example', base_url='/', name='Identity'))
+
+    def tearDown(self) -> None:
+        invalidate_mail_templates()
+        flask_app.config['MAIL'] = self.original_mail
+        self.ctx.pop()
+
+    def test_compiled_templates_match_str_format(self) -> None:
+        for file_name in os.listdir('mail_templates'):
+            if not file_name.endswith('.txt'):
+                continue
+            with open(os.path.join('mail_templates', file_name)) as f:
+                source = f.read()
+            self.assertEqual(compile_format(source).render(self.values), source.format(**self.values), file_name)
+
+    def test_format_features(self) -> None:
+        plan = compile_format('{{x}} {user.id:>4} {user.name!r} {site[name]} {user.id:{width}}')
+        self.assertEqual(plan.render(dict(self.values, width=3)), '{x}    7 \'alice\' Identity   7')
+        with self.assertRaises(ValueError):
+            compile_format('{} {0}')
+        with self.assertRaises(ValueError):
+            compile_format('{user.}')
+        with self.assertRaises(KeyError):
+            compile_format('{missing}').render(self.values)
+
+    def test_html_only_interpolates_double_braces(self) -> None:
+        source = ('<style>p { color: red; }</style>'
+                  '<a href="{{site[root_url]}}?uid={{user.id}}">{{user_display_name}}</a>')
+        expected = re.sub(r"(\{\{[^}]+\}\})", lambda m: m.group(1)[1:-1].format(**self.values), source)
+        self.assertEqual(compile_html(source).render(self.values), expected)
+
+    def test_reload_and_invalidate(self) -> None:
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'hello.txt')
+        with open(path, 'w') as f:
+            f.write('Hi {user.name}\nBody')
+        self.assertEqual(get_mail_template('hello', folder).subject.render(self.values), 'Hi alice')
+
+        with open(path, 'w') as f:
+            f.write('Hello {user.name}\nBody')
+        os.utime(path, (0, 0))
+        flask_app.config['MAIL'] = dict(flask_app.config.get('MAIL') or {}, reload_templates=False)
+        self.assertEqual(get_mail_template('hello', folder).subject.render(self.values), 'Hi alice')
+        flask_app.config['MAIL']['reload_templates'] = True
+        self.assertEqual(get_mail_template('hello', folder).subject.render(self.values), 'Hello alice')
+
+        flask_app.config['MAIL']['reload_templates'] = False
+        with open(path, 'w') as f:
+            f.write('Hey {user.name}\nBody')
+        os.utime(path, (0, 0))
+        invalidate_mail_templates('hello')
+        self.assertEqual(get_mail_template('hello', folder).subject.render(self.values), 'Hey alice')
+        self.assertIsNone(load_mail_template('hello', folder).html)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+import redis
+
+from app import app as flask_app
+from models import OAuthAuthorization, OAuthClient, User, db
+from query_counter import count_queries
+from services.oauth import OAuthService, OAuthServiceError
+from services.oauth_auth_code import (
+    AuthCodeError,
+    AuthorizationCode,
+    MemoryAuthCodeStore,
+    RedisAuthCodeStore,
+    reset_auth_code_store,
+)
+from services.oauth_eligibility import reset_eligibility_index
+
+
+def _writes(statements: list[str]) -> list[str]:
+    return [statement for statement in statements if not statement.lstrip().upper().startswith('SELECT')]
+
+
+class MemoryAuthCodeStoreTests(unittest.TestCase):
+    def test_codes_are_single_use_and_bound_to_the_client(self) -> None:
+        store = MemoryAuthCodeStore(timedelta(seconds=60))
+        code = store.issue(1, 7)
+        self.assertEqual(store.redeem(code, 1), AuthorizationCode(1, 7))
+        with self.assertRaises(AuthCodeError):
+            store.redeem(code, 1)
+        with self.assertRaises(AuthCodeError):
+            store.redeem(store.issue(1, 7), 2)
+
+    def test_codes_expire_and_are_bounded(self) -> None:
+        store = MemoryAuthCodeStore(timedelta(seconds=60), max_codes=2)
+        with patch('services.oauth_auth_code.time.monotonic', return_value=100.0):
+            expired = store.issue(1, 7)
+        with patch('services.oauth_auth_code.time.monotonic', return_value=161.0):
+            with self.assertRaises(AuthCodeError):
+                store.redeem(expired, 1)
+            codes = [store.issue(1, user_id) for user_id in range(3)]
+            with self.assertRaises(AuthCodeError):
+                store.redeem(codes[0], 1)
+            self.assertEqual(store.redeem(codes[2], 1).user_id, 2)
+
+    def test_discard_user_codes(self) -> None:
+        store = MemoryAuthCodeStore(timedelta(seconds=60))
+        mine, other = store.issue(1, 7), store.issue(1, 8)
+        store.discard_user_codes(7)
+        with self.assertRaises(AuthCodeError):
+            store.redeem(mine, 1)
+        store.redeem(other, 1)
+
+
+class RedisAuthCodeStoreTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = MagicMock()
+        with patch('redis.Redis.from_url', return_value=self.client):
+            self.store = RedisAuthCodeStore(timedelta(seconds=60), 'redis://localhost/2', key_prefix='t:')
+
+    def test_issue_sets_key_with_ttl(self) -> None:
+        pipe = self.client.pipeline.return_value
+        pipe.execute.return_value = [True, 1, True]
+        code = self.store.issue(3, 9)
+        pipe.set.assert_called_once_with('t:code:' + code, '3:9', ex=60, nx=True)
+        pipe.sadd.assert_called_once_with('t:user:9', code)
+
+    def test_redeem_uses_getdel(self) -> None:
+        self.client.getdel.return_value = b'3:9'
+        self.assertEqual(self.store.redeem('abc', 3), AuthorizationCode(3, 9))
+        self.client.getdel.assert_called_once_with('t:code:abc')
+        with self.assertRaises(AuthCodeError):
+            self.store.redeem('abc', 4)
+
+    def test_falls_back_to_database_when_redis_is_down(self) -> None:
+        self.client.pipeline.return_value.execute.side_effect = redis.ConnectionError('down')
+        with patch.object(self.store._fallback, 'issue', return_value='db-code') as issue:
+            self.assertEqual(self.store.issue(3, 9), 'db-code')
+        issue.assert_called_once_with(3, 9)
+
+
+class AuthCodeHandshakeTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original_auth_codes = flask_app.config.get('OAUTH_AUTH_CODES')
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        flask_app.config['OAUTH_AUTH_CODES'] = {'backend': 'memory'}
+        reset_auth_code_store()
+        reset_eligibility_index()
+        self.ctx = flask_app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.user = User(name='codeuser', email='code@example.com', password='x', is_email_confirmed=True)
+        self.client = OAuthClient(name='app', secret='s', redirect_url='http://app/cb', home_url='http://app',
+                                  is_public=True)
+        db.session.add_all([self.user, self.client])
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        flask_app.config['OAUTH_AUTH_CODES'] = self.original_auth_codes
+        reset_auth_code_store()
+        reset_eligibility_index()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_only_the_access_grant_is_written(self) -> None:
+        with count_queries() as connect_statements:
+            code = OAuthService.start_authorization(self.client, self.user, 'http://app/cb')
+            db.session.commit()
+        with count_queries() as token_statements:
+            access_token = OAuthService.get_access_token(self.client, 's', 'http://app/cb', code)
+            db.session.commit()
+        self.assertEqual(_writes(connect_statements), [])
+        self.assertEqual(len(_writes(token_statements)), 1)
+        self.assertEqual(OAuthAuthorization.query.one().access_token, access_token)
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService.get_access_token(self.client, 's', 'http://app/cb', code)
+        self.assertEqual(ctx.exception.msg, 'invalid authorization token')
+
+    def test_logout_discards_outstanding_codes(self) -> None:
+        code = OAuthService.start_authorization(self.client, self.user, 'http://app/cb')
+        OAuthService.clear_user_tokens(self.user)
+        with self.assertRaises(OAuthServiceError):
+            OAuthService.get_access_token(self.client, 's', 'http://app/cb', code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+
+from app import app as flask_app
+from models import Group, OAuthAclChange, OAuthClient, User, db
+from query_counter import count_queries
+from services.oauth import OAuthService, OAuthServiceError
+from services.oauth_eligibility import (
+    EligibilityIndex,
+    get_eligibility_index,
+    record_acl_change,
+    reset_eligibility_index,
+)
+
+
+class OAuthEligibilityTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original_eligibility = flask_app.config.get('OAUTH_ELIGIBILITY')
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        flask_app.config['OAUTH_ELIGIBILITY'] = {'check_interval_seconds': 0}
+        reset_eligibility_index()
+        self.ctx = flask_app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.admin_group = Group(name='admin')
+        self.staff = Group(name='staff')
+        self.admin = User(name='admin', email='admin@example.com', password='x', is_email_confirmed=True)
+        self.admin.groups.append(self.admin_group)
+        self.user = User(name='member', email='member@example.com', password='x', is_email_confirmed=True)
+        self.public_client = OAuthClient(name='wiki', secret='s', redirect_url='http://wiki/cb',
+                                         home_url='http://wiki', is_public=True)
+        self.private_client = OAuthClient(name='payroll', secret='s', redirect_url='http://payroll/cb',
+                                          home_url='http://payroll', is_public=False)
+        self.private_client.allowed_groups.append(self.staff)
+        db.session.add_all([self.admin_group, self.staff, self.admin, self.user, self.public_client,
+                            self.private_client])
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        flask_app.config['OAUTH_ELIGIBILITY'] = self.original_eligibility
+        reset_eligibility_index()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _client_names(self, user: User) -> list[str]:
+        return sorted(client.name for client in OAuthService.get_clients_for_user(user))
+
+    def test_eligibility_is_a_set_intersection(self) -> None:
+        self.assertEqual(self._client_names(self.user), ['wiki'])
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService._check_user_eligibility(self.private_client, self.user)
+        self.assertEqual(ctx.exception.msg, 'permission denied')
+
+        self.user.groups.append(self.staff)
+        record_acl_change(user_id=self.user.id)
+        db.session.commit()
+        OAuthService._check_user_eligibility(self.private_client, self.user)
+        self.assertEqual(self._client_names(self.user), ['payroll', 'wiki'])
+
+    def test_cached_checks_do_not_query_acls(self) -> None:
+        index = get_eligibility_index()
+        index.check_interval = 60
+        index.client_ids_for_user(self.user)
+        public_id, private_id = self.public_client.id, self.private_client.id
+        with count_queries() as statements:
+            for _ in range(10):
+                self.assertTrue(index.is_eligible(public_id, self.user))
+                self.assertFalse(index.is_eligible(private_id, self.user))
+        self.assertEqual(statements, [])
+
+    def test_other_workers_apply_changes_from_the_log(self) -> None:
+        other = EligibilityIndex(check_interval=0, max_users=16)  # another worker's index
+        self.assertFalse(other.is_eligible(self.private_client.id, self.user))
+        reloads = other.full_reloads
+
+        self.private_client.is_public = True
+        record_acl_change(client_id=self.private_client.id)
+        db.session.commit()
+        self.assertTrue(other.is_eligible(self.private_client.id, self.user))
+
+        self.private_client.is_public = False
+        self.user.groups.append(self.staff)
+        record_acl_change(client_id=self.private_client.id)
+        record_acl_change(user_id=self.user.id)
+        db.session.commit()
+        self.assertTrue(other.is_eligible(self.private_client.id, self.user))
+        self.assertEqual(other.full_reloads, reloads)
+        self.assertEqual(other.version, db.session.query(db.func.max(OAuthAclChange.id)).scalar())
+
+    def test_admin_endpoints_record_changes(self) -> None:
+        client = flask_app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = self.admin.id
+        self.assertFalse(get_eligibility_index().is_eligible(self.private_client.id, self.user))
+
+        response = client.put('/api/admin/groups/%d/users/%d' % (self.staff.id, self.user.id))
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(get_eligibility_index().is_eligible(self.private_client.id, self.user))
+
+        response = client.delete('/api/admin/clients/%d/allowed_groups/%d' % (self.private_client.id, self.staff.id))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(get_eligibility_index().is_eligible(self.private_client.id, self.user))
+        self.assertEqual(OAuthAclChange.query.count(), 2)
+        stats = client.get('/api/admin/cache-stats').get_json()['oauth_eligibility']
+        self.assertEqual(stats['clients'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
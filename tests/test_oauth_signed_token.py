@@ -0,0 +1,138 @@
+import base64
+import json
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from app import app as flask_app
+from models import Group, OAuthAuthorization, OAuthClient, User, db
+from query_counter import count_queries
+from services.oauth import OAuthService, OAuthServiceError
+from services.oauth_eligibility import reset_eligibility_index
+from services.oauth_signed_token import SignedAccessToken, reset_revocation_list
+from services.oauth_token_cache import reset_token_cache
+from services.password_expiry import PASSWORD_WARNING_1WEEK
+
+
+def _claims(token: str) -> dict:
+    payload = token.split('.')[1]
+    return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+
+
+class OAuthSignedTokenTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original_signed_tokens = flask_app.config.get('OAUTH_SIGNED_TOKENS')
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        flask_app.config['OAUTH_SIGNED_TOKENS'] = {
+            'enabled': True, 'keys': {'k1': 'first-secret'}, 'current_key': 'k1', 'ttl_seconds': 600,
+        }
+        reset_token_cache()
+        reset_revocation_list()
+        reset_eligibility_index()
+        self.ctx = flask_app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.user = User(name='tokenuser', email='token@example.com', password='x', is_email_confirmed=True)
+        self.group = Group(name='staff')
+        self.client = OAuthClient(name='app', secret='s', redirect_url='http://app/cb', home_url='http://app',
+                                  is_public=False)
+        self.client.allowed_groups.append(self.group)
+        self.user.groups.append(self.group)
+        db.session.add_all([self.user, self.group, self.client])
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        flask_app.config['OAUTH_SIGNED_TOKENS'] = self.original_signed_tokens
+        reset_token_cache()
+        reset_revocation_list()
+        reset_eligibility_index()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _issue(self) -> str:
+        OAuthService.start_authorization(self.client, self.user, self.client.redirect_url)
+        db.session.commit()
+        auth = OAuthAuthorization.query.one()
+        token = OAuthService.get_access_token(self.client, 's', self.client.redirect_url, auth.authorize_token)
+        db.session.commit()
+        return token
+
+    def _count_queries(self, fn) -> int:
+        with count_queries() as statements:
+            fn()
+        return len(statements)
+
+    def test_token_is_verified_without_database_access(self) -> None:
+        token = self._issue()
+        claims = _claims(token)
+        self.assertEqual((claims['sub'], claims['aud'], claims['grp']),
+                         (str(self.user.id), str(self.client.id), [self.group.id]))
+        self.assertEqual(claims['jti'], OAuthAuthorization.query.one().access_token)
+
+        OAuthService.verify_access_token(token)  # loads the revocation list
+        verified = []
+        self.assertEqual(self._count_queries(lambda: verified.append(OAuthService.verify_access_token(token))), 0)
+        self.assertIsInstance(verified[0], SignedAccessToken)
+        self.assertEqual(verified[0].user.id, self.user.id)
+
+    def test_whoami_accepts_signed_bearer_token(self) -> None:
+        token = self._issue()
+        resp = flask_app.test_client().get('/api/account/whoami', headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['name'], 'tokenuser')
+
+    def test_cleared_tokens_are_revoked_in_every_process(self) -> None:
+        token = self._issue()
+        OAuthService.verify_access_token(token)
+        OAuthService.clear_user_tokens(self.user)
+        db.session.commit()
+        with self.assertRaises(OAuthServiceError):
+            OAuthService.verify_access_token(token)
+
+        reset_revocation_list()  # another worker, which only sees the revocation through the database
+        with self.assertRaises(OAuthServiceError):
+            OAuthService.verify_access_token(token)
+        OAuthService.verify_access_token(self._issue())  # tokens issued afterwards are valid
+
+    def test_key_rotation(self) -> None:
+        token = self._issue()
+        flask_app.config['OAUTH_SIGNED_TOKENS'].update(keys={'k1': 'first-secret', 'k2': 'second-secret'},
+                                                       current_key='k2')
+        OAuthService.verify_access_token(token)
+        new_token = self._issue()
+        self.assertNotEqual(new_token.split('.')[0], token.split('.')[0])
+
+        flask_app.config['OAUTH_SIGNED_TOKENS']['keys'] = {'k2': 'second-secret'}
+        OAuthService.verify_access_token(new_token)
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService.verify_access_token(token)
+        self.assertEqual(ctx.exception.msg, 'invalid access_token')
+
+    def test_tampered_and_expired_tokens_are_rejected(self) -> None:
+        token = self._issue()
+        header, _, signature = token.split('.')
+        claims = _claims(token)
+        claims['sub'] = '999'
+        forged = base64.urlsafe_b64encode(json.dumps(claims).encode()).rstrip(b'=').decode()
+        with self.assertRaises(OAuthServiceError):
+            OAuthService.verify_access_token('.'.join((header, forged, signature)))
+
+        self.user.password_expires_at = datetime.utcnow() + PASSWORD_WARNING_1WEEK + timedelta(seconds=1)
+        db.session.commit()
+        token = self._issue()  # 'warning_1month': expires at the one-week boundary instead of after ttl_seconds
+        claims = _claims(token)
+        self.assertLessEqual(claims['exp'] - claims['iat'], 1)
+        time.sleep(1.1)
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService.verify_access_token(token)
+        self.assertEqual(ctx.exception.msg, 'access_token expired')
+
+
+if __name__ == '__main__':
+    unittest.main()
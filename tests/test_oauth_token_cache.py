@@ -0,0 +1,140 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from passlib.hash import pbkdf2_sha256
+
+from app import app as flask_app
+from models import Group, OAuthAclChange, OAuthAuthorization, OAuthClient, User, db
+from services.oauth import OAuthService, OAuthServiceError
+from services.oauth_eligibility import reset_eligibility_index
+from services.oauth_token_cache import get_token_cache_stats, reset_token_cache
+from services.password_expiry import PASSWORD_WARNING_1WEEK
+
+
+class OAuthTokenCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        flask_app.config['OAUTH_TOKEN_CACHE'] = {'enabled': True, 'max_size': 16, 'ttl_seconds': 60}
+        reset_token_cache()
+        reset_eligibility_index()
+        self.ctx = flask_app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.user = User(name='tokenuser', email='token@example.com', password=pbkdf2_sha256.hash('OldPass123'),
+                         is_email_confirmed=True)
+        self.group = Group(name='staff')
+        self.client = OAuthClient(name='app', secret='s', redirect_url='http://app/cb', home_url='http://app',
+                                  is_public=False)
+        self.client.allowed_groups.append(self.group)
+        self.user.groups.append(self.group)
+        db.session.add_all([self.user, self.group, self.client])
+        db.session.flush()
+        db.session.add(OAuthAuthorization(client_id=self.client.id, user_id=self.user.id, access_token='tok'))
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        reset_token_cache()
+        reset_eligibility_index()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_second_verification_hits_cache(self) -> None:
+        OAuthService.verify_access_token('tok')
+        auth = OAuthService.verify_access_token('tok')
+        self.assertEqual(auth.user_id, self.user.id)
+        stats = get_token_cache_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_clear_user_tokens_invalidates(self) -> None:
+        OAuthService.verify_access_token('tok')
+        OAuthService.clear_user_tokens(self.user)
+        db.session.commit()
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService.verify_access_token('tok')
+        self.assertEqual(ctx.exception.msg, 'invalid access_token')
+
+    def test_invalidate_user_tokens_after_group_removal(self) -> None:
+        from services.oauth_eligibility import record_acl_change
+        from services.oauth_token_cache import invalidate_user_tokens
+
+        OAuthService.verify_access_token('tok')
+        self.user.groups.remove(self.group)
+        record_acl_change(user_id=self.user.id)
+        db.session.commit()
+        invalidate_user_tokens(self.user.id)
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService.verify_access_token('tok')
+        self.assertEqual(ctx.exception.msg, 'permission denied')
+
+    def test_changes_made_by_other_workers_are_rechecked_on_hit(self) -> None:
+        from services.oauth_eligibility import get_eligibility_index
+
+        OAuthService.verify_access_token('tok')
+        self.user.is_active = False  # deactivated through another worker: this cache is not invalidated
+        db.session.add(OAuthAclChange(user_id=self.user.id))
+        db.session.commit()
+        get_eligibility_index()._checked_at = 0.0
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService.verify_access_token('tok')
+        self.assertEqual(ctx.exception.msg, 'inactive user')
+
+        reset_token_cache()
+        self.user.is_active = True
+        db.session.commit()
+        OAuthService.verify_access_token('tok')
+        self.user.groups.remove(self.group)
+        db.session.add(OAuthAclChange(user_id=self.user.id))  # as record_acl_change in another worker
+        db.session.commit()
+        get_eligibility_index()._checked_at = 0.0  # due for its next look at the change log
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService.verify_access_token('tok')
+        self.assertEqual(ctx.exception.msg, 'permission denied')
+
+    def test_cached_denial_is_rechecked_after_acl_change(self) -> None:
+        from services.oauth_eligibility import get_eligibility_index
+
+        self.user.groups.remove(self.group)
+        db.session.commit()
+        with self.assertRaises(OAuthServiceError):
+            OAuthService.verify_access_token('tok')
+        self.user.groups.append(self.group)
+        db.session.add(OAuthAclChange(user_id=self.user.id))  # access granted again through another worker
+        db.session.commit()
+        get_eligibility_index()._checked_at = 0.0
+        self.assertEqual(OAuthService.verify_access_token('tok').user_id, self.user.id)
+
+    def test_cache_hit_runs_no_query(self) -> None:
+        from query_counter import count_queries
+
+        OAuthService.verify_access_token('tok')
+        with count_queries() as queries:
+            OAuthService.verify_access_token('tok')
+        self.assertEqual(len(queries), 0)
+
+    def test_cached_expiry_status_does_not_outlive_transition(self) -> None:
+        self.user.password_expires_at = datetime.utcnow() + PASSWORD_WARNING_1WEEK + timedelta(seconds=1)
+        db.session.commit()
+        OAuthService.verify_access_token('tok')  # 'warning_1month' is cached until the 1-week boundary
+        time.sleep(1.1)
+        with self.assertRaises(OAuthServiceError) as ctx:
+            OAuthService.verify_access_token('tok')
+        self.assertEqual(ctx.exception.code, 'password_expiring')
+
+    def test_disabled_cache_is_bypassed(self) -> None:
+        flask_app.config['OAUTH_TOKEN_CACHE'] = {'enabled': False}
+        reset_token_cache()
+        OAuthService.verify_access_token('tok')
+        OAuthService.verify_access_token('tok')
+        self.assertEqual(get_token_cache_stats()['hits'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from app import app as flask_app
+from models import OAuthAuthorization, OAuthClient, User, db
+from services.oauth import OAuthService, OAuthServiceError
+from services.oauth_eligibility import reset_eligibility_index
+
+
+class OAuthTokenIssuanceTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        reset_eligibility_index()
+        self.ctx = flask_app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.users = [User(name='user%d' % i, email='user%d@example.com' % i, password='x', is_email_confirmed=True)
+                      for i in range(2)]
+        self.client = OAuthClient(name='app', secret='s', redirect_url='http://app/cb', home_url='http://app',
+                                  is_public=True)
+        db.session.add_all(self.users + [self.client])
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_colliding_tokens_are_retried(self) -> None:
+        with patch('services.oauth.token_urlsafe', side_effect=['code-a', 'code-a', 'code-b', 'access-a',
+                                                                'access-a', 'access-b']):
+            self.assertEqual(OAuthService.start_authorization(self.client, self.users[0], 'http://app/cb'), 'code-a')
+            db.session.commit()
+            self.assertEqual(OAuthService.start_authorization(self.client, self.users[1], 'http://app/cb'), 'code-b')
+            db.session.commit()
+            self.assertEqual(OAuthService.get_access_token(self.client, 's', 'http://app/cb', 'code-a'), 'access-a')
+            db.session.commit()
+            self.assertEqual(OAuthService.get_access_token(self.client, 's', 'http://app/cb', 'code-b'), 'access-b')
+            db.session.commit()
+        tokens = {auth.user_id: auth.access_token for auth in OAuthAuthorization.query}
+        self.assertEqual(tokens, {self.users[0].id: 'access-a', self.users[1].id: 'access-b'})
+
+    def test_gives_up_after_retries(self) -> None:
+        OAuthService.start_authorization(self.client, self.users[0], 'http://app/cb')
+        db.session.commit()
+        taken = OAuthAuthorization.query.one().authorize_token
+        with patch('services.oauth.token_urlsafe', return_value=taken):
+            with self.assertRaises(OAuthServiceError) as ctx:
+                OAuthService.start_authorization(self.client, self.users[1], 'http://app/cb')
+        self.assertEqual(ctx.exception.msg, 'token space almost exhausted')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import os
+import smtplib
 import tempfile
 import time
 import unittest
+from unittest.mock import patch
 from datetime import datetime, timedelta
 
 from cryptography.hazmat.backends import default_backend
@@ -11,7 +13,8 @@ from passlib.hash import pbkdf2_sha256
 
 import utils.two_factor as two_factor
 from app import app as flask_app
-from models import OAuthClient, User, db
+from models import Group, MailOutbox, OAuthAuthorization, OAuthClient, User, db
+from services.oauth_eligibility import reset_eligibility_index
 from services.password_expiry import (
     PASSWORD_EXPIRY_NO_2FA,
     PASSWORD_WARNING_1MONTH,
@@ -19,14 +22,17 @@ from services.password_expiry import (
     get_password_expiry_status,
     is_password_expiry_applicable,
     refresh_password_expiry,
+    send_password_expiry_warnings,
 )
 from services.user import UserService
+from utils.background import wait_for_deferred_writes
 
 
 class PasswordExpiryTests(unittest.TestCase):
     def setUp(self) -> None:
         self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
         flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        reset_eligibility_index()
         self.ctx = flask_app.app_context()
         self.ctx.push()
         db.create_all()
@@ -105,6 +111,12 @@ class PasswordExpiryTests(unittest.TestCase):
 
     def test_expired_session_whoami_returns_password_expired(self) -> None:
         user = self._make_user(password_expires_at=datetime.utcnow() - timedelta(days=1))
+        client_row = OAuthClient(name='tokenapp', secret='secret', redirect_url='https://app.example/callback',
+                                 home_url='https://app.example/', is_public=True)
+        db.session.add(client_row)
+        db.session.flush()
+        db.session.add(OAuthAuthorization(client_id=client_row.id, user_id=user.id, access_token='expired-token'))
+        db.session.commit()
         client = flask_app.test_client()
         with client.session_transaction() as sess:
             sess['user_id'] = user.id
@@ -117,6 +129,30 @@ class PasswordExpiryTests(unittest.TestCase):
         follow_up = client.get('/api/account/whoami')
         self.assertEqual(follow_up.status_code, 204)
 
+        wait_for_deferred_writes()  # /whoami hands the token revocation to the background writer
+        db.session.expire_all()
+        self.assertIsNone(OAuthAuthorization.query.one().access_token)
+
+    def test_whoami_resolves_a_read_only_view_without_committing(self) -> None:
+        user = self._make_user(password_expires_at=datetime.utcnow() + timedelta(days=3))
+        group = Group(name='staff', description='Staff')
+        user.groups.append(group)
+        db.session.commit()
+        expected = user.to_dict(password_expiry_fields=dict(
+            password_expires_at=user.password_expires_at.isoformat(), password_expiry_status='warning_1week',
+            password_expiry_intercept_active=True))
+        self.assertEqual(UserService.get_view(user.id).to_dict(), user.to_dict())
+
+        client = flask_app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user.id
+        commits = []
+        with patch.object(db.session, 'commit', side_effect=lambda: commits.append(1)):
+            resp = client.get('/api/account/whoami')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json(), expected)
+        self.assertEqual(commits, [])
+
     def test_expired_session_oauth_connect_returns_password_expired(self) -> None:
         user = self._make_user(password_expires_at=datetime.utcnow() - timedelta(days=1))
         client_row = OAuthClient(
@@ -164,5 +200,81 @@ class PasswordExpiryTests(unittest.TestCase):
         self.assertIn('password_expired=1', resp.location)
 
 
+class PasswordExpiryWarningTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original_mail = flask_app.config.get('MAIL')
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        flask_app.config['MAIL'] = {
+            'enabled': True, 'from': 'noreply@example.com', 'display_name': 'Identity',
+            'outbox': {'enabled': True},
+        }
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+
+    def tearDown(self) -> None:
+        flask_app.config['MAIL'] = self.original_mail
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _make_user(self, name: str, expires_in: timedelta | None, **kwargs) -> User:
+        expires_at = datetime.utcnow() + expires_in if expires_in is not None else None
+        user = User(name=name, email=f'{name}@example.com', password='x', is_email_confirmed=True,
+                    password_expires_at=expires_at, **kwargs)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def test_batch_warns_only_due_users_once(self) -> None:
+        due = [self._make_user(f'due{i}', timedelta(days=3)) for i in range(5)]
+        self._make_user('later', timedelta(days=20))
+        self._make_user('expired', timedelta(days=-1))
+        self._make_user('twofactor', timedelta(days=3), is_two_factor_enabled=True)
+        self._make_user('external', timedelta(days=3), external_auth_enforced=True)
+        self._make_user('inactive', timedelta(days=3), is_active=False)
+        self._make_user('warned', timedelta(days=3), password_expiry_warning_email_sent_at=datetime.utcnow())
+
+        self.assertEqual(send_password_expiry_warnings(page_size=2, dry_run=True), 5)
+        self.assertEqual(MailOutbox.query.count(), 0)
+
+        self.assertEqual(send_password_expiry_warnings(page_size=2), 5)
+        self.assertEqual(MailOutbox.query.count(), 5)
+        for user in due:
+            self.assertIsNotNone(db.session.get(User, user.id).password_expiry_warning_email_sent_at)
+        self.assertEqual(send_password_expiry_warnings(page_size=2), 0)
+
+    def test_failed_delivery_keeps_marks_of_users_already_mailed(self) -> None:
+        flask_app.config['MAIL'] = dict(flask_app.config['MAIL'], outbox={'enabled': False})
+        users = [self._make_user(f'due{i}', timedelta(days=3)) for i in range(3)]
+        with patch('utils.mail.MailTransport') as transport_cls:
+            transport = transport_cls.return_value.__enter__.return_value
+            transport.send.side_effect = [None, smtplib.SMTPServerDisconnected('gone')]
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                send_password_expiry_warnings(page_size=10)
+        db.session.rollback()
+        warned = [db.session.get(User, user.id).password_expiry_warning_email_sent_at is not None for user in users]
+        self.assertEqual(warned, [True, False, False])
+
+        with patch('utils.mail.MailTransport') as transport_cls:
+            self.assertEqual(send_password_expiry_warnings(page_size=10), 2)  # the first user is not mailed again
+        self.assertEqual(transport_cls.return_value.__enter__.return_value.send.call_count, 2)
+
+    def test_session_access_does_not_send_or_commit(self) -> None:
+        user = self._make_user('due', timedelta(days=3))
+        client = flask_app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = user.id
+
+        resp = client.get('/api/account/whoami')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['password_expiry_status'], 'warning_1week')
+        self.assertEqual(MailOutbox.query.count(), 0)
+        self.assertIsNone(db.session.get(User, user.id).password_expiry_warning_email_sent_at)
+
+
 if __name__ == '__main__':
     unittest.main()
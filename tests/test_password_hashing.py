@@ -0,0 +1,179 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from flask import request
+from passlib.hash import pbkdf2_sha256
+
+from app import app as flask_app
+from models import User, db
+from services.user import UserService, UserServiceError
+from utils.password_hashing import (
+    PasswordHashingBusyError,
+    benchmark_password_scheme,
+    find_matching_password_hash,
+    hash_password,
+    run_password_task,
+    shutdown_password_hashing,
+    verify_password,
+    verify_password_and_update,
+)
+from utils.password_hashing import _verify
+
+_started = threading.Event()
+_release = threading.Event()
+
+
+def _block() -> bool:
+    _started.set()
+    _release.wait(5)
+    return True
+
+
+class PasswordHashingTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original = flask_app.config.get('PASSWORD_HASHING')
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+
+    def tearDown(self) -> None:
+        _release.set()
+        shutdown_password_hashing()
+        flask_app.config['PASSWORD_HASHING'] = self.original
+        self.ctx.pop()
+
+    def _configure(self, **cfg) -> None:
+        shutdown_password_hashing()
+        flask_app.config['PASSWORD_HASHING'] = cfg
+
+    def test_inline_hash_and_verify(self) -> None:
+        self._configure(executor='inline')
+        password_hash = hash_password('Secret123')
+        self.assertTrue(verify_password('Secret123', password_hash))
+        self.assertFalse(verify_password('Secret124', password_hash))
+
+    def test_process_pool_hash_and_verify(self) -> None:
+        self._configure(executor='process', max_workers=1)
+        password_hash = hash_password('Secret123')
+        self.assertTrue(verify_password('Secret123', password_hash))
+
+    def test_rejects_when_queue_full(self) -> None:
+        self._configure(executor='inline', max_workers=1, queue_depth=0, retry_after_seconds=7)
+        _started.clear()
+        _release.clear()
+
+        def occupy() -> None:
+            with flask_app.app_context():
+                run_password_task(_block)
+
+        worker = threading.Thread(target=occupy)
+        worker.start()
+        try:
+            self.assertTrue(_started.wait(5))
+            with self.assertRaises(PasswordHashingBusyError) as ctx:
+                run_password_task(bool)
+            self.assertEqual(ctx.exception.retry_after, 7)
+        finally:
+            _release.set()
+            worker.join()
+        self.assertTrue(run_password_task(bool, 1))
+
+    def test_busy_error_maps_to_503(self) -> None:
+        with patch('api_account.UserService.login', side_effect=PasswordHashingBusyError(3)), \
+                patch('api_account.captcha_required_for_login', return_value=False), \
+                patch('api_account.resolve_user_by_name_or_email', return_value=None):
+            response = flask_app.test_client().post('/api/account/login', json={
+                'name_or_email': 'someone', 'password': 'Secret123'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '3')
+        self.assertEqual(response.get_json()['msg'], 'server busy')
+
+    def test_cost_change_triggers_rehash(self) -> None:
+        self._configure(executor='inline', context={'schemes': ['pbkdf2_sha256'], 'pbkdf2_sha256__rounds': 1000})
+        old_hash = hash_password('Secret123')
+        self._configure(executor='inline', context={'schemes': ['pbkdf2_sha256'], 'pbkdf2_sha256__rounds': 2000})
+        self.assertEqual(verify_password_and_update('Secret124', old_hash), (False, None))
+        matched, new_hash = verify_password_and_update('Secret123', old_hash)
+        self.assertTrue(matched)
+        self.assertTrue(new_hash.startswith('$pbkdf2-sha256$2000$'))
+        self.assertEqual(verify_password_and_update('Secret123', new_hash), (True, None))
+
+    def test_deprecated_scheme_is_migrated(self) -> None:
+        self._configure(executor='inline', context={'schemes': ['pbkdf2_sha512', 'pbkdf2_sha256'],
+                                                    'deprecated': 'auto', 'pbkdf2_sha512__rounds': 1000})
+        old_hash = pbkdf2_sha256.using(rounds=1000).hash('Secret123')
+        matched, new_hash = verify_password_and_update('Secret123', old_hash)
+        self.assertTrue(matched)
+        self.assertTrue(new_hash.startswith('$pbkdf2-sha512$1000$'))
+
+    def test_find_matching_hash_stops_at_first_match(self) -> None:
+        self._configure(executor='inline', max_workers=1)
+        hashes = [pbkdf2_sha256.using(rounds=1000).hash(p) for p in ('a', 'b', 'c', 'd')]
+        with patch('utils.password_hashing._verify', wraps=_verify) as verify:
+            self.assertEqual(find_matching_password_hash('b', hashes), 1)
+        self.assertEqual(verify.call_count, 2)
+        self.assertIsNone(find_matching_password_hash('e', hashes))
+
+    def test_find_matching_hash_in_process_pool(self) -> None:
+        self._configure(executor='process', max_workers=2, queue_depth=0)
+        hashes = [pbkdf2_sha256.using(rounds=1000).hash(p) for p in ('a', 'b', 'c', 'd', 'e')]
+        self.assertEqual(find_matching_password_hash('d', hashes), 3)
+        self.assertIsNone(find_matching_password_hash('f', hashes))
+
+    def test_find_matching_hash_prefers_lowest_index(self) -> None:
+        self._configure(executor='process', max_workers=2, queue_depth=0)
+        # the current password (index 0) is also in the history, and its older, cheaper hash finishes first
+        hashes = [pbkdf2_sha256.using(rounds=200000).hash('a'), pbkdf2_sha256.using(rounds=1000).hash('a')]
+        self.assertEqual(find_matching_password_hash('a', hashes), 0)
+
+    def test_benchmark_reports_throughput(self) -> None:
+        self._configure(executor='inline')
+        result = benchmark_password_scheme('pbkdf2_sha256', duration=0, rounds=1000)
+        self.assertEqual(result['rounds'], 1000)
+        self.assertEqual(result['hashes'], 1)
+        self.assertGreater(result['hashes_per_second'], 0)
+
+
+class LoginRehashTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.original = flask_app.config.get('PASSWORD_HASHING')
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        flask_app.config['PASSWORD_HASHING'] = {
+            'executor': 'inline', 'context': {'schemes': ['pbkdf2_sha256'], 'pbkdf2_sha256__rounds': 2000}}
+        shutdown_password_hashing()
+        self.ctx = flask_app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.old_hash = pbkdf2_sha256.using(rounds=1000).hash('Secret123')
+        self.user = User(name='rehash', email='rehash@example.com', password=self.old_hash, is_email_confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        shutdown_password_hashing()
+        flask_app.config['PASSWORD_HASHING'] = self.original
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_successful_login_upgrades_hash(self) -> None:
+        UserService.login('rehash', 'Secret123', '127.0.0.1', request.user_agent)
+        db.session.expire_all()
+        user = db.session.get(User, self.user.id)
+        self.assertTrue(user.password.startswith('$pbkdf2-sha256$2000$'))
+        self.assertIsNone(user.password_changed_at)
+
+    def test_failed_login_keeps_hash(self) -> None:
+        with self.assertRaises(UserServiceError):
+            UserService.login('rehash', 'Wrong1234', '127.0.0.1', request.user_agent)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, self.user.id).password, self.old_hash)
+
+
+if __name__ == '__main__':
+    unittest.main()
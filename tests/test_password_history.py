@@ -14,6 +14,7 @@ class PasswordHistoryTests(unittest.TestCase):
     def setUp(self) -> None:
         self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
         flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        self.original_history = flask_app.config.get('PASSWORD_HISTORY')
         self.ctx = flask_app.app_context()
         self.ctx.push()
         db.create_all()
@@ -27,6 +28,7 @@ class PasswordHistoryTests(unittest.TestCase):
         db.session.commit()
 
     def tearDown(self) -> None:
+        flask_app.config['PASSWORD_HISTORY'] = self.original_history
         db.session.remove()
         db.drop_all()
         self.ctx.pop()
@@ -58,6 +60,20 @@ class PasswordHistoryTests(unittest.TestCase):
         with self.assertRaises(UserServiceError):
             UserService.force_set_password(self.user, 'FirstPass1')
 
+    def test_configurable_history_limit(self) -> None:
+        flask_app.config['PASSWORD_HISTORY'] = {'limit': 12}
+        passwords = ['Pass%02dword' % i for i in range(14)]
+        for pwd in passwords:
+            record_password_change(self.user)
+            self.user.password = pbkdf2_sha256.using(rounds=1000).hash(pwd)
+        db.session.commit()
+
+        self.assertEqual(UserPasswordHistory.query.filter_by(user_id=self.user.id).count(), 12)
+        with self.assertRaises(UserServiceError) as ctx:
+            check_password_not_reused(self.user, passwords[1])  # 12th most recent previous password
+        self.assertIn('recent passwords', ctx.exception.detail)
+        check_password_not_reused(self.user, passwords[0])  # 13th, beyond the limit
+
 
 if __name__ == '__main__':
     unittest.main()
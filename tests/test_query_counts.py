@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+from app import app as flask_app
+from models import Group, OAuthAuthorization, OAuthClient, User, db
+from query_counter import count_queries
+from services.oauth_eligibility import reset_eligibility_index
+from services.oauth_token_cache import reset_token_cache
+
+_USERS = 6
+
+
+class EndpointQueryCountTests(unittest.TestCase):
+    """Pins the SQL statements per request. The fixture has several users, groups, clients and authorizations, so
+    a lazy load inside a loop shows up as a changed count."""
+
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        reset_eligibility_index()
+        reset_token_cache()
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        admin_group, staff, ops = Group(name='admin'), Group(name='staff'), Group(name='ops')
+        self.admin = User(name='admin', email='admin@example.com', password='x', is_email_confirmed=True)
+        self.admin.groups.append(admin_group)
+        self.clients = [OAuthClient(name='app%d' % i, secret='s', redirect_url='http://app/cb', home_url='http://app',
+                                    is_public=i == 0) for i in range(3)]
+        for client in self.clients:
+            client.allowed_groups += [staff, ops]
+        self.users = [User(name='user%d' % i, email='user%d@example.com' % i, password='x', is_email_confirmed=True)
+                      for i in range(_USERS)]
+        for user in self.users:
+            user.groups += [staff, ops]
+        db.session.add_all([admin_group, staff, ops, self.admin] + self.clients + self.users)
+        db.session.flush()
+        for user in self.users:
+            for client in self.clients:
+                db.session.add(OAuthAuthorization(client_id=client.id, user_id=user.id,
+                                                  access_token='tok-%d-%d' % (user.id, client.id)))
+        db.session.commit()
+        self.staff_id, self.client_id, self.user_id = staff.id, self.clients[1].id, self.users[0].id
+        self.http = flask_app.test_client()
+        with self.http.session_transaction() as sess:
+            sess['user_id'] = self.admin.id
+
+    def tearDown(self) -> None:
+        reset_eligibility_index()
+        reset_token_cache()
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _statements(self, url: str, **kwargs) -> list[str]:
+        with flask_app.app_context(), count_queries() as statements:  # fresh session and g, as in production
+            response = self.http.get(url, **kwargs)
+        self.assertEqual(response.status_code, 200, response.get_data(as_text=True))
+        return statements
+
+    def test_admin_endpoints(self) -> None:
+        # each count includes loading the session user (1) and its groups for the admin check (1)
+        expected = {
+            '/api/admin/users?limit=50': 4,  # + users page, + their groups
+            # + prefix matches, + their groups, + substring matches (the prefixes did not fill the limit)
+            '/api/admin/users?name=user&limit=50': 5,
+            '/api/admin/users/%d?oauth-info=true' % self.user_id: 5,  # + user, + authorizations with clients, + groups
+            '/api/admin/clients': 4,  # + clients, + their allowed groups
+            # + client, + authorizations with their users, + the users' groups
+            '/api/admin/clients/%d/authorizations' % self.client_id: 5,
+            '/api/admin/groups/%d/users' % self.staff_id: 4,  # + group, + members
+        }
+        for url, count in expected.items():
+            statements = self._statements(url)
+            self.assertEqual(len(statements), count, '%s:\n%s' % (url, '\n'.join(statements)))
+
+    def test_account_endpoints(self) -> None:
+        self.assertEqual(len(self._statements('/api/account/whoami')), 1)  # user and groups in one query
+        self.assertEqual(len(self._statements('/api/account/me')), 2)  # user, then groups for the response
+
+        bearer = {'Authorization': 'Bearer tok-%d-%d' % (self.user_id, self.client_id)}
+        # authorization with client and user, then the eligibility index (version, log, client ACLs, user groups)
+        self.assertEqual(len(self._statements('/api/account/me', headers=bearer)), 6)
+        # cached token: no authorization query; the user the endpoint reads, then the clients the user may use
+        self.assertEqual(len(self._statements('/api/account/clients', headers=bearer)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
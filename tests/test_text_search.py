@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import select
+
+from app import app as flask_app
+from models import Group, User, db
+from services.group import GroupService
+from services.user import UserService
+from utils.text_search import _prefix_condition
+
+
+class TextSearchTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        for name, nickname, real_name in (('bob', None, 'Robert Ann'), ('annabel', None, None), ('ann', None, None),
+                                          ('joanna', 'Anny', None), ('carl', 'x_y', 'Carl 100%')):
+            db.session.add(User(name=name, email='%s@example.com' % name, password='x', nickname=nickname,
+                                real_name=real_name))
+        db.session.add_all([Group(name='staff', description='All staff'),
+                            Group(name='managers', description='Staff managers')])
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def _user_names(self, term: str) -> list[str]:
+        return [user.name for user in UserService.search_by_name(term, 10)]
+
+    def test_exact_then_prefix_then_substring(self) -> None:
+        self.assertEqual(self._user_names('Ann'), ['ann', 'annabel', 'joanna', 'bob'])
+        self.assertEqual([g.name for g in GroupService.search_by_name('staff', 10)], ['staff', 'managers'])
+
+    def test_limit_spans_prefix_and_substring_matches(self) -> None:
+        self.assertEqual([user.name for user in UserService.search_by_name('Ann', 2)], ['ann', 'annabel'])
+        self.assertEqual([user.name for user in UserService.search_by_name('Ann', 4)],
+                         ['ann', 'annabel', 'joanna', 'bob'])
+        self.assertEqual([user.name for user in UserService.search_by_name('obert', 3)], ['bob'])
+
+    def test_short_terms_also_match_inside(self) -> None:
+        self.assertEqual(self._user_names('an'), ['ann', 'annabel', 'joanna', 'bob'])  # joanna by nickname 'Anny'
+        self.assertEqual(self._user_names('ob'), ['bob'])
+        self.assertEqual([user.name for user in UserService.search_by_name('an', 3)], ['ann', 'annabel', 'joanna'])
+
+    def test_limited_search_takes_each_columns_first_prefix_matches(self) -> None:
+        db.session.add_all([User(name='yan', email='yan@example.com', password='x', nickname='Quinn'),
+                            User(name='zoe', email='zoe@example.com', password='x', nickname='Quill')])
+        db.session.commit()
+        self.assertEqual(self._user_names('qui'), ['yan', 'zoe'])
+        # by nickname order 'Quill' comes first, although by name 'yan' ranks first among all matches
+        self.assertEqual([user.name for user in UserService.search_by_name('qui', 1)], ['zoe'])
+
+    def test_wildcards_are_literal(self) -> None:
+        self.assertEqual(self._user_names('x_'), ['carl'])
+        self.assertEqual(self._user_names('0%'), ['carl'])
+        self.assertEqual(self._user_names('1%'), [])
+        self.assertEqual(self._user_names('%%'), [])
+
+    def test_prefix_search_uses_nocase_indexes(self) -> None:
+        condition = _prefix_condition([User.name, User.nickname, User.real_name], 'an', 'sqlite')
+        sql = select(User.id).where(condition).compile(db.engine, compile_kwargs={'literal_binds': True})
+        plan = db.session.execute(db.text('EXPLAIN QUERY PLAN %s' % sql)).fetchall()
+        self.assertIn('ix_user_name_nocase', str(plan))
+        self.assertNotIn('SCAN', str(plan))
+
+
+if __name__ == '__main__':
+    unittest.main()
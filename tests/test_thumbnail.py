@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from app import app as flask_app
+from utils.thumbnail import ThumbnailCache, reset_thumbnail_cache
+
+
+class ThumbnailCacheTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.source_root = os.path.join(self.tmp, 'upload')
+        os.makedirs(os.path.join(self.source_root, 'avatar'))
+        for name in ('a', 'b', 'c'):
+            Image.new('RGB', (400, 400), 'red').save(os.path.join(self.source_root, 'avatar', '%s.png' % name))
+        self.folder = os.path.join(self.tmp, 'thumbnails')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp)
+
+    def test_sizes_snap_to_configured_ones(self) -> None:
+        cache = ThumbnailCache(self.folder, [64, 32, 128], 10 ** 6, 1)
+        self.assertEqual([cache.snap(size) for size in (1, 32, 33, 100, 4000)], [32, 32, 64, 128, 128])
+
+    def test_renders_once_then_hits(self) -> None:
+        cache = ThumbnailCache(self.folder, [32], 10 ** 6, 1)
+        key = cache.get(self.source_root, 'avatar/a.png', 32)
+        self.assertEqual(key, 'avatar/a_s32.png')
+        with Image.open(os.path.join(self.folder, key)) as im:
+            self.assertEqual(im.size, (32, 32))
+        cache.get(self.source_root, 'avatar/a.png', 32)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['renders']), (1, 1, 1))
+
+        # another process finds the file on disk
+        other = ThumbnailCache(self.folder, [32], 10 ** 6, 1)
+        other.scan()
+        self.assertEqual(other.stats()['files'], 1)
+
+    def test_concurrent_misses_share_one_render(self) -> None:
+        cache = ThumbnailCache(self.folder, [32], 10 ** 6, 1)
+        release = threading.Event()
+        original = cache._render
+
+        def slow_render(*args) -> None:
+            release.wait(5)
+            original(*args)
+
+        with mock.patch.object(cache, '_render', side_effect=slow_render) as render:
+            threads = [threading.Thread(target=cache.get, args=(self.source_root, 'avatar/a.png', 32))
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            while cache.stats()['misses'] < 8:
+                threading.Event().wait(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(cache.stats()['in_flight'], 0)
+
+    def test_evicts_least_recently_used_beyond_max_bytes(self) -> None:
+        cache = ThumbnailCache(self.folder, [64], 10 ** 6, 1)
+        one = os.path.getsize(os.path.join(self.folder, cache.get(self.source_root, 'avatar/a.png', 64)))
+        cache.max_bytes = 2 * one
+        cache.get(self.source_root, 'avatar/b.png', 64)
+        cache.get(self.source_root, 'avatar/a.png', 64)  # a is now the most recently used
+        cache.get(self.source_root, 'avatar/c.png', 64)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'avatar'))), ['a_s64.png', 'c_s64.png'])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_bound_covers_the_renders_of_every_process(self) -> None:
+        Image.new('RGB', (64, 64), 'red').save(os.path.join(self.tmp, 'one.png'))
+        one = os.path.getsize(os.path.join(self.tmp, 'one.png'))  # the size of each thumbnail below
+        first = ThumbnailCache(self.folder, [64], 2 * one, 1)
+        second = ThumbnailCache(self.folder, [64], 2 * one, 1)  # another worker on the same folder
+        first.get(self.source_root, 'avatar/a.png', 64)
+        second.get(self.source_root, 'avatar/b.png', 64)
+        second.get(self.source_root, 'avatar/c.png', 64)  # the folder now holds three, counting the first's
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'avatar'))), ['b_s64.png', 'c_s64.png'])
+        self.assertEqual(second.stats()['bytes'], 2 * one)
+
+    def test_pregenerate_and_discard(self) -> None:
+        cache = ThumbnailCache(self.folder, [32, 64], 10 ** 6, 2)
+        cache.pregenerate(self.source_root, 'avatar/a.png')
+        cache._get_pool().shutdown(wait=True)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'avatar'))), ['a_s32.png', 'a_s64.png'])
+        cache.discard('avatar/a.png')
+        self.assertEqual(os.listdir(os.path.join(self.folder, 'avatar')), [])
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_endpoint_serves_configured_sizes_only(self) -> None:
+        saved = flask_app.config['UPLOAD']
+        flask_app.config['UPLOAD'] = dict(saved, root_folder=self.source_root,
+                                          thumbnail=dict(folder=self.folder, sizes=[32, 64]))
+        reset_thumbnail_cache()
+        try:
+            client = flask_app.test_client()
+            for size in range(1, 200, 7):
+                response = client.get('/upload/avatar/a.png?size=%d' % size)
+                self.assertEqual(response.status_code, 200)
+                response.close()
+            self.assertEqual(sorted(os.listdir(os.path.join(self.folder, 'avatar'))), ['a_s32.png', 'a_s64.png'])
+            self.assertEqual(client.get('/upload/avatar/a.png?size=x').status_code, 400)
+            self.assertEqual(client.get('/upload/avatar/missing.png?size=32').status_code, 404)
+        finally:
+            flask_app.config['UPLOAD'] = saved
+            reset_thumbnail_cache()
+
+
+if __name__ == '__main__':
+    unittest.main()
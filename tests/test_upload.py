@@ -0,0 +1,261 @@
+import io
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+import zlib
+from unittest import mock
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from app import app as flask_app
+from models import User, db
+from utils.thumbnail import get_thumbnail_cache, reset_thumbnail_cache
+from utils.upload import UploadError, handle_post_upload, handle_upload, sweep_uploads
+
+
+class _CountingStream(io.RawIOBase):
+    """An endless upload body that records how much of it was read."""
+
+    def __init__(self, head: bytes) -> None:
+        self.head = head
+        self.read_bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = (self.head + b'\0' * len(buffer))[:len(buffer)] if self.read_bytes == 0 else b'\0' * len(buffer)
+        buffer[:len(chunk)] = chunk
+        self.read_bytes += len(chunk)
+        return len(chunk)
+
+
+def _png(width: int, height: int) -> bytes:
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), 'blue').save(out, 'PNG')
+    return out.getvalue()
+
+
+def _png_claiming(width: int, height: int) -> bytes:
+    """A tiny PNG whose header declares a ``width`` x ``height`` canvas."""
+    data = bytearray(_png(1, 1))
+    ihdr = b'IHDR' + struct.pack('>II', width, height) + bytes(data[24:29])
+    data[12:33] = ihdr + struct.pack('>I', zlib.crc32(ihdr))
+    return bytes(data)
+
+
+class HandleUploadTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.saved_upload = flask_app.config['UPLOAD']
+        flask_app.config['UPLOAD'] = dict(self.saved_upload, root_folder=self.root,
+                                          thumbnail=dict(folder=os.path.join(self.root, 'thumbnails'), sizes=[32]))
+        reset_thumbnail_cache()
+        self.ctx = flask_app.test_request_context()
+        self.ctx.push()
+
+    def tearDown(self) -> None:
+        get_thumbnail_cache()._get_pool().shutdown(wait=True)  # thumbnails of the accepted upload
+        self.ctx.pop()
+        flask_app.config['UPLOAD'] = self.saved_upload
+        reset_thumbnail_cache()
+        shutil.rmtree(self.root)
+
+    def _upload(self, stream, name: str = 'a.png') -> str:
+        return handle_upload(FileStorage(stream, filename=name), 'avatar', image_check=True, image_check_squared=True)
+
+    def _saved_files(self) -> list[str]:
+        folder = os.path.join(self.root, 'avatar')
+        return sorted(os.path.relpath(os.path.join(root, name), folder)
+                      for root, _, names in os.walk(folder) for name in names)
+
+    def test_oversized_upload_is_rejected_after_reading_the_limit(self) -> None:
+        stream = _CountingStream(b'\x89PNG\r\n\x1a\n')
+        with self.assertRaises(UploadError) as cm:
+            self._upload(io.BufferedReader(stream))
+        self.assertEqual(cm.exception.msg, 'file size too big')
+        self.assertLess(stream.read_bytes, flask_app.config['UPLOAD']['avatar']['size_limit'] + 2 * 64 * 1024)
+        self.assertEqual(self._saved_files(), [])
+
+    def test_non_image_is_rejected_on_its_first_bytes(self) -> None:
+        stream = _CountingStream(b'<?php')
+        with self.assertRaises(UploadError) as cm:
+            self._upload(io.BufferedReader(stream))
+        self.assertEqual(cm.exception.msg, 'invalid image file')
+        self.assertLessEqual(stream.read_bytes, 64 * 1024)
+        self.assertEqual(self._saved_files(), [])
+
+    def test_checks_run_before_the_file_appears(self) -> None:
+        with self.assertRaises(UploadError) as cm:
+            self._upload(io.BytesIO(_png(40, 20)))
+        self.assertEqual(cm.exception.msg, 'image is not squared')
+        self.assertEqual(self._saved_files(), [])
+
+        url = self._upload(io.BytesIO(_png(40, 40)))
+        self.assertEqual(self._saved_files(), [url.split('/', 2)[2]])
+        with Image.open(os.path.join(self.root, url.split('/', 1)[1])) as im:
+            self.assertEqual(im.size, (40, 40))
+
+    def test_huge_canvas_is_refused_before_decoding(self) -> None:
+        for width, max_source_dimension in ((13000, None), (20000, 10 ** 6)):  # the latter trips Pillow's own check
+            if max_source_dimension:
+                flask_app.config['UPLOAD']['image'] = dict(max_source_dimension=max_source_dimension)
+            with self.assertRaises(UploadError) as cm:
+                self._upload(io.BytesIO(_png_claiming(width, width)))
+            self.assertEqual(cm.exception.msg, 'image dimensions too large')
+        self.assertEqual(self._saved_files(), [])
+
+    def test_identical_images_share_one_normalised_file(self) -> None:
+        exif = Image.Exif()
+        exif[0x0112] = 6  # orientation: rotate 90° clockwise to display
+        exif[0x010f] = 'Camera Maker'
+        jpeg = io.BytesIO()
+        Image.new('RGB', (1024, 1024), 'green').save(jpeg, 'JPEG', exif=exif.tobytes())
+        url = self._upload(io.BytesIO(jpeg.getvalue()), 'photo.jpg')
+        self.assertRegex(url, r'^upload/avatar/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}\.png$')
+        with Image.open(os.path.join(self.root, url.split('/', 1)[1])) as im:
+            self.assertEqual((im.format, im.size), ('PNG', (512, 512)))
+            self.assertNotIn('exif', im.info)
+
+        self.assertEqual(self._upload(io.BytesIO(jpeg.getvalue()), 'again.jpeg'), url)
+        self.assertEqual(len(self._saved_files()), 1)
+
+        flask_app.config['UPLOAD']['image'] = dict(format='webp', max_dimension=64)
+        webp_url = self._upload(io.BytesIO(jpeg.getvalue()), 'photo.jpg')
+        self.assertTrue(webp_url.endswith('.webp'))
+        with Image.open(os.path.join(self.root, webp_url.split('/', 1)[1])) as im:
+            self.assertEqual(im.size, (64, 64))
+
+
+class SharedAvatarTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        self.root = tempfile.mkdtemp()
+        self.saved_upload = flask_app.config['UPLOAD']
+        flask_app.config['UPLOAD'] = dict(self.saved_upload, root_folder=self.root,
+                                          thumbnail=dict(folder=os.path.join(self.root, 'thumbnails'), sizes=[32]))
+        reset_thumbnail_cache()
+        self.ctx = flask_app.test_request_context()
+        self.ctx.push()
+        db.create_all()
+        self.users = [User(name='user%d' % i, email='user%d@example.com' % i, password='x', is_email_confirmed=True)
+                      for i in range(2)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self) -> None:
+        get_thumbnail_cache()._get_pool().shutdown(wait=True)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        flask_app.config['UPLOAD'] = self.saved_upload
+        reset_thumbnail_cache()
+        shutil.rmtree(self.root)
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_file_is_deleted_with_its_last_reference(self) -> None:
+        url = None
+        for user in self.users:
+            url = handle_upload(FileStorage(io.BytesIO(_png(40, 40)), filename='a.png'), 'avatar', image_check=True)
+            user.avatar = url
+        db.session.commit()
+        path = os.path.join(self.root, url.split('/', 1)[1])
+        os.utime(path, (0, 0))  # past the grace period for fresh uploads
+
+        self.users[0].avatar = None
+        handle_post_upload(url, 'avatar')
+        self.assertTrue(os.path.exists(path))  # user1 still uses it
+
+        self.users[1].avatar = None
+        handle_post_upload(url, 'avatar')
+        self.assertFalse(os.path.exists(path))
+
+    def test_quick_replacements_are_swept_later(self) -> None:
+        client = flask_app.test_client()
+        with client.session_transaction() as sess:
+            sess['user_id'] = self.users[0].id
+        urls = []
+        for size in (40, 41, 42):  # each replaces the last within the grace period
+            response = client.put('/api/account/me', data={'avatar': (io.BytesIO(_png(size, size)), 'a.png')},
+                                  content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 200)
+            urls.append(response.get_json()['avatar'])
+        paths = [os.path.join(self.root, url.split('/', 1)[1]) for url in urls]
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+        self.assertEqual(sweep_uploads(), 0)  # still within the grace period
+        for path in paths:
+            os.utime(path, (0, 0))
+        self.assertEqual(sweep_uploads(), 2)
+        self.assertEqual([os.path.exists(path) for path in paths], [False, False, True])
+
+    def test_reupload_during_release_keeps_the_file(self) -> None:
+        url = handle_upload(FileStorage(io.BytesIO(_png(40, 40)), filename='a.png'), 'avatar', image_check=True)
+        path = os.path.join(self.root, url.split('/', 1)[1])
+        os.utime(path, (0, 0))
+        uploaded = []
+
+        def reupload() -> None:
+            with flask_app.test_request_context():
+                uploaded.append(handle_upload(FileStorage(io.BytesIO(_png(40, 40)), filename='a.png'), 'avatar',
+                                              image_check=True))
+
+        getmtime = os.path.getmtime
+        thread = threading.Thread(target=reupload)
+
+        def getmtime_then_reupload(name):
+            mtime = getmtime(name)  # the release has seen the old mtime ...
+            thread.start()  # ... when another worker stores the same image again
+            thread.join(0.5)
+            return mtime
+
+        with mock.patch('utils.upload.os.path.getmtime', side_effect=getmtime_then_reupload):
+            handle_post_upload(url, 'avatar')
+        thread.join()
+        self.assertEqual(uploaded, [url])
+        self.assertTrue(os.path.exists(path))
+
+    def test_content_addressed_files_are_immutable(self) -> None:
+        url = handle_upload(FileStorage(io.BytesIO(_png(40, 40)), filename='a.png'), 'avatar', image_check=True)
+        response = flask_app.test_client().get('/' + url)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
+
+
+class UploadRequestLimitTests(unittest.TestCase):
+    def setUp(self) -> None:
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
+        self.ctx = flask_app.app_context()
+        self.ctx.push()
+        db.create_all()
+        user = User(name='alice', email='alice@example.com', password='x', is_email_confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        self.client = flask_app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['user_id'] = user.id
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def test_oversized_body_is_refused_before_parsing(self) -> None:
+        body = b'\x89PNG\r\n\x1a\n' + b'\0' * (flask_app.config['UPLOAD']['avatar']['size_limit'] + 128 * 1024)
+        response = self.client.put('/api/account/me', data={'avatar': (io.BytesIO(body), 'a.png')},
+                                   content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.get_json()['msg'], 'request too large')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import logging
+import os
+import queue
+import threading
+from typing import Any, Callable
+
+from flask import current_app as app
+
+logger = logging.getLogger(__name__)
+
+_tasks: queue.Queue = queue.Queue()
+_lock = threading.Lock()
+_worker: threading.Thread | None = None
+_worker_pid: int | None = None
+
+
+def _run(flask_app) -> None:
+    from models import db
+    while True:
+        fn, args = _tasks.get()
+        try:
+            with flask_app.app_context():
+                try:
+                    fn(*args)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Deferred write %s failed', getattr(fn, '__name__', fn))
+                finally:
+                    db.session.remove()
+        finally:
+            _tasks.task_done()
+
+
+def defer_write(fn: Callable[..., Any], *args: Any) -> None:
+    """Run ``fn(*args)`` later on this process's background writer thread, in its own app context and session.
+
+    The session is committed after ``fn`` returns. Lets read-only request paths hand off writes they discover;
+    tasks still queued when the process exits are lost, so only defer writes that are safe to miss or repeat.
+    """
+    global _worker, _worker_pid
+    with _lock:
+        if _worker is None or _worker_pid != os.getpid() or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, args=(app._get_current_object(),), name='deferred-writes',
+                                       daemon=True)
+            _worker.start()
+            _worker_pid = os.getpid()
+    _tasks.put((fn, args))
+
+
+def wait_for_deferred_writes() -> None:
+    """Block until every deferred write queued so far has run."""
+    _tasks.join()
@@ -4,8 +4,7 @@ import requests
 from flask import current_app as app
 
 from models import User
-from services.login_record import LoginRecordService
-from services.user import UserService
+from services.login_throttle import get_login_throttle
 
 
 def _captcha_config() -> dict[str, Any]:
@@ -40,11 +39,11 @@ def captcha_required_for_login(user: User | None, ip: str) -> bool:
     if not is_captcha_enabled():
         return False
 
-    time_span = UserService.login_recent_failures_time_span
+    throttle = get_login_throttle()
     if user is not None:
-        if LoginRecordService.count_recent_failures_for_user(user, time_span) >= 1:
+        if throttle.count_user_failures(user) >= 1:
             return True
-    if ip and LoginRecordService.count_recent_failures_for_ip(ip, time_span) >= 1:
+    if ip and throttle.count_ip_failures(ip) >= 1:
         return True
     return False
 
@@ -0,0 +1,36 @@
+import hashlib
+
+from flask import Response, request
+
+
+def make_etag(*parts) -> str:
+    """Hash ``parts`` (ids, ``modified_at`` values, ...) into an ETag value."""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def user_version(user) -> tuple:
+    """What ``user.to_dict()`` depends on: the user's own row and, since group membership lives in an association
+    table that does not touch ``modified_at``, the id and ``modified_at`` of every group the user is in."""
+    return user.id, user.modified_at, sorted((group.id, group.modified_at) for group in user.groups)
+
+
+def not_modified(etag: str) -> Response | None:
+    """Return a 304 response if the request's If-None-Match already has ``etag``, otherwise None.
+
+    Check this before serialising the resource; that is the work a 304 saves.
+    """
+    if request.if_none_match.contains(etag):
+        return _revalidate_privately(Response(status=304), etag)
+    return None
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    """Mark the response to a signed-in user's request as revalidatable with ``etag``."""
+    return _revalidate_privately(response, etag)
+
+
+def _revalidate_privately(response: Response, etag: str) -> Response:
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # clients may store it but must revalidate
+    response.cache_control.private = True  # per user: shared proxies must not store it for other clients
+    return response
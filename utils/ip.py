@@ -1,45 +1,161 @@
 import logging
+import os
 import socket
-from typing import Callable, Literal, Optional, TypeVar
+import threading
+import time
+from typing import Callable, Iterable, Optional, TypeVar
 
 import geoip2.database
+import maxminddb
+from flask import current_app as app, has_app_context
 from geoip2.errors import AddressNotFoundError
 from geoip2.models import City, ASN, Country
 
+from utils.ttl_cache import TTLCache
+
 logger = logging.getLogger(__name__)
 
-_GeoDb = geoip2.database.Reader | Literal[False] | None
-_GeoLookupResult = TypeVar('_GeoLookupResult')
+_DEFAULT_CACHE_SIZE = 65536
+_MISSING = object()
 
-_geo_country_db: _GeoDb = None
-_geo_city_db: _GeoDb = None
-_geo_asn_db: _GeoDb = None
+_DEFAULT_RELOAD_CHECK_SECONDS = 60
+_GeoLookupResult = TypeVar('_GeoLookupResult')
 
 
-def _open_geo_db(path: str, label: str) -> geoip2.database.Reader | Literal[False]:
+def _reader_mode() -> int:
+    # MODE_MMAP_EXT is the C extension reading the mapped file; it is only there when libmaxminddb was found at install
     try:
-        logger.info('Loading GeoLite2 %s...', label)
-        return geoip2.database.Reader(path)
-    except (FileNotFoundError, OSError) as exc:
-        logger.warning('GeoLite2 %s database unavailable at %s: %s', label, path, exc)
-        return False
+        import maxminddb.extension  # noqa: F401
+        return maxminddb.MODE_MMAP_EXT
+    except ImportError:
+        return maxminddb.MODE_MMAP
+
+
+class _GeoDatabase:
+    """One GeoLite2 file, memory-mapped so every worker shares the page cache, reopened once the file is replaced.
+
+    ``scripts/download-mmdb.sh`` renames new files into place, so a changed inode, size or mtime means a complete new
+    database. The old reader is not closed: lookups in flight on other threads may still use it, and it unmaps itself
+    once the last of them lets go.
+    """
+
+    def __init__(self, path: str, label: str) -> None:
+        self.path = path
+        self.label = label
+        self.reader: geoip2.database.Reader | None = None
+        self._signature: tuple[int, int, int] | None = None
+        self._warned = False
+        self._checked_at: float | None = None
+        self._lock = threading.Lock()
+
+    def get_reader(self) -> geoip2.database.Reader | None:
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is None or now - checked_at >= _reload_check_seconds():
+            with self._lock:
+                if self._checked_at == checked_at:  # not refreshed by another thread meanwhile
+                    self._checked_at = now
+                    self._refresh()
+        return self.reader
+
+    def open(self) -> None:
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self._refresh()
+
+    def _refresh(self) -> None:
+        try:
+            stat = os.stat(self.path)
+        except OSError as exc:
+            if not self._warned:  # once, not on every check
+                logger.warning('GeoLite2 %s database unavailable at %s: %s', self.label, self.path, exc)
+                self._warned = True
+            return  # a reader that is already open keeps serving the file it mapped
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if signature == self._signature:
+            return
+        try:
+            logger.info('Loading GeoLite2 %s...', self.label)
+            reader = geoip2.database.Reader(self.path, mode=_reader_mode())
+        except (OSError, ValueError) as exc:  # ValueError: not a MaxMind database (e.g. cut short)
+            logger.warning('GeoLite2 %s database at %s could not be opened: %s', self.label, self.path, exc)
+            return
+        reloaded = self.reader is not None
+        self.reader = reader
+        self._signature = signature
+        self._warned = False
+        if reloaded:
+            _forget_geo_results(self.label)
+            logger.info('Reloaded GeoLite2 %s database', self.label)
+
+
+_geo_country_db = _GeoDatabase('mmdb/GeoLite2-Country.mmdb', 'Country')
+_geo_city_db = _GeoDatabase('mmdb/GeoLite2-City.mmdb', 'City')
+_geo_asn_db = _GeoDatabase('mmdb/GeoLite2-ASN.mmdb', 'ASN')
+
+# (database label, ip) -> lookup result, None included: addresses missing from the database are asked about as often
+_geo_cache: TTLCache[tuple[str, str], object] | None = None
+_stats_lock = threading.Lock()
+_reader_lookups = 0
+_reader_seconds = 0.0
+
+
+def _geo_config() -> dict:
+    cfg = app.config.get('GEOIP') if has_app_context() else None
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def _reload_check_seconds() -> float:
+    return float(_geo_config().get('reload_check_seconds', _DEFAULT_RELOAD_CHECK_SECONDS))
+
+
+def _get_geo_cache() -> TTLCache[tuple[str, str], object]:
+    global _geo_cache
+    if _geo_cache is None:
+        _geo_cache = TTLCache(int(_geo_config().get('cache_size', _DEFAULT_CACHE_SIZE)))
+    return _geo_cache
+
+
+def _forget_geo_results(label: str) -> None:
+    if _geo_cache is not None:
+        _geo_cache.discard_where(lambda key, _: key[0] == label)
+
+
+def init_geo_databases(app) -> None:
+    """Open the databases now, so the first request of each worker does not pay for it."""
+    with app.app_context():
+        for db in (_geo_country_db, _geo_city_db, _geo_asn_db):
+            db.open()
 
 
 def _lookup_geo(
     ip_addr: str,
-    db: _GeoDb,
-    path: str,
-    label: str,
+    db: _GeoDatabase,
     lookup: Callable[[geoip2.database.Reader, str], _GeoLookupResult],
-) -> tuple[_GeoDb, Optional[_GeoLookupResult]]:
-    if db is None:
-        db = _open_geo_db(path, label)
-    if db is False:
-        return db, None
-    try:
-        return db, lookup(db, ip_addr)
-    except AddressNotFoundError:
-        return db, None
+) -> Optional[_GeoLookupResult]:
+    reader = db.get_reader()
+    if reader is None:
+        return None
+    cache = _get_geo_cache()
+    key = (db.label, ip_addr)
+    result = cache.get(key, _MISSING)
+    if result is _MISSING:
+        started = time.perf_counter()
+        try:
+            result = lookup(reader, ip_addr)
+        except AddressNotFoundError:
+            result = None
+        finally:
+            _record_reader_lookup(time.perf_counter() - started)
+        cache.put(key, result)
+    return result
+
+
+def _record_reader_lookup(seconds: float) -> None:
+    global _reader_lookups, _reader_seconds
+    with _stats_lock:
+        _reader_lookups += 1
+        _reader_seconds += seconds
 
 
 class IPInfo:
@@ -91,39 +207,15 @@ class IPCountryInfo:
 
 
 def get_geo_country(ip_addr: str) -> Optional[Country]:
-    global _geo_country_db
-    _geo_country_db, result = _lookup_geo(
-        ip_addr,
-        _geo_country_db,
-        'mmdb/GeoLite2-Country.mmdb',
-        'Country',
-        lambda reader, addr: reader.country(addr),
-    )
-    return result
+    return _lookup_geo(ip_addr, _geo_country_db, lambda reader, addr: reader.country(addr))
 
 
 def get_geo_city(ip_addr: str) -> Optional[City]:
-    global _geo_city_db
-    _geo_city_db, result = _lookup_geo(
-        ip_addr,
-        _geo_city_db,
-        'mmdb/GeoLite2-City.mmdb',
-        'City',
-        lambda reader, addr: reader.city(addr),
-    )
-    return result
+    return _lookup_geo(ip_addr, _geo_city_db, lambda reader, addr: reader.city(addr))
 
 
 def get_geo_asn(ip_addr: str) -> Optional[ASN]:
-    global _geo_asn_db
-    _geo_asn_db, result = _lookup_geo(
-        ip_addr,
-        _geo_asn_db,
-        'mmdb/GeoLite2-ASN.mmdb',
-        'ASN',
-        lambda reader, addr: reader.asn(addr),
-    )
-    return result
+    return _lookup_geo(ip_addr, _geo_asn_db, lambda reader, addr: reader.asn(addr))
 
 
 def get_hostname(ip_addr: str) -> Optional[str]:
@@ -139,3 +231,27 @@ def get_ip_info(ip_addr: str, resolve_hostname: bool = False) -> IPInfo:
 
 def get_ip_country_info(ip_addr: str) -> IPCountryInfo:
     return IPCountryInfo(get_geo_country(ip_addr))
+
+
+def lookup_many(ips: Iterable[str], country_only: bool = False, locale: str = 'en-US') -> dict[str, dict]:
+    """Map each distinct ip in ``ips`` to its ``IPCountryInfo`` (``country_only``) or ``IPInfo`` dict."""
+    if country_only:
+        return {ip: get_ip_country_info(ip).to_dict(locale) for ip in set(ips)}
+    return {ip: get_ip_info(ip).to_dict(locale) for ip in set(ips)}
+
+
+def get_geo_stats() -> dict:
+    stats = _get_geo_cache().stats()
+    with _stats_lock:
+        stats['reader_lookups'] = _reader_lookups
+        stats['reader_mean_ms'] = _reader_seconds * 1000 / _reader_lookups if _reader_lookups else None
+    return stats
+
+
+def reset_geo_cache() -> None:
+    """Drop the cached results and counters so the next use re-reads GEOIP (mainly for tests)."""
+    global _geo_cache, _reader_lookups, _reader_seconds
+    with _stats_lock:
+        _geo_cache = None
+        _reader_lookups = 0
+        _reader_seconds = 0.0
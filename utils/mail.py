@@ -1,18 +1,21 @@
 import logging
 import os
-import re
 import smtplib
+import ssl
 import time
 from email.headerregistry import Address
 from email.message import EmailMessage
+from functools import lru_cache
 from subprocess import Popen, PIPE
-from typing import List
+from typing import Callable, List
 
 from flask import current_app as app
 
+from utils.mail_templates import get_mail_template
 from utils.profile_validation import display_name
 
-_templates = {}
+_DEFAULT_SMTP_TIMEOUT_SECONDS = 30
+
 _logger = logging.getLogger(__name__)
 
 
@@ -29,27 +32,78 @@ def build_confirm_email_url(user) -> str:
     )
 
 
+@lru_cache(maxsize=1024)
+def _address(name: str, email: str) -> Address:
+    user, domain = email.split('@', 1)
+    return Address(name, user, domain)
+
+
 def _build_address_list(recipient_list: list) -> List[Address]:
-    addresses = []
-    for name, email in recipient_list:
-        to_user, to_domain = email.split('@', 1)
-        addresses.append(Address(name, to_user, to_domain))
-    return addresses
+    return [_address(name, email) for name, email in recipient_list]
 
 
 def send_email(to_name, to_email, template, **kwargs):
     send_emails([(to_name, to_email)], [], [], template, **kwargs)
 
 
+def commit_and_send_email(to_name, to_email, template, **kwargs):
+    """Commit the current transaction and send an email about the change it makes.
+
+    A queued message is committed together with the change; a directly delivered one is only sent once the commit
+    has succeeded, so a failed commit never mails out a token that was not saved.
+    """
+    from models import db
+    if is_mail_outbox_enabled():
+        send_email(to_name, to_email, template, **kwargs)
+        db.session.commit()
+    else:
+        db.session.commit()
+        send_email(to_name, to_email, template, **kwargs)
+
+
 def send_emails(to_list, cc_list, bcc_list, template, **kwargs):
+    """Send a system or personal email.
+
+    With ``MAIL.outbox.enabled``, the message is only added to the mail outbox in the current database transaction
+    (so callers must commit) and ``flask mail-worker`` delivers it. Otherwise it is delivered right away.
+    """
     if not is_mail_enabled():
         _logger.debug('Outbound email skipped (MAIL.enabled is false)')
         return
 
+    send_messages([build_email(to_list, cc_list, bcc_list, template, **kwargs)])
+
+
+def send_messages(messages: List[EmailMessage], on_sent: Callable[[int], None] | None = None) -> None:
+    """Send already built messages: queue them all in the mail outbox, or deliver them over one transport.
+
+    ``on_sent(index)`` is called after each message is queued or delivered, so a caller can record the ones that
+    went out before a later one fails. Does not check ``is_mail_enabled()``; as with ``send_emails``, outbox callers
+    must commit.
+    """
+    if is_mail_outbox_enabled():
+        from services.mail_outbox import enqueue_email
+        for index, msg in enumerate(messages):
+            enqueue_email(msg)
+            if on_sent is not None:
+                on_sent(index)
+        return
+    with MailTransport(app.config['MAIL']) as transport:
+        for index, msg in enumerate(messages):
+            transport.send(msg)
+            if on_sent is not None:
+                on_sent(index)
+
+
+def is_mail_outbox_enabled() -> bool:
+    outbox_config = (app.config.get('MAIL') or {}).get('outbox') or {}
+    return bool(outbox_config.get('enabled', False))
+
+
+def build_email(to_list, cc_list, bcc_list, template, **kwargs) -> EmailMessage:
     mail_config = app.config['MAIL']
 
     msg = EmailMessage()
-    from_user, from_domain = mail_config['from'].split('@', 1)
     from_name = mail_config['display_name']
 
     sender = kwargs.get('sender')
@@ -59,13 +113,11 @@ def send_emails(to_list, cc_list, bcc_list, template, **kwargs):
     user = kwargs.get('user')
     if user is not None:
         kwargs = {**kwargs, 'user_display_name': display_name(user)}
-    msg['From'] = Address(from_name, from_user, from_domain)
+    msg['From'] = _address(from_name, mail_config['from'])
 
     reply_to_address = mail_config.get('reply_to')
     if reply_to_address:
-        reply_to_user, reply_to_domain = reply_to_address.split('@', 1)
-        reply_to_name = mail_config.get('reply_to_name') or ''
-        msg['Reply-To'] = Address(reply_to_name, reply_to_user, reply_to_domain)
+        msg['Reply-To'] = _address(mail_config.get('reply_to_name') or '', reply_to_address)
 
     if to_list:
         msg['To'] = _build_address_list(to_list)
@@ -75,49 +127,86 @@ def send_emails(to_list, cc_list, bcc_list, template, **kwargs):
         msg['Bcc'] = _build_address_list(bcc_list)
 
     if template:
-        temp = _templates.get(template)
-        if temp is None:
-            temp = {}
-            txt_path = os.path.join('mail_templates', template + '.txt')
-            html_path = os.path.join('mail_templates', template + '.html')
-            with open(txt_path) as f_txt:
-                txt = f_txt.read()
-                temp['subject'], temp['text'] = txt.split('\n', 1)
-            if os.path.isfile(html_path):
-                with open(html_path) as f_html:
-                    temp['html'] = f_html.read()
-            _templates[template] = temp
-
-        msg['Subject'] = temp['subject'].format(**kwargs)
-        msg.set_content(temp['text'].format(**kwargs))
-        temp_html = temp.get('html')
-        if temp_html:
-            # In html templates, double curly-braces are used for string interpolation to avoid conflict with css and js
-            # functions
-            html = re.sub(r"(\{\{[^}]+\}\})", lambda m: m.group(1)[1:-1].format(**kwargs), temp_html)
-            msg.add_alternative(html, subtype='html')
+        temp = get_mail_template(template)
+        msg['Subject'] = temp.subject.render(kwargs)
+        msg.set_content(temp.text.render(kwargs))
+        if temp.html is not None:
+            msg.add_alternative(temp.html.render(kwargs), subtype='html')
     else:
         msg['Subject'] = kwargs.get('subject', '<No Subject>')
         msg.set_content(kwargs.get('body', '<No Body>'))
-
-    # use mock folder?
-    mock_folder = mail_config.get('mock_folder')
-    if mock_folder:
-        for name, email in to_list:
-            folder = os.path.join(mock_folder, email)
-            if not os.path.isdir(folder):
-                os.makedirs(folder)
-            with open(os.path.join(folder, '%f.txt' % time.time()), 'w') as f:
-                f.write("From: %s\nSubject: %s\n\n%s" % (str(msg['From']), msg['Subject'], msg.get_body()))
-        return
-
-    # use mail catcher? (https://github.com/sj26/mailcatcher)
-    mail_catcher_config = mail_config.get('mail_catcher')
-    if mail_catcher_config:
-        with smtplib.SMTP(host=mail_catcher_config.get('host'), port=mail_catcher_config.get('port')) as smtp:
-            smtp.send_message(msg)
-        return
-
-    # use sendmail directly
-    p = Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=PIPE)
-    p.communicate(msg.as_bytes())
+    return msg
+
+
+class MailTransport:
+    """Delivers messages the way MAIL configures: mock folder, mail catcher, SMTP relay or local sendmail.
+
+    The SMTP session (mail catcher or relay) is opened on first use and reused by later send() calls until close(),
+    so a batch of messages costs one connection and one login.
+    """
+
+    def __init__(self, mail_config: dict):
+        self.mail_config = mail_config
+        self._smtp: smtplib.SMTP | None = None
+
+    def __enter__(self) -> 'MailTransport':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _smtp_config(self) -> dict | None:
+        # use mail catcher? (https://github.com/sj26/mailcatcher)
+        return self.mail_config.get('mail_catcher') or self.mail_config.get('smtp')
+
+    def _connect(self, smtp_config: dict) -> smtplib.SMTP:
+        host = smtp_config.get('host')
+        timeout = smtp_config.get('timeout_seconds', _DEFAULT_SMTP_TIMEOUT_SECONDS)
+        if smtp_config.get('ssl'):
+            smtp = smtplib.SMTP_SSL(host=host, port=smtp_config.get('port') or 465, timeout=timeout,
+                                    context=ssl.create_default_context())
+        else:
+            smtp = smtplib.SMTP(host=host, port=smtp_config.get('port') or 25, timeout=timeout)
+            if smtp_config.get('starttls'):
+                smtp.starttls(context=ssl.create_default_context())
+        username = smtp_config.get('username')
+        if username:
+            smtp.login(username, smtp_config.get('password') or '')
+        return smtp
+
+    def send(self, msg: EmailMessage) -> None:
+        # use mock folder?
+        mock_folder = self.mail_config.get('mock_folder')
+        if mock_folder:
+            for address in msg['To'].addresses if msg['To'] else ():
+                folder = os.path.join(mock_folder, address.addr_spec)
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                with open(os.path.join(folder, '%f.txt' % time.time()), 'w') as f:
+                    f.write("From: %s\nSubject: %s\n\n%s" % (str(msg['From']), msg['Subject'], msg.get_body()))
+            return
+
+        smtp_config = self._smtp_config()
+        if smtp_config:
+            if self._smtp is None:
+                self._smtp = self._connect(smtp_config)
+            try:
+                self._smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:  # the relay dropped an idle session; retry once on a fresh one
+                self._smtp = self._connect(smtp_config)
+                self._smtp.send_message(msg)
+            return
+
+        # use sendmail directly
+        p = Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=PIPE)
+        p.communicate(msg.as_bytes())
+        if p.returncode:
+            raise RuntimeError('sendmail exited with status %d' % p.returncode)
+
+    def close(self) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except smtplib.SMTPException:
+                pass
+            self._smtp = None
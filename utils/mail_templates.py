@@ -0,0 +1,192 @@
+import os
+import re
+import threading
+from dataclasses import dataclass
+from string import Formatter
+from typing import Any, Callable, Mapping
+
+from flask import current_app as app
+
+# In html templates, double curly-braces are used for string interpolation to avoid conflict with css and js functions
+_HTML_PLACEHOLDER = re.compile(r"(\{\{[^}]+\}\})")
+# the ".attr" and "[key]" parts after a field's first name, as str.format reads them
+_FIELD_LOOKUP = re.compile(r"\.([^.\[]+)|\[([^\]]+)\]")
+
+_DEFAULT_FOLDER = 'mail_templates'
+
+_Field = Callable[[Mapping[str, Any]], str]
+
+_templates: dict[str, 'MailTemplate'] = {}
+_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class RenderPlan:
+    """A template pre-split into (literal, field) segments; ``field`` is None for the trailing literal."""
+    segments: tuple[tuple[str, _Field | None], ...]
+
+    def render(self, values: Mapping[str, Any]) -> str:
+        parts = []
+        for literal, field in self.segments:
+            parts.append(literal)
+            if field is not None:
+                parts.append(field(values))
+        return ''.join(parts)
+
+
+@dataclass(frozen=True)
+class MailTemplate:
+    subject: RenderPlan
+    text: RenderPlan
+    html: RenderPlan | None
+    source_mtimes: tuple[float | None, float | None]
+
+
+def _compile_field(field_name: str, format_spec: str, conversion: str | None) -> _Field:
+    if '{' in format_spec:  # nested replacement fields in the spec are rare; let str.format handle them
+        source = '{%s%s:%s}' % (field_name, '!' + conversion if conversion else '', format_spec)
+        return lambda values: source.format_map(values)
+
+    first, lookups = _split_field_name(field_name)
+    if first.isdigit() or first == '':
+        raise ValueError('positional field {%s} is not supported in mail templates' % field_name)
+
+    def field(values: Mapping[str, Any]) -> str:
+        obj = values[first]
+        for is_attr, key in lookups:
+            obj = getattr(obj, key) if is_attr else obj[key]
+        if conversion == 's':
+            obj = str(obj)
+        elif conversion == 'r':
+            obj = repr(obj)
+        elif conversion == 'a':
+            obj = ascii(obj)
+        return format(obj, format_spec)
+
+    return field
+
+
+def _split_field_name(field_name: str) -> tuple[str, tuple[tuple[bool, str | int], ...]]:
+    """Split ``user.name`` or ``links[0]`` into the first name and its ``(is_attr, key)`` lookups."""
+    first = re.split(r'[.\[]', field_name, maxsplit=1)[0]
+    rest = field_name[len(first):]
+    lookups = []
+    pos = 0
+    while pos < len(rest):
+        match = _FIELD_LOOKUP.match(rest, pos)
+        if match is None:
+            raise ValueError('invalid field {%s}' % field_name)
+        attr, key = match.groups()
+        lookups.append((True, attr) if attr is not None else (False, int(key) if key.isdigit() else key))
+        pos = match.end()
+    return first, tuple(lookups)
+
+
+def _merge(items: list[str | _Field]) -> RenderPlan:
+    segments = []
+    literal = ''
+    for item in items:
+        if isinstance(item, str):
+            literal += item
+        else:
+            segments.append((literal, item))
+            literal = ''
+    segments.append((literal, None))
+    return RenderPlan(tuple(segments))
+
+
+def _format_items(source: str) -> list[str | _Field]:
+    items = []
+    for literal, field_name, format_spec, conversion in Formatter().parse(source):
+        if literal:
+            items.append(literal)
+        if field_name is not None:
+            items.append(_compile_field(field_name, format_spec, conversion))
+    return items
+
+
+def compile_format(source: str) -> RenderPlan:
+    """Compile a ``str.format`` template; ``plan.render(values)`` equals ``source.format(**values)``."""
+    return _merge(_format_items(source))
+
+
+def compile_html(source: str) -> RenderPlan:
+    """Compile an html template in which only ``{{field}}`` placeholders are interpolated."""
+    items = []
+    for i, piece in enumerate(_HTML_PLACEHOLDER.split(source)):
+        if i % 2:  # a '{{...}}' placeholder
+            items.extend(_format_items(piece[1:-1]))
+        elif piece:
+            items.append(piece)
+    return _merge(items)
+
+
+def _source_paths(name: str, folder: str) -> tuple[str, str]:
+    return os.path.join(folder, name + '.txt'), os.path.join(folder, name + '.html')
+
+
+def _mtime(path: str) -> float | None:
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def load_mail_template(name: str, folder: str = _DEFAULT_FOLDER) -> MailTemplate:
+    txt_path, html_path = _source_paths(name, folder)
+    mtimes = (_mtime(txt_path), _mtime(html_path))
+    with open(txt_path) as f_txt:
+        subject, text = f_txt.read().split('\n', 1)
+    html = None
+    if mtimes[1] is not None:
+        with open(html_path) as f_html:
+            html_source = f_html.read()
+        if html_source:
+            html = compile_html(html_source)
+    return MailTemplate(compile_format(subject), compile_format(text), html, mtimes)
+
+
+def _is_stale(name: str, template: MailTemplate, folder: str) -> bool:
+    return tuple(_mtime(path) for path in _source_paths(name, folder)) != template.source_mtimes
+
+
+def _reload_enabled() -> bool:
+    mail_config = app.config.get('MAIL') or {}
+    return bool(mail_config.get('reload_templates', app.debug))
+
+
+def get_mail_template(name: str, folder: str = _DEFAULT_FOLDER) -> MailTemplate:
+    """Return the compiled template, compiling it on first use.
+
+    With MAIL.reload_templates (defaults to the Flask debug flag), edited template files are recompiled.
+    """
+    template = _templates.get(name)
+    if template is None or (_reload_enabled() and _is_stale(name, template, folder)):
+        template = load_mail_template(name, folder)
+        with _lock:
+            _templates[name] = template
+    return template
+
+
+def compile_mail_templates(folder: str = _DEFAULT_FOLDER) -> int:
+    """Compile every template in ``folder`` up front, so a broken template fails at startup. Returns the count."""
+    if not os.path.isdir(folder):
+        return 0
+    names = sorted(f[:-4] for f in os.listdir(folder) if f.endswith('.txt'))
+    compiled = {name: load_mail_template(name, folder) for name in names}
+    with _lock:
+        _templates.update(compiled)
+    return len(compiled)
+
+
+def invalidate_mail_templates(name: str | None = None) -> None:
+    """Drop one (or every) compiled template so it is recompiled from disk on next use."""
+    with _lock:
+        if name is None:
+            _templates.clear()
+        else:
+            _templates.pop(name, None)
+
+
+def init_app(flask_app) -> None:
+    compile_mail_templates()
@@ -0,0 +1,242 @@
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from typing import Any, Callable, Sequence, TypeVar
+
+from flask import current_app as app
+from passlib.context import CryptContext
+
+from error import BasicError
+
+logger = logging.getLogger(__name__)
+
+_T = TypeVar('_T')
+
+_DEFAULT_MAX_WORKERS = 2
+_DEFAULT_QUEUE_DEPTH = 8
+_DEFAULT_TIMEOUT_SECONDS = 15
+_DEFAULT_RETRY_AFTER_SECONDS = 2
+_DEFAULT_CONTEXT = {'schemes': ['pbkdf2_sha256']}
+
+_lock = threading.Lock()
+_executor: ProcessPoolExecutor | None = None
+_slots: threading.BoundedSemaphore | None = None
+_contexts: dict[str, CryptContext] = {}
+
+
+class PasswordHashingBusyError(BasicError):
+    def __init__(self, retry_after: int) -> None:
+        super().__init__('server busy', detail='Too many password operations in progress. Please try again shortly.')
+        self.retry_after = retry_after
+
+
+def _get_context(context_config: dict[str, Any]) -> CryptContext:
+    """Build (once per process) the CryptContext for a PASSWORD_HASHING.context dict.
+
+    The worker functions receive the plain dict rather than a CryptContext so that they stay picklable for the
+    process pool; each pool process then keeps its own compiled copy.
+    """
+    key = json.dumps(context_config, sort_keys=True)
+    context = _contexts.get(key)
+    if context is None:
+        context = _contexts[key] = CryptContext(**context_config)
+    return context
+
+
+def _hash(context_config: dict[str, Any], password: str) -> str:
+    return _get_context(context_config).hash(password)
+
+
+def _verify(context_config: dict[str, Any], password: str, password_hash: str) -> bool:
+    return _get_context(context_config).verify(password, password_hash)
+
+
+def _verify_and_update(context_config: dict[str, Any], password: str, password_hash: str) -> tuple[bool, str | None]:
+    return _get_context(context_config).verify_and_update(password, password_hash)
+
+
+def _hashing_config() -> dict[str, Any]:
+    cfg = app.config.get('PASSWORD_HASHING')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def _context_config() -> dict[str, Any]:
+    context_config = _hashing_config().get('context')
+    return context_config if isinstance(context_config, dict) and context_config else _DEFAULT_CONTEXT
+
+
+def _uses_process_pool() -> bool:
+    return _hashing_config().get('executor', 'process') == 'process'
+
+
+def _max_workers() -> int:
+    return int(_hashing_config().get('max_workers', _DEFAULT_MAX_WORKERS))
+
+
+def _get_slots() -> threading.BoundedSemaphore:
+    """Admission control: at most max_workers running plus queue_depth waiting, across all request threads."""
+    global _slots
+    if _slots is None:
+        with _lock:
+            if _slots is None:
+                cfg = _hashing_config()
+                capacity = _max_workers() + int(cfg.get('queue_depth', _DEFAULT_QUEUE_DEPTH))
+                _slots = threading.BoundedSemaphore(capacity)
+    return _slots
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                max_workers = _max_workers()
+                # spawn instead of fork: the parent is a multi-threaded gunicorn worker
+                _executor = ProcessPoolExecutor(max_workers=max_workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+                logger.info('Started password hashing pool with %d process(es)', max_workers)
+    return _executor
+
+
+def _retry_after() -> int:
+    return int(_hashing_config().get('retry_after_seconds', _DEFAULT_RETRY_AFTER_SECONDS))
+
+
+def submit_password_task(fn: Callable[..., _T], *args: Any, admission_timeout: float = 0) -> Future:
+    """Submit a CPU-heavy password task, or raise PasswordHashingBusyError if the queue is full.
+
+    By default a full queue is rejected at once; ``admission_timeout`` waits that many seconds for a free slot.
+    ``fn`` must be a picklable module-level function when the process pool is enabled.
+    """
+    slots = _get_slots()
+    acquired = slots.acquire(timeout=admission_timeout) if admission_timeout > 0 else slots.acquire(blocking=False)
+    if not acquired:
+        raise PasswordHashingBusyError(_retry_after())
+    try:
+        if _uses_process_pool():
+            future = _get_executor().submit(fn, *args)
+        else:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def _timeout() -> float:
+    return float(_hashing_config().get('timeout_seconds', _DEFAULT_TIMEOUT_SECONDS))
+
+
+def wait_password_task(future: Future) -> Any:
+    try:
+        return future.result(timeout=_timeout())
+    except FutureTimeoutError:
+        future.cancel()
+        raise PasswordHashingBusyError(_retry_after())
+
+
+def run_password_task(fn: Callable[..., _T], *args: Any) -> _T:
+    return wait_password_task(submit_password_task(fn, *args))
+
+
+def hash_password(password: str) -> str:
+    return run_password_task(_hash, _context_config(), password)
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    return run_password_task(_verify, _context_config(), password, password_hash)
+
+
+def verify_password_and_update(password: str, password_hash: str) -> tuple[bool, str | None]:
+    """Verify a password and, if its hash uses a deprecated scheme or cost, also return a replacement hash.
+
+    Returns ``(matched, new_hash)`` where ``new_hash`` is None unless the stored hash should be upgraded.
+    """
+    return run_password_task(_verify_and_update, _context_config(), password, password_hash)
+
+
+def find_matching_password_hash(password: str, password_hashes: Sequence[str]) -> int | None:
+    """Return the lowest index of a hash in ``password_hashes`` that ``password`` matches, or None if none does.
+
+    With ``executor: "process"`` up to max_workers verifications run at once; once one matches, no more are
+    submitted, and the result is returned as soon as every lower index has been checked (the others are cancelled).
+    With ``executor: "inline"`` the verifications run one after another on the calling thread. Only the first
+    verification goes through admission control: once admitted, a busy pool makes this wait for free slots instead
+    of failing halfway.
+    """
+    context_config = _context_config()
+    parallelism = max(1, _max_workers())
+    queued = deque(enumerate(password_hashes))
+    in_flight: dict[Future, int] = {}
+    admitted = False
+    best: int | None = None
+    try:
+        while True:
+            while best is None and queued and len(in_flight) < parallelism:
+                index, password_hash = queued[0]
+                try:
+                    future = submit_password_task(_verify, context_config, password, password_hash,
+                                                  admission_timeout=_timeout() if admitted and not in_flight else 0)
+                except PasswordHashingBusyError:
+                    if in_flight:
+                        break  # wait for one of ours to finish first
+                    raise
+                admitted = True
+                queued.popleft()
+                in_flight[future] = index
+            if not in_flight or (best is not None and min(in_flight.values()) > best):
+                return best
+            done, _ = wait(in_flight, timeout=_timeout(), return_when=FIRST_COMPLETED)
+            if not done:
+                raise PasswordHashingBusyError(_retry_after())
+            for future in done:
+                index = in_flight.pop(future)
+                if future.result() and (best is None or index < best):
+                    best = index
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+def get_password_schemes() -> list[str]:
+    return list(_get_context(_context_config()).schemes())
+
+
+def benchmark_password_scheme(scheme: str, duration: float = 2.0, rounds: int | None = None) -> dict[str, Any]:
+    """Hash in a loop on the current thread for about ``duration`` seconds.
+
+    Uses the configured settings of ``scheme`` unless ``rounds`` overrides the cost. Runs inline on purpose: the
+    result is the single-core throughput, from which the pool size and cost can be chosen.
+    """
+    handler = _get_context(_context_config()).handler(scheme)
+    if rounds is not None:
+        handler = handler.using(rounds=rounds)
+    count = 0
+    started = time.perf_counter()
+    elapsed = 0.0
+    while count == 0 or elapsed < duration:
+        handler.hash('benchmark-password')
+        count += 1
+        elapsed = time.perf_counter() - started
+    return dict(scheme=scheme, rounds=getattr(handler, 'default_rounds', None), hashes=count, seconds=elapsed,
+                hashes_per_second=count / elapsed, ms_per_hash=elapsed * 1000 / count)
+
+
+def shutdown_password_hashing() -> None:
+    """Stop the pool and forget the configuration (mainly for tests)."""
+    global _executor, _slots
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(cancel_futures=True)
+        _executor = None
+        _slots = None
+        _contexts.clear()
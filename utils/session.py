@@ -9,14 +9,15 @@ from services.password_expiry import (
     PasswordExpiryError,
     build_password_expiry_fields,
     get_password_expiry_status,
-    maybe_send_password_expiry_warning_email,
     revoke_expired_session,
 )
 from services.user import UserService, UserServiceError
+from utils.background import defer_write
 from utils.url import url_append_param
 
 _session_key_user_id = 'user_id'
 _g_key_user = 'user'
+_g_key_user_view = 'user_view'
 _g_key_oauth_authorization = 'oauth_authorization'
 _admin_group_name = 'admin'
 
@@ -35,6 +36,8 @@ def set_current_user(user, remember):
 def clear_current_user():
     if _g_key_user in g:
         g.pop(_g_key_user)
+    if _g_key_user_view in g:
+        g.pop(_g_key_user_view)
     if _session_key_user_id in session:
         del session[_session_key_user_id]
 
@@ -64,6 +67,13 @@ def _handle_expired_session_user(user) -> None:
     clear_current_user()
 
 
+def _revoke_expired_session_by_id(user_id: int) -> None:
+    from models import User, db
+    user = db.session.get(User, user_id)
+    if user is not None:
+        revoke_expired_session(user)
+
+
 def _raise_expired_password_error() -> None:
     raise PasswordExpiryError(
         'password expired',
@@ -72,39 +82,43 @@ def _raise_expired_password_error() -> None:
     )
 
 
-def _enforce_session_password_expiry(user, *, raise_on_expired: bool = False):
+def _enforce_session_password_expiry(user, *, raise_on_expired: bool = False, read_only: bool = False):
     if user is None:
         return None
     if get_password_expiry_status(user) != 'expired':
-        maybe_send_password_expiry_warning_email(user)
-        db_commit_if_needed()
         return user
-    _handle_expired_session_user(user)
+    if read_only:
+        defer_write(_revoke_expired_session_by_id, user.id)
+        clear_current_user()
+    else:
+        _handle_expired_session_user(user)
     if raise_on_expired:
         _raise_expired_password_error()
     return None
 
 
-def db_commit_if_needed() -> None:
-    from models import db
-    if db.session.dirty or db.session.new:
-        db.session.commit()
-
+def get_session_user(*, raise_on_expired: bool = False, read_only: bool = False):
+    """Return the logged-in user of the session cookie, or None.
 
-def get_session_user(*, raise_on_expired: bool = False):
+    With ``read_only``, the result may be a ``UserView`` (a column projection loaded with one query) instead of a
+    User, and the request does no database writes: revoking the tokens of an expired session is handed to the
+    background writer.
+    """
     user = g.get(_g_key_user)
+    if user is None and read_only:
+        user = g.get(_g_key_user_view)
     if user is not None:
-        return _enforce_session_password_expiry(user, raise_on_expired=raise_on_expired)
+        return _enforce_session_password_expiry(user, raise_on_expired=raise_on_expired, read_only=read_only)
     uid = get_current_uid()
     if uid is None:
         return None
-    user = UserService.get(uid)
+    user = UserService.get_view(uid) if read_only else UserService.get(uid)
     if user is None:  # user deleted?
         clear_current_user()  # avoid next db query
         return None
-    user = _enforce_session_password_expiry(user, raise_on_expired=raise_on_expired)
+    user = _enforce_session_password_expiry(user, raise_on_expired=raise_on_expired, read_only=read_only)
     if user is not None:
-        setattr(g, _g_key_user, user)
+        setattr(g, _g_key_user_view if read_only else _g_key_user, user)
     return user
 
 
@@ -126,7 +140,7 @@ def get_oauth_authorization():
     return auth
 
 
-def get_current_user():
+def get_current_user(*, read_only: bool = False):
     # try OAuth authentication first
     try:
         auth = get_oauth_authorization()
@@ -138,7 +152,7 @@ def get_current_user():
         return auth.user
     else:
         # try getting session user
-        return get_session_user(raise_on_expired=True)
+        return get_session_user(raise_on_expired=True, read_only=read_only)
 
 
 def user_to_dict_with_password_expiry(user, *, include_intercept: bool = False) -> dict:
@@ -0,0 +1,74 @@
+from sqlalchemy import case, func, inspect, or_, select
+
+from models import db
+
+
+def _folded(column, dialect: str):
+    # Postgres: lower(column) is what the gin_trgm_ops indexes cover. SQLite: LIKE is already case-insensitive and
+    # only the bare column can use its NOCASE index.
+    return column if dialect == 'sqlite' else func.lower(column)
+
+
+def _escaped(term: str) -> str:
+    # a bound 'term%' pattern rather than startswith()'s "? || '%'", which SQLite cannot match against an index
+    return term.lower().replace('/', '//').replace('%', '/%').replace('_', '/_')
+
+
+def _sort_key(column, dialect: str):
+    # the order a NOCASE index (SQLite) or lower(column) COLLATE "C" btree index (Postgres) already stores, so
+    # "ORDER BY ... LIMIT" stops early instead of sorting every match
+    return column.collate('NOCASE') if dialect == 'sqlite' else func.lower(column).collate('C')
+
+
+def _prefix_key(column, dialect: str):
+    # what the prefix LIKE of the candidate walk runs on: the expression of the index that _sort_key walks
+    return column if dialect == 'sqlite' else _sort_key(column, dialect)
+
+
+def _prefix_condition(columns, term: str, dialect: str):
+    pattern = _escaped(term) + '%'
+    return or_(*(_folded(column, dialect).like(pattern, escape='/') for column in columns))
+
+
+def build_text_search(columns, term: str):
+    """Return ``(condition, rank)`` for a case-insensitive autocomplete search of ``term`` anywhere in ``columns``.
+
+    ``rank`` orders exact matches first, then prefix matches, then the rest. The substring condition is served by
+    the trigram indexes on Postgres for terms of three characters or more and scans the table otherwise; see
+    :func:`ranked_search` for how limited searches avoid that scan.
+    """
+    dialect = db.session.get_bind().dialect.name
+    term = term.lower()
+    folded = [_folded(column, dialect) for column in columns]
+    condition = or_(*(column.like('%' + _escaped(term) + '%', escape='/') for column in folded))
+    rank = case((or_(*(func.lower(column) == term for column in columns)), 0),
+                (_prefix_condition(columns, term, dialect), 1), else_=2)
+    return condition, rank
+
+
+def ranked_search(query, columns, term: str, limit, *order_by) -> list:
+    """Run ``query`` filtered by :func:`build_text_search` and return up to ``limit`` rows ordered by rank, then
+    ``order_by``.
+
+    With a ``limit`` the prefix matches are gathered from the first ``limit`` prefix matches of each column, in that
+    column's case-insensitive order (an index range walk rather than a sort of every match, which matters for
+    one-letter terms), and the substring search only runs when they do not fill the limit. So when more than
+    ``limit`` rows match by prefix, a row that matches only through a later column competes with that column's
+    first ``limit`` matches rather than with all of them, and the rows returned can differ from the first ``limit``
+    rows of the unlimited ranking.
+    """
+    condition, rank = build_text_search(columns, term)
+    if limit is None:
+        return query.filter(condition).order_by(rank, *order_by).all()
+
+    dialect = db.session.get_bind().dialect.name
+    key = inspect(columns[0].class_).primary_key[0]
+    pattern = _escaped(term) + '%'
+    candidates = or_(*(key.in_(select(key).where(_prefix_key(column, dialect).like(pattern, escape='/'))
+                               .order_by(_sort_key(column, dialect)).limit(limit))
+                       for column in columns))
+    rows = query.filter(candidates).order_by(rank, *order_by).limit(limit).all()
+    if len(rows) < limit:
+        found = [getattr(row, key.key) for row in rows]
+        rows += query.filter(condition, key.notin_(found)).order_by(rank, *order_by).limit(limit - len(rows)).all()
+    return rows
@@ -0,0 +1,267 @@
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from PIL import Image
+from flask import current_app as app
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_SIZES = (32, 64, 128, 256)
+_DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+_DEFAULT_WORKERS = 2
+
+_cache: 'ThumbnailCache | None' = None
+
+
+def _touch(path: str) -> None:
+    # an explicit time keeps its full precision, where the file system's own clock may tie two quick uses
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+class ThumbnailCache:
+    """Thumbnails of uploaded images at a fixed set of sizes, kept on disk under ``folder``.
+
+    ``folder`` may be shared by several workers, so what it holds is recorded there: a thumbnail's mtime is its last
+    use, and ``.usage`` keeps the folder's running file count and size, updated under an ``flock`` lock shared by all
+    workers. A render that takes the total over ``max_bytes`` rescans the folder under that lock and deletes the least
+    recently used files until it fits. Each thumbnail is rendered at most once at a time per process: a request that
+    misses while the same thumbnail is being rendered (by another request or by :meth:`pregenerate`) waits for that
+    render instead of starting its own.
+    """
+
+    def __init__(self, folder: str, sizes, max_bytes: int, workers: int) -> None:
+        self.folder = folder
+        self.sizes = tuple(sorted(set(sizes)))
+        if not self.sizes or self.sizes[0] <= 0:
+            raise ValueError('sizes must be positive')
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self.renders = 0
+        self.evictions = 0
+        self._files = 0  # in folder, as of this process's last look at .usage
+        self._bytes = 0
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._pool: ThreadPoolExecutor | None = None
+        self._pool_pid: int | None = None
+
+    def scan(self) -> None:
+        """Measure ``folder`` again (evicting down to ``max_bytes``), e.g. after files were added or removed by hand."""
+        if os.path.isdir(self.folder):
+            with self._folder_lock():
+                self._evict()
+
+    def snap(self, size: int) -> int:
+        """The smallest configured size that is at least ``size`` (the largest one for bigger requests)."""
+        for allowed in self.sizes:
+            if allowed >= size:
+                return allowed
+        return self.sizes[-1]
+
+    @staticmethod
+    def thumbnail_path(path: str, size: int) -> str:
+        prefix, ext = os.path.splitext(path)
+        return '%s_s%d%s' % (prefix, size, ext)
+
+    def get(self, source_root: str, path: str, size: int) -> str:
+        """Return the path of ``path``'s thumbnail at ``size`` (a configured size) relative to ``folder``, rendering
+        it if needed. Raises IOError if the source is missing or not an image."""
+        key = self.thumbnail_path(path, size)
+        try:
+            _touch(os.path.join(self.folder, key))  # possibly rendered by another worker; now the most recently used
+        except OSError:
+            pass
+        else:
+            with self._lock:
+                self.hits += 1
+            return key
+        with self._lock:
+            self.misses += 1
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if owner:
+            self._render(source_root, path, size, key, future)
+        future.result()
+        return key
+
+    def pregenerate(self, source_root: str, path: str) -> None:
+        """Render every configured size of ``path`` on the background pool."""
+        pool = self._get_pool()
+        for size in self.sizes:
+            key = self.thumbnail_path(path, size)
+            with self._lock:
+                if key in self._inflight or os.path.exists(os.path.join(self.folder, key)):
+                    continue
+                future = self._inflight[key] = Future()
+            pool.submit(self._render, source_root, path, size, key, future)
+
+    def discard(self, path: str) -> None:
+        """Delete the thumbnails of ``path``, e.g. once the upload itself is deleted."""
+        if not os.path.isdir(self.folder):
+            return
+        with self._folder_lock():
+            for size in self.sizes:
+                full = os.path.join(self.folder, self.thumbnail_path(path, size))
+                try:
+                    nbytes = os.path.getsize(full)
+                    os.unlink(full)
+                except OSError:
+                    continue
+                self._record_usage(-1, -nbytes)
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():  # the pool's threads do not survive a fork
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='thumbnails')
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _render(self, source_root: str, path: str, size: int, key: str, future: Future) -> None:
+        full = os.path.join(self.folder, key)
+        try:
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            with Image.open(os.path.join(source_root, path)) as im:
+                im.thumbnail((size, size))
+                # write aside and rename, so other workers never serve a partial file
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(full), prefix='.', suffix=os.path.splitext(full)[1])
+                os.close(fd)
+                try:
+                    im.save(tmp)  # format from the extension, as the source was named
+                    _touch(tmp)
+                    self._store(tmp, full)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.unlink(tmp)
+                    raise
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            if not isinstance(e, IOError):
+                logger.exception('Rendering thumbnail %s failed', key)
+            return
+        with self._lock:
+            self.renders += 1
+            self._inflight.pop(key, None)
+        future.set_result(key)
+
+    def _store(self, tmp: str, full: str) -> None:
+        # rename and count together, so a concurrent rescan cannot count the file a second time
+        nbytes = os.path.getsize(tmp)
+        with self._folder_lock():
+            try:
+                replaced = os.path.getsize(full)  # rendered meanwhile by another worker
+            except OSError:
+                replaced = None
+            os.replace(tmp, full)
+            if replaced is None:
+                self._record_usage(1, nbytes)
+            else:
+                self._record_usage(0, nbytes - replaced)
+
+    @contextmanager
+    def _folder_lock(self):
+        with open(os.path.join(self.folder, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file is closed
+            yield
+
+    def _record_usage(self, files: int, nbytes: int) -> None:
+        # holding _folder_lock, with the change already made in the folder
+        try:
+            with open(os.path.join(self.folder, '.usage')) as f:
+                total_files, total_bytes = (int(value) for value in f.read().split())
+        except (OSError, ValueError):  # not measured yet, or cut short
+            self._evict()
+            return
+        total_files += files
+        total_bytes += nbytes
+        if total_bytes > self.max_bytes or total_files < 0 or total_bytes < 0:
+            self._evict()
+            return
+        self._write_usage(total_files, total_bytes)
+
+    def _write_usage(self, files: int, nbytes: int) -> None:
+        with open(os.path.join(self.folder, '.usage'), 'w') as f:
+            f.write('%d %d' % (files, nbytes))
+        with self._lock:
+            self._files = files
+            self._bytes = nbytes
+
+    def _evict(self) -> None:
+        # holding _folder_lock: the folder itself is the truth, .usage only a running total since the last scan
+        found = []
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if name.startswith('.'):  # .lock, .usage, and renders not yet renamed into place
+                    continue
+                full = os.path.join(root, name)
+                try:
+                    stat = os.stat(full)
+                except OSError:
+                    continue
+                found.append((stat.st_mtime_ns, full, stat.st_size))
+        found.sort()
+        total = sum(nbytes for _, _, nbytes in found)
+        evicted = 0
+        for _, full, nbytes in found[:-1]:  # least recently used first, always keeping the newest
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(full)
+            except OSError:
+                continue
+            total -= nbytes
+            evicted += 1
+        self._write_usage(len(found) - evicted, total)
+        with self._lock:
+            self.evictions += evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(sizes=list(self.sizes), files=self._files, bytes=self._bytes, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses, hit_rate=self.hits / lookups if lookups else None,
+                        renders=self.renders, evictions=self.evictions, in_flight=len(self._inflight))
+
+
+def _thumbnail_config() -> dict:
+    cfg = (app.config.get('UPLOAD') or {}).get('thumbnail')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def get_thumbnail_cache() -> ThumbnailCache:
+    global _cache
+    if _cache is None:
+        cfg = _thumbnail_config()
+        _cache = ThumbnailCache(cfg.get('folder') or os.path.join(tempfile.gettempdir(), 'idm_thumbnails'),
+                                [int(size) for size in cfg.get('sizes', _DEFAULT_SIZES)],
+                                int(cfg.get('max_cache_bytes', _DEFAULT_MAX_CACHE_BYTES)),
+                                int(cfg.get('workers', _DEFAULT_WORKERS)))
+    return _cache
+
+
+def init_thumbnail_cache(app) -> None:
+    """Measure the thumbnail folder now rather than during the first render of each worker."""
+    with app.app_context():
+        get_thumbnail_cache().scan()
+
+
+def get_thumbnail_stats() -> dict:
+    return get_thumbnail_cache().stats()
+
+
+def reset_thumbnail_cache() -> None:
+    """Drop the cache instance so the next use re-reads UPLOAD.thumbnail (mainly for tests)."""
+    global _cache
+    _cache = None
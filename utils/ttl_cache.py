@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+_K = TypeVar('_K', bound=Hashable)
+_V = TypeVar('_V')
+
+
+class TTLCache(Generic[_K, _V]):
+    """Thread-safe bounded LRU cache with per-entry expiry and hit/miss counters.
+
+    Entries are evicted least-recently-used first once ``max_size`` is reached. ``ttl`` is the default lifetime in
+    seconds (``None`` means entries only leave through eviction or explicit invalidation).
+    """
+
+    def __init__(self, max_size: int, ttl: float | None = None) -> None:
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[_K, tuple[float | None, _V]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: _K, default: _V | None = None) -> _V | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                deadline, value = entry
+                if deadline is None or deadline > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: _K, value: _V, ttl: float | None = None) -> None:
+        if ttl is None:
+            ttl = self.ttl
+        deadline = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (deadline, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: _K) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_where(self, predicate: Callable[[_K, _V], bool]) -> int:
+        with self._lock:
+            keys = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self._entries), max_size=self.max_size, hits=self.hits, misses=self.misses,
+                        hit_rate=self.hits / lookups if lookups else None)
@@ -1,11 +1,20 @@
+import fcntl
+import hashlib
+import io
 import os
+import re
 import tempfile
+import time
+from contextlib import contextmanager
 from uuid import uuid4
 
-from PIL import Image
+from PIL import Image, ImageOps
 from flask import current_app as app, send_from_directory, request, jsonify
+from werkzeug.security import safe_join
 
 from error import BasicError
+from models import OAuthClient, User, db
+from utils.thumbnail import get_thumbnail_cache
 
 
 class UploadError(BasicError):
@@ -13,6 +22,26 @@ class UploadError(BasicError):
 
 
 _cache_timeout = 365 * 24 * 60 * 60  # 1 year
+_CHUNK_SIZE = 64 * 1024
+_FORM_OVERHEAD = 64 * 1024  # multipart boundaries and the other form fields sent along with a file
+# leading bytes of PNG, JPEG and GIF, the image types uploads accept
+_IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a')
+_DEFAULT_MAX_DIMENSION = 512
+_DEFAULT_MAX_SOURCE_DIMENSION = 4096
+_DEFAULT_WEBP_QUALITY = 90
+# <type>/<sha256[:2]>/<sha256[2:4]>/<sha256>.<ext>, as written for checked images
+_CONTENT_ADDRESSED_PATH = re.compile(r'^\w+/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+$')
+_RELEASE_GRACE_SECONDS = 60
+# the columns that refer to the content-addressed uploads of each type
+_REFERENCE_COLUMNS = {'avatar': User.avatar, 'icon': OAuthClient.icon}
+
+
+def limit_upload_request(_type):
+    """Cap the current request body at what an upload of ``_type`` can need, so the form parser answers a larger one
+    with 413 instead of spooling it. Call before the first access to ``request.files`` or ``request.form``."""
+    limit = app.config['UPLOAD'][_type]['size_limit'] + _FORM_OVERHEAD
+    configured = app.config.get('MAX_CONTENT_LENGTH')  # never loosen the app-wide cap
+    request.max_content_length = limit if configured is None else min(limit, configured)
 
 
 def get_upload(path):
@@ -21,24 +50,26 @@ def get_upload(path):
     if size_param:
         try:
             size = int(size_param)
-            prefix, ext = os.path.splitext(path)
-            thumbnail_root = os.path.join(tempfile.gettempdir(), 'idm_thumbnails')
-            thumbnail_path = '%s_s%d%s' % (prefix, size, ext)
-            thumbnail_path_full = os.path.join(thumbnail_root, thumbnail_path)
-            if not os.path.exists(thumbnail_path_full):
-                source_path_full = os.path.join(source_root, path)
-                im = Image.open(source_path_full)
-                im.thumbnail((size, size))
-                thumbnail_folder_full = os.path.dirname(thumbnail_path_full)
-                if not os.path.exists(thumbnail_folder_full):
-                    os.makedirs(thumbnail_folder_full)
-                im.save(thumbnail_path_full)
-            return send_from_directory(thumbnail_root, thumbnail_path, max_age=_cache_timeout)
         except ValueError:
             return jsonify(msg='invalid thumbnail parameter'), 400
+        if size <= 0:
+            return jsonify(msg='invalid thumbnail parameter'), 400
+        if safe_join(source_root, path) is None:
+            return jsonify(msg='file not found'), 404
+        cache = get_thumbnail_cache()
+        try:
+            # only the configured sizes are rendered; other sizes get the next larger one
+            thumbnail_path = cache.get(source_root, path, cache.snap(size))
+        except FileNotFoundError:
+            return jsonify(msg='file not found'), 404
         except IOError as e:
             return jsonify(msg='failed to create thumbnail', detail=str(e)), 500
-    return send_from_directory(source_root, path, max_age=_cache_timeout)
+        return send_from_directory(cache.folder, thumbnail_path, max_age=_cache_timeout)
+    response = send_from_directory(source_root, path, max_age=_cache_timeout)
+    if _CONTENT_ADDRESSED_PATH.match(path):
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
 
 
 def init_app(app):
@@ -62,48 +93,171 @@ def handle_upload(file, _type, image_check=False, image_check_squared=False):
     if not os.path.isdir(save_folder):
         os.makedirs(save_folder)
 
-    save_file = None
-    save_path = None
-    for _ in range(5):
-        _file = "%s.%s" % (str(uuid4()), ext)
-        _path = os.path.join(save_folder, _file)
-        if not os.path.lexists(_path):
-            save_file = _file
-            save_path = _path
-            break
-    if save_file is None:
-        raise UploadError('file name space almost exhausted')
-    file.save(save_path)
+    # copy into a temp file next to the target and rename it into place only once every check passed
+    fd, tmp_path = tempfile.mkstemp(dir=save_folder, prefix='.upload-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            _copy_upload(file.stream, out, upload_config['size_limit'], image_check)
+
+        if image_check:
+            try:
+                with Image.open(tmp_path) as im:  # reads the header only; pixels are decoded in _normalize_image
+                    if image_check_squared:
+                        if im.size[0] != im.size[1]:
+                            raise UploadError('image is not squared')
+                    data, ext = _normalize_image(im)
+            except Image.DecompressionBombError:
+                raise UploadError('image dimensions too large')
+            except IOError:
+                raise UploadError('invalid image file')
 
-    if os.stat(save_path).st_size > upload_config['size_limit']:
-        os.unlink(save_path)
-        raise UploadError('file size too big')
+            # content-addressed: identical images share one file (and its thumbnails), and a URL never changes content
+            digest = hashlib.sha256(data).hexdigest()
+            save_file = '%s/%s/%s.%s' % (digest[:2], digest[2:4], digest, ext)
+            save_path = os.path.join(save_folder, save_file)
+            with _content_lock(upload_root, _type, digest):
+                if os.path.exists(save_path):
+                    # a fresh mtime keeps handle_post_upload from releasing it under the new reference
+                    os.utime(save_path)
+                else:
+                    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+                    with open(tmp_path, 'wb') as out:
+                        out.write(data)
+                    os.replace(tmp_path, save_path)
+        else:
+            save_file = None
+            save_path = None
+            for _ in range(5):
+                _file = "%s.%s" % (str(uuid4()), ext)
+                _path = os.path.join(save_folder, _file)
+                if not os.path.lexists(_path):
+                    save_file = _file
+                    save_path = _path
+                    break
+            if save_file is None:
+                raise UploadError('file name space almost exhausted')
+            os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
 
     if image_check:
-        try:
-            with Image.open(save_path) as im:
-                image_size = im.size
-        except IOError:
-            os.unlink(save_path)
-            raise UploadError('invalid image file')
-        if image_check_squared:
-            if image_size[0] != image_size[1]:
-                os.unlink(save_path)
-                raise UploadError('image is not squared')
+        get_thumbnail_cache().pregenerate(upload_root, '/'.join([sub_folder, save_file]))
 
     url = '/'.join(['upload', sub_folder, save_file])
     return url
 
 
+def _normalize_image(im):
+    """Re-encode ``im`` upright, without metadata (EXIF, text chunks) and at most ``max_dimension`` pixels wide and
+    high. Returns the encoded bytes and their file extension.
+
+    A small file can declare a huge canvas, so images over ``max_source_dimension`` pixels wide or high are refused
+    before any pixel is decoded.
+    """
+    cfg = _image_config()
+    max_dimension = int(cfg.get('max_dimension', _DEFAULT_MAX_DIMENSION))
+    if max(im.size) > int(cfg.get('max_source_dimension', _DEFAULT_MAX_SOURCE_DIMENSION)):
+        raise UploadError('image dimensions too large')
+    if im.format == 'JPEG':
+        im.draft(im.mode, (max_dimension, max_dimension))  # let the decoder downscale by up to 8x
+    im = ImageOps.exif_transpose(im)
+    has_alpha = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+    im = im.convert('RGBA' if has_alpha else 'RGB')
+    im.thumbnail((max_dimension, max_dimension))  # only ever shrinks
+    out = io.BytesIO()
+    if cfg.get('format', 'png') == 'webp':
+        im.save(out, 'WEBP', quality=int(cfg.get('webp_quality', _DEFAULT_WEBP_QUALITY)))
+        return out.getvalue(), 'webp'
+    im.save(out, 'PNG', optimize=True)
+    return out.getvalue(), 'png'
+
+
+def _image_config() -> dict:
+    cfg = app.config['UPLOAD'].get('image')
+    return cfg if isinstance(cfg, dict) else {}
+
+
+def _copy_upload(stream, out, size_limit, image_check):
+    """Copy ``stream`` to ``out`` in chunks, giving up as soon as it exceeds ``size_limit`` bytes or, with
+    ``image_check``, as soon as its first bytes are not an image header."""
+    size = 0
+    while True:
+        chunk = stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        if size == 0 and image_check and not chunk.startswith(_IMAGE_SIGNATURES):
+            raise UploadError('invalid image file')
+        size += len(chunk)
+        if size > size_limit:
+            raise UploadError('file size too big')
+        out.write(chunk)
+
+
 def handle_post_upload(old_url, _type):
-    parts = old_url.split('/')
-    if len(parts) != 3:
-        return
-    root, sub_folder, file = parts
-    if root != 'upload' or sub_folder != _type:
-        return
+    """Release the upload at ``old_url`` after its owner switched to another one or was deleted. Call it after the
+    owner's change is committed. Returns whether the file was deleted.
 
+    Content-addressed files may be shared, so they are only deleted once no user or client refers to them any more,
+    and not within ``_RELEASE_GRACE_SECONDS`` of being stored, as another upload of the same image may not have
+    committed its reference yet. :func:`sweep_uploads` deletes the files skipped for that reason later.
+    """
+    parts = old_url.split('/')
+    if len(parts) < 3 or parts[0] != 'upload' or parts[1] != _type:
+        return False
+    path = '/'.join(parts[1:])
     upload_root = app.config['UPLOAD']['root_folder']
-    old_path = os.path.join(upload_root, sub_folder, file)
-    if os.path.isfile(old_path):
+    old_path = os.path.join(upload_root, path)
+
+    if len(parts) == 3:  # a uuid4 name, owned by one row
+        if not os.path.isfile(old_path):
+            return False
         os.unlink(old_path)
+    elif _CONTENT_ADDRESSED_PATH.match(path):
+        with _content_lock(upload_root, _type, parts[-1]):
+            if _reference_count(_type, old_url) > 0:
+                return False
+            try:
+                if time.time() - os.path.getmtime(old_path) < _RELEASE_GRACE_SECONDS:
+                    return False  # just stored: the new reference may not be committed yet
+                os.unlink(old_path)
+            except OSError:
+                return False
+    else:
+        return False
+    get_thumbnail_cache().discard(path)
+    return True
+
+
+def sweep_uploads():
+    """Delete the content-addressed uploads that no user or client refers to, once past the grace period that
+    made :func:`handle_post_upload` keep them. Returns the number of files deleted."""
+    upload_root = app.config['UPLOAD']['root_folder']
+    deleted = 0
+    for _type, column in _REFERENCE_COLUMNS.items():
+        referenced = {url for url, in db.session.query(column).filter(column.isnot(None)).distinct()}
+        for root, _, names in os.walk(os.path.join(upload_root, _type)):
+            for name in names:
+                path = os.path.relpath(os.path.join(root, name), upload_root).replace(os.sep, '/')
+                url = 'upload/' + path
+                if _CONTENT_ADDRESSED_PATH.match(path) and url not in referenced and handle_post_upload(url, _type):
+                    deleted += 1
+    return deleted
+
+
+@contextmanager
+def _content_lock(upload_root, _type, digest):
+    """Hold an exclusive lock, shared by all workers, over the content-addressed files whose digest starts like
+    ``digest``, so a re-upload cannot refresh a file that a release has already decided to delete."""
+    folder = os.path.join(upload_root, '.locks')
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, '%s-%s.lock' % (_type, digest[:2])), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)  # released when the file is closed
+        yield
+
+
+def _reference_count(_type, url):
+    column = _REFERENCE_COLUMNS.get(_type)
+    if column is None:
+        return 0
+    return db.session.query(column).filter(column == url).count()